@@ -1,16 +1,84 @@
+import time
+import threading
+from typing import Dict, Any
+
+from starlette.requests import HTTPConnection
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, AsyncAdaptedQueuePool
 from app.config import get_settings
 
 settings = get_settings()
 
+
+class PoolMetrics:
+    """Track how long requests wait for a pooled connection"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            avg_wait = self.total_wait / self.checkouts if self.checkouts else 0.0
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": round(avg_wait * 1000, 2),
+                "max_wait_ms": round(self.max_wait * 1000, 2)
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records checkout wait times"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_metrics.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.record_wait(time.perf_counter() - start)
+        return connection
+
+
+def _engine_options() -> Dict[str, Any]:
+    """Build pool options from settings"""
+    if not settings.db_pool_enabled:
+        return {"poolclass": NullPool}
+
+    return {
+        "poolclass": MeteredQueuePool,
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping
+    }
+
+
 # Create async engine
 engine = create_async_engine(
     settings.database_url,
     echo=settings.sql_echo,
-    poolclass=NullPool,  # Disable connection pooling for simplicity
-    future=True
+    future=True,
+    **_engine_options()
 )
 
 # Create session factory
@@ -24,8 +92,17 @@ async_session_maker = async_sessionmaker(
 Base = declarative_base()
 
 
-async def get_db():
-    """Dependency to get database session"""
+async def get_db(connection: HTTPConnection):
+    """Dependency to get database session
+    
+    Reuses the request-scoped session opened by the authentication middleware
+    so the user lookup and the route share one connection and transaction.
+    """
+    request_session = getattr(connection.state, "db", None)
+    if request_session is not None:
+        yield request_session
+        return
+    
     async with async_session_maker() as session:
         try:
             yield session
@@ -33,8 +110,30 @@ async def get_db():
             await session.close()
 
 
+def get_pool_status() -> Dict[str, Any]:
+    """Current connection pool usage for sizing the pool per deployment"""
+    pool = engine.pool
+    if not isinstance(pool, AsyncAdaptedQueuePool):
+        return {"pooled": False}
+
+    return {
+        "pooled": True,
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": settings.db_max_overflow,
+        **pool_metrics.snapshot()
+    }
+
+
 async def init_db():
     """Initialize database tables"""
     async with engine.begin() as conn:
         # Create all tables
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def close_db():
+    """Dispose of all pooled connections"""
+    await engine.dispose()
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
@@ -8,10 +9,14 @@ from fastapi.responses import HTMLResponse
 import structlog
 
 from app.config import get_settings
-from app.database import init_db
+from app.database import init_db, close_db, get_pool_status
 from app.routers import auth, workshop, projects, websocket, admin, images, public
 from app.middleware import AuthenticationMiddleware
 from app.services.deployment import get_published_site
+from app.services.last_seen import last_seen_tracker
+from app.services.cost_ledger import cost_ledger
+from app.services.llm_call_writer import llm_call_writer
+from app.services.azure_ai import get_ai_service, close_ai_service
 
 # Configure structured logging
 structlog.configure(
@@ -38,6 +43,13 @@ settings = get_settings()
 templates = Jinja2Templates(directory="app/templates")
 
 
+async def log_pool_status(interval: int):
+    """Periodically log database pool usage"""
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("Database pool status", **get_pool_status())
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan manager"""
@@ -45,11 +57,27 @@ async def lifespan(app: FastAPI):
     logger.info("Starting KI Website Workshop Portal", environment=settings.environment)
     await init_db()
     logger.info("Database initialized")
+    last_seen_tracker.start()
+    cost_ledger.start()
+    llm_call_writer.start()
+    await get_ai_service().warm_up()
+    
+    pool_log_task = None
+    if settings.db_pool_enabled and settings.db_pool_log_interval > 0:
+        pool_log_task = asyncio.create_task(log_pool_status(settings.db_pool_log_interval))
     
     yield
     
     # Shutdown
     logger.info("Shutting down KI Website Workshop Portal")
+    if pool_log_task:
+        pool_log_task.cancel()
+    await last_seen_tracker.stop()
+    await cost_ledger.stop()
+    # Write queued AI calls while the database is still open
+    await llm_call_writer.stop()
+    await close_ai_service()
+    await close_db()
 
 
 # Create FastAPI app
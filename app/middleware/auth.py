@@ -1,17 +1,27 @@
+import re
 from typing import Optional, Set
 from fastapi import Request, HTTPException
-from fastapi.responses import RedirectResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi.responses import RedirectResponse, JSONResponse
+from starlette.requests import HTTPConnection
 from starlette.responses import Response
+from starlette.types import ASGIApp, Receive, Scope, Send
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
+from sqlalchemy.orm import joinedload
 
 from app.database import async_session_maker
 from app.models import User
+from app.services.session_cache import session_cache
+from app.services.last_seen import last_seen_tracker
+from app.services import session_tokens
 
 
-class AuthenticationMiddleware(BaseHTTPMiddleware):
-    """Authentication middleware for protecting routes"""
+class AuthenticationMiddleware:
+    """Authentication middleware for protecting routes
+    
+    Implemented as plain ASGI middleware so responses (image data, exports,
+    published sites) stream straight through without being buffered.
+    """
     
     # Routes that don't require authentication
     EXCLUDED_PATHS: Set[str] = {
@@ -40,76 +50,121 @@ class AuthenticationMiddleware(BaseHTTPMiddleware):
         "/gallery"
     }
 
-    async def dispatch(self, request: Request, call_next):
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._skip_auth_pattern = self._compile_skip_auth_pattern()
+        self._redirect_paths = frozenset(self.REDIRECT_PATHS)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         """Process request through authentication middleware"""
         
+        # WebSockets authenticate with the token in their URL
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        path = scope["path"]
+        
         # Skip authentication for excluded paths
-        if self._should_skip_auth(request.url.path):
-            return await call_next(request)
+        if self._should_skip_auth(path):
+            await self.app(scope, receive, send)
+            return
         
         # Get session token from cookies
-        session_token = request.cookies.get("session_token")
+        session_token = HTTPConnection(scope).cookies.get("session_token")
         
         if not session_token:
-            return self._handle_unauthenticated(request)
-        
-        # Validate session token and get user
-        user = await self._get_user_from_token(session_token)
+            await self._handle_unauthenticated(path)(scope, receive, send)
+            return
         
-        if not user:
-            return self._handle_invalid_session(request)
-        
-        # Add user to request state for use in route handlers
-        request.state.user = user
-        
-        return await call_next(request)
+        # One session per request, shared with route handlers through get_db
+        async with async_session_maker() as db:
+            # Validate session token and get user
+            user = await self._get_user_from_token(session_token, db)
+            
+            if not user:
+                await self._handle_invalid_session(path)(scope, receive, send)
+                return
+            
+            # Update last seen timestamp (flushed in bulk in the background)
+            last_seen_tracker.touch(user.id)
+            
+            # Add user and session to request state for use in route handlers
+            state = scope.setdefault("state", {})
+            state["user"] = user
+            state["db"] = db
+            
+            await self.app(scope, receive, send)
+    
+    def _compile_skip_auth_pattern(self) -> re.Pattern:
+        """Compile excluded paths and prefixes into a single matcher"""
+        exact = "|".join(re.escape(path) for path in sorted(self.EXCLUDED_PATHS))
+        prefixes = "|".join(re.escape(prefix) for prefix in sorted(self.EXCLUDED_PREFIXES))
+        return re.compile(f"(?:{exact})$|(?:{prefixes})")
     
     def _should_skip_auth(self, path: str) -> bool:
         """Check if path should skip authentication"""
-        # Check exact paths
-        if path in self.EXCLUDED_PATHS:
-            return True
-        
-        # Check prefixes
-        return any(
-            path.startswith(prefix) 
-            for prefix in self.EXCLUDED_PREFIXES
-        )
+        return self._skip_auth_pattern.match(path) is not None
     
-    def _handle_unauthenticated(self, request: Request) -> Response:
+    def _handle_unauthenticated(self, path: str) -> Response:
         """Handle unauthenticated requests"""
-        if any(path == request.url.path for path in self.REDIRECT_PATHS):
+        if path in self._redirect_paths:
             return RedirectResponse(url="/", status_code=303)
         
-        raise HTTPException(status_code=401, detail="Nicht angemeldet")
+        return JSONResponse({"detail": "Nicht angemeldet"}, status_code=401)
     
-    def _handle_invalid_session(self, request: Request) -> Response:
+    def _handle_invalid_session(self, path: str) -> Response:
         """Handle invalid session tokens"""
-        if any(path == request.url.path for path in self.REDIRECT_PATHS):
+        if path in self._redirect_paths:
             response = RedirectResponse(url="/", status_code=303)
             response.delete_cookie("session_token")
             return response
         
-        raise HTTPException(status_code=401, detail="Ungültige Session")
+        return JSONResponse({"detail": "Ungültige Session"}, status_code=401)
     
-    async def _get_user_from_token(self, session_token: str) -> Optional[User]:
-        """Get user from session token"""
+    async def _get_user_from_token(self, session_token: str, db: AsyncSession) -> Optional[User]:
+        """Get user from session token, attached to the request session"""
         try:
-            async with async_session_maker() as db:
-                result = await db.execute(
-                    select(User).where(User.session_token == session_token)
-                )
-                user = result.scalar_one_or_none()
-                
-                if user:
-                    # Update last seen timestamp
-                    from datetime import datetime
-                    user.last_seen = datetime.utcnow()
-                    await db.commit()
-                
-                return user
+            return await load_session_user(session_token, db)
         except Exception:
+            await db.rollback()
+            return None
+
+
+async def load_session_user(session_token: str, db: AsyncSession) -> Optional[User]:
+    """
+    Get the user of a session token, attached to db (used by requests and WebSockets)
+    
+    Signed tokens are verified in CPU, so forged, expired or revoked ones never
+    reach the DB; valid ones are rebuilt from the session cache without a query.
+    """
+    claims = None
+    if session_tokens.is_signed_mode():
+        claims = session_tokens.verify_session_token(session_token)
+        if not claims:
             return None
+    
+    # Hot path: rebuild the user from the in-memory cache without a query
+    snapshot = session_cache.get(session_token)
+    if snapshot:
+        return await session_cache.attach(snapshot, db)
+    
+    if claims:
+        user = await db.get(User, claims.user_id, options=[joinedload(User.workshop)])
+        if user and not session_tokens.is_current_generation(user, claims):
+            user = None
+    else:
+        result = await db.execute(
+            select(User)
+            .options(joinedload(User.workshop))
+            .where(User.session_token == session_token)
+        )
+        user = result.scalar_one_or_none()
+    
+    if user:
+        session_cache.set(session_token, user)
+    
+    return user
 
 
 # Dependency to get current user from request state
@@ -1,7 +1,7 @@
 from .user import User, UserRole
 from .workshop import Workshop
 from .website import Website, CodeHistory, ChangeType, WebsiteLike, WebsiteCollaborator, WebsiteComment, WebsiteShare
-from .llm import LLMCall, ChatMessage, MessageRole, ResponseType
+from .llm import LLMCall, UserCostLedger, ChatMessage, MessageRole, ResponseType
 from .template import Template
 from .image import UserImage
 
@@ -17,6 +17,7 @@ __all__ = [
     "WebsiteComment", 
     "WebsiteShare",
     "LLMCall",
+    "UserCostLedger",
     "ChatMessage",
     "MessageRole",
     "ResponseType",
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DECIMAL, Boolean, ForeignKey, JSON, Enum, DateTime, CheckConstraint
+from sqlalchemy import Column, Integer, String, Text, DECIMAL, Float, Boolean, ForeignKey, JSON, Enum, DateTime, CheckConstraint
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from app.database import Base
@@ -29,6 +29,7 @@ class LLMCall(Base):
     response_data = Column(JSON, nullable=False)
     model = Column(String(50), default="gpt-4.1-mini")
     prompt_tokens = Column(Integer, nullable=False)
+    cached_tokens = Column(Integer, default=0, nullable=False)
     completion_tokens = Column(Integer, nullable=False)
     total_tokens = Column(Integer, nullable=False)
     cost = Column(DECIMAL(10, 6), nullable=False)
@@ -36,6 +37,13 @@ class LLMCall(Base):
     is_error_fix = Column(Boolean, default=False)
     parent_call_id = Column(Integer, ForeignKey("llm_calls.id"))
     duration_ms = Column(Integer)
+    queue_wait_ms = Column(Integer)
+    ttft_ms = Column(Integer)
+    tokens_per_second = Column(Float)
+    retries = Column(Integer, default=0, nullable=False)
+    endpoint = Column(String(100))
+    cache_hit = Column(Boolean, default=False, nullable=False)
+    prompt_breakdown = Column(JSON)
     created_at = Column(DateTime, server_default=func.now())
     
     # Relationships
@@ -48,6 +56,17 @@ class LLMCall(Base):
     )
 
 
+class UserCostLedger(Base):
+    """Running totals of a user's LLM calls, updated with every recorded call"""
+    __tablename__ = "user_cost_ledger"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    total_cost = Column(DECIMAL(12, 6), default=0, nullable=False)
+    total_calls = Column(Integer, default=0, nullable=False)
+    total_tokens = Column(Integer, default=0, nullable=False)
+    last_call_at = Column(DateTime)
+
+
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
     
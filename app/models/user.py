@@ -23,6 +23,7 @@ class User(Base):
     display_name = Column(String(100))
     password_hash = Column(String(255), nullable=False)
     session_token = Column(String(255), unique=True, server_default=func.gen_random_uuid())
+    token_generation = Column(Integer, default=0, nullable=False)
     role = Column(Enum(UserRole), default=UserRole.PARTICIPANT)
     joined_at = Column(DateTime, server_default=func.now())
     last_seen = Column(DateTime, server_default=func.now())
@@ -1,14 +1,22 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, func, or_
 from sqlalchemy.orm import selectinload
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Optional
 
-from app.database import get_db
-from app.models import User, Workshop, LLMCall, Website, UserRole
+from app.database import get_db, get_pool_status
+from app.models import User, Workshop, UserCostLedger, Website, UserRole
 from app.middleware.auth import get_current_user_from_state
-from app.services import CostTracker
+from app.services import CostTracker, get_ai_service
+from app.services.session_cache import session_cache
+from app.services.cost_ledger import cost_ledger
+from app.services.llm_call_writer import llm_call_writer
+from app.services.llm_scheduler import llm_scheduler
+from app.services.llm_telemetry import llm_telemetry
+from app.services.rate_limiter import llm_rate_limiter
+from app.services.response_cache import response_cache
+from app.services.last_seen import last_seen_tracker
 
 router = APIRouter()
 
@@ -70,28 +78,24 @@ async def get_admin_stats(
     # Active users (last 5 minutes)
     from datetime import datetime, timedelta
     since = datetime.utcnow() - timedelta(minutes=5)
+    # Include users whose last_seen is still buffered in memory
+    recently_seen = last_seen_tracker.get_recent_user_ids(since)
     result = await db.execute(
         select(func.count(User.id))
         .where(User.workshop_id == workshop_id)
-        .where(User.last_seen >= since)
+        .where(or_(User.last_seen >= since, User.id.in_(recently_seen)))
     )
     active_users = result.scalar() or 0
     
-    # Total cost
+    # Total cost and API calls from the per-user ledger
     result = await db.execute(
-        select(func.sum(LLMCall.cost))
-        .join(User)
+        select(func.sum(UserCostLedger.total_cost), func.sum(UserCostLedger.total_calls))
+        .join(User, User.id == UserCostLedger.user_id)
         .where(User.workshop_id == workshop_id)
     )
-    total_cost = float(result.scalar() or 0)
-    
-    # Total API calls
-    result = await db.execute(
-        select(func.count(LLMCall.id))
-        .join(User)
-        .where(User.workshop_id == workshop_id)
-    )
-    total_api_calls = result.scalar() or 0
+    total_cost, total_api_calls = result.one()
+    total_cost = float(total_cost or 0)
+    total_api_calls = total_api_calls or 0
     
     # Total websites
     result = await db.execute(
@@ -114,6 +118,31 @@ async def get_admin_stats(
     )
 
 
+@router.get("/db-pool")
+async def get_db_pool_status(request: Request):
+    """Get database connection pool, session cache, cost ledger and LLM call queue usage"""
+    require_admin(request)
+    return {
+        **get_pool_status(),
+        "session_cache": session_cache.get_stats(),
+        "cost_ledger": cost_ledger.get_stats(),
+        "llm_call_writer": llm_call_writer.get_stats()
+    }
+
+
+@router.get("/llm")
+async def get_llm_status(request: Request):
+    """Get LLM queue usage, rate limiter, response cache, latency percentiles per model and per-deployment counters"""
+    require_admin(request)
+    return {
+        "scheduler": llm_scheduler.get_stats(),
+        "latency": llm_telemetry.get_stats(),
+        "rate_limiter": llm_rate_limiter.get_stats(),
+        "endpoints": get_ai_service().get_endpoint_stats(),
+        "response_cache": response_cache.get_stats()
+    }
+
+
 @router.get("/users", response_model=List[UserDetail])
 async def get_all_users(
     request: Request,
@@ -127,6 +156,7 @@ async def get_all_users(
     users = result.scalars().all()
     
     cost_tracker = CostTracker(db)
+    await cost_tracker.load_users([user.id for user in users])
     user_details = []
     
     for user in users:
@@ -146,7 +176,7 @@ async def get_all_users(
             total_cost=stats["total_cost"],
             total_calls=stats["total_calls"],
             total_tokens=stats["total_tokens"],
-            last_seen=user.last_seen.isoformat(),
+            last_seen=(last_seen_tracker.get(user.id) or user.last_seen).isoformat(),
             website_count=website_count
         ))
     
@@ -177,8 +207,8 @@ async def get_workshop_details(
     
     # Total cost
     result = await db.execute(
-        select(func.sum(LLMCall.cost))
-        .join(User)
+        select(func.sum(UserCostLedger.total_cost))
+        .join(User, User.id == UserCostLedger.user_id)
         .where(User.workshop_id == workshop.id)
     )
     total_cost = float(result.scalar() or 0)
@@ -212,10 +242,75 @@ async def stop_workshop(
     
     workshop.is_active = False
     await db.commit()
+    session_cache.invalidate_workshop(workshop.id)
     
     return {"message": "Workshop beendet"}
 
 
+class ResponseCacheSettings(BaseModel):
+    enabled: bool
+
+
+@router.post("/workshop/response-cache")
+async def set_response_cache(
+    request: Request,
+    cache_settings: ResponseCacheSettings,
+    db: AsyncSession = Depends(get_db)
+):
+    """Enable or disable replaying cached AI responses in this workshop"""
+    admin_user = require_admin(request)
+    result = await db.execute(
+        select(Workshop).where(Workshop.id == admin_user.workshop_id)
+    )
+    workshop = result.scalar_one_or_none()
+    
+    if not workshop:
+        raise HTTPException(status_code=404, detail="Workshop nicht gefunden")
+    
+    # Reassign so the JSON column is marked as changed
+    workshop.settings = {**(workshop.settings or {}), "response_cache": cache_settings.enabled}
+    await db.commit()
+    session_cache.invalidate_workshop(workshop.id)
+    
+    return {"message": "Antwort-Cache aktiviert" if cache_settings.enabled else "Antwort-Cache deaktiviert"}
+
+
+class RateLimitSettings(BaseModel):
+    user_per_minute: Optional[float] = None
+    user_burst: Optional[int] = None
+    workshop_per_minute: Optional[float] = None
+    workshop_burst: Optional[int] = None
+
+
+@router.post("/workshop/rate-limit")
+async def set_rate_limit(
+    request: Request,
+    limit_settings: RateLimitSettings,
+    db: AsyncSession = Depends(get_db)
+):
+    """Override the AI request rate limits of this workshop (unset fields use the defaults)"""
+    admin_user = require_admin(request)
+    result = await db.execute(
+        select(Workshop).where(Workshop.id == admin_user.workshop_id)
+    )
+    workshop = result.scalar_one_or_none()
+    
+    if not workshop:
+        raise HTTPException(status_code=404, detail="Workshop nicht gefunden")
+    
+    overrides = limit_settings.model_dump(exclude_none=True)
+    # Reassign so the JSON column is marked as changed
+    workshop.settings = {**(workshop.settings or {}), "rate_limit": overrides}
+    await db.commit()
+    session_cache.invalidate_workshop(workshop.id)
+    
+    # Buckets filled under the old limits would otherwise delay the new ones
+    user_ids = (await db.execute(select(User.id).where(User.workshop_id == workshop.id))).scalars().all()
+    llm_rate_limiter.reset_workshop(workshop.id, list(user_ids))
+    
+    return {"message": "Anfragelimits gespeichert", "rate_limit": overrides}
+
+
 @router.get("/export")
 async def export_workshop_data(
     request: Request,
@@ -249,6 +344,7 @@ async def export_workshop_data(
         },
         "users": []
     }
+    await CostTracker(db).load_users([user.id for user in users])
     
     for user in users:
         # Get user's websites
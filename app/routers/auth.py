@@ -9,6 +9,9 @@ import secrets
 from app.database import get_db
 from app.models import User, Workshop, Website, UserRole
 from app.services.project_service import ProjectCreationService
+from app.services.session_cache import session_cache
+from app.services.last_seen import last_seen_tracker
+from app.services import session_tokens
 from app.config import get_settings
 
 router = APIRouter()
@@ -46,9 +49,8 @@ async def get_current_user(request: Request, db: AsyncSession = Depends(get_db))
     if not user:
         raise HTTPException(status_code=401, detail="Ungültige Session")
     
-    # Update last seen
-    user.last_seen = datetime.utcnow()
-    await db.commit()
+    # Update last seen (flushed in bulk in the background)
+    last_seen_tracker.touch(user.id)
     
     return user
 
@@ -114,6 +116,12 @@ async def signup(
         workshop.admin_user_id = user.id
         await db.commit()
     
+    # Signed tokens embed the user id, so they can only be issued now
+    if session_tokens.is_signed_mode():
+        session_token = session_tokens.issue_session_token(user)
+        user.session_token = session_token
+        await db.commit()
+    
     # Create default website
     await ProjectCreationService.create_project(
         db=db,
@@ -166,8 +174,9 @@ async def login(
     if not user or not user.verify_password(login_request.password):
         raise HTTPException(status_code=401, detail="Ungültige Anmeldedaten")
     
-    # Generate new session token
-    session_token = secrets.token_urlsafe(32)
+    # Generate new session token (the old one stops working)
+    session_cache.invalidate_token(user.session_token)
+    session_token = session_tokens.issue_session_token(user)
     user.session_token = session_token
     user.last_seen = datetime.utcnow()
     await db.commit()
@@ -191,8 +200,22 @@ async def login(
 
 
 @router.post("/logout")
-async def logout(response: Response):
+async def logout(request: Request, response: Response, db: AsyncSession = Depends(get_db)):
     """Logout user"""
+    session_token = request.cookies.get("session_token")
+    session_cache.invalidate_token(session_token)
+    
+    # Signed tokens stay valid until they expire unless their generation is revoked
+    claims = None
+    if session_token and session_tokens.is_signed_mode():
+        claims = session_tokens.verify_session_token(session_token)
+    
+    if claims:
+        user = await db.get(User, claims.user_id)
+        if user:
+            session_tokens.revoke_session_tokens(user)
+            await db.commit()
+    
     response.delete_cookie("session_token")
     return {"message": "Erfolgreich abgemeldet"}
 
@@ -300,6 +323,12 @@ async def join_workshop(
         workshop.admin_user_id = user.id
         await db.commit()
     
+    # Signed tokens embed the user id, so they can only be issued now
+    if session_tokens.is_signed_mode():
+        session_token = session_tokens.issue_session_token(user)
+        user.session_token = session_token
+        await db.commit()
+    
     # Create default website
     await ProjectCreationService.create_project(
         db=db,
@@ -1,15 +1,19 @@
 import json
+import math
 import asyncio
 import logging
-from typing import Dict, Set, Optional
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
+from typing import Dict, List, Set, Optional
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from sqlalchemy.orm import selectinload
 
-from app.database import get_db
-from app.models import User, Website, ChatMessage, MessageRole, ChangeType, CodeHistory
-from app.services import AzureAIService, CostTracker, CodeProcessor
+from app.database import async_session_maker
+from app.models import User, Website, Workshop, LLMCall, ResponseType, ChatMessage, MessageRole, ChangeType, CodeHistory
+from app.services import AzureAIService, CostTracker, CodeProcessor, get_ai_service, cost_ledger
+from app.services.rate_limiter import llm_rate_limiter
+from app.services.llm_budget import BudgetExceededError, RequestBudget
+from app.middleware.auth import load_session_user
 from app.config import get_settings
 
 router = APIRouter()
@@ -100,39 +104,157 @@ class GalleryUpdateManager:
 gallery_manager = GalleryUpdateManager()
 
 
+class ConnectionDispatcher:
+    """Process inbound messages of one WebSocket connection concurrently
+    
+    Messages are queued into lanes keyed by (kind, project_id): edits to the
+    same project keep their order, AI requests of the same project keep their
+    order, and neither blocks the other or the receive loop.
+    
+    Lanes run concurrently, so the dispatcher only keeps the user's id; every
+    message loads its own User into its own session.
+    """
+    
+    def __init__(self, user_id: int, azure_ai: AzureAIService):
+        self.user_id = user_id
+        self.azure_ai = azure_ai
+        self.lanes: Dict[tuple, asyncio.Queue] = {}
+        self.workers: Dict[tuple, asyncio.Task] = {}
+        self.ai_tasks: Dict[Optional[int], asyncio.Task] = {}  # project_id -> in-flight AI request
+        
+    def dispatch(self, message: dict):
+        kind = "ai" if message.get("type") == "ai_request" else "edit"
+        key = (kind, message.get("project_id"))
+        
+        lane = self.lanes.setdefault(key, asyncio.Queue())
+        lane.put_nowait(message)
+        
+        worker = self.workers.get(key)
+        if not worker or worker.done():
+            self.workers[key] = asyncio.create_task(self._run_lane(key))
+            
+    async def _run_lane(self, key: tuple):
+        lane = self.lanes[key]
+        # The lane ends as soon as it is drained; dispatch() starts a new one on demand
+        while not lane.empty():
+            message = lane.get_nowait()
+            try:
+                if key[0] == "ai":
+                    await self._run_ai_request(message)
+                else:
+                    await self._handle_message(message)
+            except Exception as e:
+                logger.error(f"WebSocket message error for user {self.user_id}: {e}")
+        del self.workers[key]
+        del self.lanes[key]
+        
+    async def _run_ai_request(self, message: dict):
+        # Run as its own task so cancel_ai_request can abort just this request
+        project_id = message.get("project_id")
+        task = asyncio.create_task(self._handle_message(message))
+        self.ai_tasks[project_id] = task
+        try:
+            await asyncio.wait({task})
+        finally:
+            if self.ai_tasks.get(project_id) is task:
+                del self.ai_tasks[project_id]
+        
+        if task.cancelled():
+            await manager.send_personal_message({
+                "type": "ai_request_cancelled",
+                "project_id": project_id
+            }, self.user_id)
+        elif task.exception():
+            raise task.exception()
+        
+    async def _handle_message(self, message: dict):
+        message_type = message.get("type")
+        
+        if message_type == "ai_request":
+            # Opens its own sessions, none of them held during the LLM call
+            await handle_ai_request(message, self.user_id, self.azure_ai)
+            return
+        
+        # Each message is its own unit of work, so idle sockets hold no
+        # connection and the identity map does not grow over the day
+        async with async_session_maker() as db:
+            # A copy per session: one instance must never be attached to two sessions
+            user = await db.get(User, self.user_id)
+            if not user:
+                return
+            
+            if message_type == "code_update":
+                await handle_code_update(
+                    message, user, db
+                )
+                
+            elif message_type == "toggle_like":
+                await handle_toggle_like(
+                    message, user, db
+                )
+                
+            elif message_type == "switch_project":
+                await handle_switch_project(
+                    message, user, db
+                )
+                
+            elif message_type == "create_project":
+                await handle_create_project(
+                    message, user, db
+                )
+                
+            elif message_type == "toggle_project_public":
+                await handle_toggle_project_public(
+                    message, user, db
+                )
+                
+    def cancel_ai_requests(self, project_id: Optional[int] = None):
+        """Cancel in-flight AI requests (of one project, or all); aborts the upstream HTTP call"""
+        for task_project_id, task in list(self.ai_tasks.items()):
+            if project_id is None or task_project_id == project_id:
+                task.cancel()
+                
+    async def close(self):
+        """Stop all work of a disconnected socket so nobody pays for unread answers"""
+        tasks = list(self.ai_tasks.values()) + list(self.workers.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 async def get_user_from_token(session_token: str, db: AsyncSession) -> Optional[User]:
-    """Get user from session token"""
-    result = await db.execute(
-        select(User)
-        .options(selectinload(User.workshop))
-        .where(User.session_token == session_token)
-    )
-    return result.scalar_one_or_none()
+    """Get user from session token (claims and session cache first, like HTTP requests)"""
+    try:
+        return await load_session_user(session_token, db)
+    except Exception as e:
+        logger.error(f"WebSocket authentication error: {e}")
+        return None
 
 
 @router.websocket("/ws/{session_token}")
 async def websocket_endpoint(
     websocket: WebSocket, 
-    session_token: str,
-    db: AsyncSession = Depends(get_db)
+    session_token: str
 ):
     """WebSocket endpoint for real-time communication"""
-    user = await get_user_from_token(session_token, db)
-    if not user:
-        await websocket.close(code=4001)
-        return
+    # Short-lived session for the handshake; the socket itself holds no connection
+    async with async_session_maker() as db:
+        user = await get_user_from_token(session_token, db)
+        if not user:
+            await websocket.close(code=4001)
+            return
+        
+        # Get user's projects to send current state
+        result = await db.execute(
+            select(Website)
+            .options(selectinload(Website.user))
+            .where(Website.user_id == user.id)
+            .order_by(Website.updated_at.desc())
+        )
+        projects = result.scalars().all()
     
     await manager.connect(websocket, user.id, session_token)
     
-    # Get user's projects to send current state
-    result = await db.execute(
-        select(Website)
-        .options(selectinload(Website.user))
-        .where(Website.user_id == user.id)
-        .order_by(Website.updated_at.desc())
-    )
-    projects = result.scalars().all()
-    
     # Send welcome message with projects list
     welcome_message = {
         "type": "connection_status", 
@@ -167,8 +289,8 @@ async def websocket_endpoint(
     
     await manager.send_personal_message(welcome_message, user.id)
     
-    azure_ai = AzureAIService()
-    cost_tracker = CostTracker(db)
+    azure_ai = get_ai_service()
+    dispatcher = ConnectionDispatcher(user.id, azure_ai)
     
     try:
         while True:
@@ -180,90 +302,151 @@ async def websocket_endpoint(
             if message_type == "ping":
                 await manager.send_personal_message({"type": "pong"}, user.id)
                 
-            elif message_type == "ai_request":
-                await handle_ai_request(
-                    message, user, db, azure_ai, cost_tracker
-                )
-                
-            elif message_type == "code_update":
-                await handle_code_update(
-                    message, user, db
-                )
-                
-            elif message_type == "toggle_like":
-                await handle_toggle_like(
-                    message, user, db
-                )
-                
-            elif message_type == "switch_project":
-                await handle_switch_project(
-                    message, user, db
-                )
+            elif message_type == "cancel_ai_request":
+                dispatcher.cancel_ai_requests(message.get("project_id"))
                 
-            elif message_type == "create_project":
-                await handle_create_project(
-                    message, user, db
-                )
-                
-            elif message_type == "toggle_project_public":
-                await handle_toggle_project_public(
-                    message, user, db
-                )
+            else:
+                dispatcher.dispatch(message)
                 
     except WebSocketDisconnect:
         manager.disconnect(user.id)
     except Exception as e:
         logger.error(f"WebSocket error for user {user.id}: {e}")
         manager.disconnect(user.id)
+    finally:
+        await dispatcher.close()
+
+
+async def get_workshop_settings(user: User, db: AsyncSession) -> dict:
+    """Settings JSON of the user's workshop, read fresh so admin changes apply to the next request"""
+    if not user.workshop_id:
+        return {}
+    result = await db.execute(select(Workshop.settings).where(Workshop.id == user.workshop_id))
+    return result.scalar_one_or_none() or {}
+
+
+async def get_recent_edits(website_id: int, db: AsyncSession, limit: int = 2) -> List[str]:
+    """new_str of the last AI edits of a project, so follow-up requests see the code they touched"""
+    result = await db.execute(
+        select(LLMCall.response_data)
+        .where(LLMCall.website_id == website_id)
+        .where(LLMCall.response_type.in_([ResponseType.UPDATE, ResponseType.UPDATE_ALL]))
+        .order_by(LLMCall.created_at.desc())
+        .limit(limit)
+    )
+    return [
+        update.get("new_str", "")
+        for response_data in result.scalars()
+        for update in (response_data or {}).get("updates") or []
+    ]
+
+
+class StreamedCodePreview:
+    """Push edits of a streaming AI response to the preview before they are saved"""
+    
+    def __init__(self, user_id: int, project_id: int, code: Dict[str, str]):
+        self.user_id = user_id
+        self.project_id = project_id
+        self.code = dict(code)
+        self.sent = False
+        
+    async def apply(self, edit: dict):
+        """Apply one completed updates[] item or new_code file to the preview"""
+        response_type = edit.get("response_type")
+        
+        if "update" in edit:
+            if response_type not in ("update", "update_all"):
+                return
+            update = edit["update"]
+            # Ambiguous single updates may still need disambiguation
+            if response_type == "update" and len(
+                AzureAIService.find_multiple_matches(update.get("old_str", ""), self.code)
+            ) > 1:
+                return
+            candidate = CodeProcessor.apply_updates(
+                self.code, [update], apply_all=(response_type == "update_all")
+            )
+        else:
+            if response_type != "rewrite" or edit.get("file") not in self.code:
+                return
+            candidate = {**self.code, edit["file"]: edit["content"]}
+        
+        # Unsafe code is only shown after sanitizing in process_code_changes
+        is_valid, _ = CodeProcessor.validate_code(candidate)
+        if not is_valid:
+            return
+        
+        self.code = candidate
+        self.sent = True
+        await manager.send_personal_message({
+            "type": "code_update",
+            "project_id": self.project_id,
+            "code": self.code,
+            "changeType": response_type,
+            "preview": True
+        }, self.user_id)
+        
+    async def reset(self, code: Dict[str, str]):
+        """Replace previewed edits that were not saved with the stored code"""
+        if not self.sent:
+            return
+        self.sent = False
+        await manager.send_personal_message({
+            "type": "code_update",
+            "project_id": self.project_id,
+            "code": code,
+            "changeType": "sync"
+        }, self.user_id)
 
 
 async def handle_ai_request(
     message: dict,
-    user: User,
-    db: AsyncSession,
-    azure_ai: AzureAIService,
-    cost_tracker: CostTracker
+    user_id: int,
+    azure_ai: AzureAIService
 ):
-    """Handle AI request from user"""
+    """
+    Handle AI request from user
+    
+    The context is read in one session and the result saved in another; no
+    session is open while the request waits for and talks to the LLM, so
+    waiting requests hold no pooled connection.
+    """
     prompt = message.get("prompt", "")
-    current_code = message.get("currentCode", {})
     project_id = message.get("project_id")
+    reservation = None
     
-    # Check if user can make API call
-    can_call, reason = await cost_tracker.can_make_api_call(user.id)
-    if not can_call:
-        await manager.send_personal_message({
-            "type": "error",
-            "message": reason
-        }, user.id)
-        return
-    
-    # Get the specified project or user's active website
-    if project_id:
-        result = await db.execute(
-            select(Website)
-            .options(selectinload(Website.user))
-            .where(Website.id == project_id)
-            .where(Website.user_id == user.id)
-        )
-        website = result.scalar_one_or_none()
-    else:
-        result = await db.execute(
-            select(Website)
-            .options(selectinload(Website.user))
-            .where(Website.user_id == user.id)
-            .where(Website.is_active == True)
-        )
-        website = result.scalar_one_or_none()
-    
-    if not website:
-        await manager.send_personal_message({
-            "type": "error",
-            "message": "Projekt nicht gefunden"
-        }, user.id)
-        return
-    
-    try:
+    async with async_session_maker() as db:
+        user = await db.get(User, user_id)
+        if not user:
+            return
+        workshop_settings = await get_workshop_settings(user, db)
+        
+        # Token buckets per user and workshop, charged before anything can fail
+        retry_after = llm_rate_limiter.check(user.id, user.workshop_id, workshop_settings)
+        if retry_after:
+            seconds = math.ceil(retry_after)
+            await manager.send_personal_message({
+                "type": "error",
+                "message": f"Zu viele Anfragen, bitte warte {seconds} Sekunde{'' if seconds == 1 else 'n'}",
+                "retry_after": round(retry_after, 1)
+            }, user.id)
+            return
+        
+        # Get the specified project or user's active website
+        query = select(Website).where(Website.user_id == user.id)
+        if project_id:
+            query = query.where(Website.id == project_id)
+        else:
+            query = query.where(Website.is_active == True)
+        website = (await db.execute(query)).scalar_one_or_none()
+        
+        if not website:
+            await manager.send_personal_message({
+                "type": "error",
+                "message": "Projekt nicht gefunden"
+            }, user.id)
+            return
+        
         # Ensure we use the most current code from the database
         # The frontend might have stale data
         actual_current_code = {
@@ -271,8 +454,6 @@ async def handle_ai_request(
             "css": website.css,
             "js": website.js
         }
-        
-        # Log for debugging
         logger.info(f"Using current code from database for AI - HTML preview: {actual_current_code['html'][:100]}...")
         
         # Get user's images for AI context
@@ -284,7 +465,43 @@ async def handle_ai_request(
         )
         
         # Get user's learned concepts
-        user_learned_concepts = user.learned_concepts or []
+        user_learned_concepts = list(user.learned_concepts or [])
+        recent_edits = await get_recent_edits(website.id, db)
+        
+        # Check limits and hold the worst-case cost until the real one is recorded
+        call_cost = azure_ai.estimate_cost(
+            prompt, actual_current_code, "code_generation",
+            user_images=user_images, learned_concepts=user_learned_concepts
+        )
+        reservation, reason = await CostTracker(db).reserve_api_call(user.id, call_cost)
+        if not reservation:
+            await manager.send_personal_message({
+                "type": "error",
+                "message": reason
+            }, user.id)
+            return
+    
+    # User and website stay usable detached: nothing was committed, so nothing expired
+    preview = StreamedCodePreview(user.id, website.id, actual_current_code)
+    # Extends the reservation for further calls and keeps their usage if the request fails
+    budget = RequestBudget(reservation, call_cost)
+    
+    try:
+        # Forward chat_message text as it is generated
+        async def send_chat_delta(delta: str):
+            await manager.send_personal_message({
+                "type": "chat_delta",
+                "project_id": website.id,
+                "content": delta
+            }, user.id)
+        
+        # Tell the user where they are while the AI is busy with others
+        async def send_queue_position(position: int):
+            await manager.send_personal_message({
+                "type": "ai_queue_position",
+                "project_id": website.id,
+                "position": position
+            }, user.id)
         
         # Generate AI response
         llm_response, response_data = await azure_ai.generate_response(
@@ -292,17 +509,27 @@ async def handle_ai_request(
             current_code=actual_current_code,
             context="code_generation",
             user_images=user_images,
-            learned_concepts=user_learned_concepts
+            learned_concepts=user_learned_concepts,
+            on_chat_delta=send_chat_delta,
+            on_code_edit=preview.apply,
+            user_id=user.id,
+            workshop_id=user.workshop_id,
+            on_queue_position=send_queue_position,
+            # Workshops opt out of cached AI responses with settings {"response_cache": false}
+            use_cache=workshop_settings.get("response_cache", True),
+            recent_edits=recent_edits,
+            budget=budget
         )
         
         # Calculate cost
         cost = azure_ai.calculate_cost(
             llm_response.prompt_tokens,
-            llm_response.completion_tokens
+            llm_response.completion_tokens,
+            llm_response.endpoint,
+            llm_response.cached_tokens
         )
         
         # Record API call - ensure response_type is proper enum value
-        from app.models.llm import ResponseType
         response_type_str = response_data["response_type"].lower()
         
         # Convert to enum to ensure it's valid
@@ -312,34 +539,41 @@ async def handle_ai_request(
         except ValueError:
             logger.error(f"Invalid response_type: {response_type_str}, falling back to chat")
             response_type = ResponseType.CHAT
-        await cost_tracker.record_api_call(
-            user_id=user.id,
-            website_id=website.id,
-            prompt=prompt,
-            response_type=response_type.value,  # Use .value to get the string value
-            response_data=response_data,
-            prompt_tokens=llm_response.prompt_tokens,
-            completion_tokens=llm_response.completion_tokens,
-            cost=cost,
-            duration_ms=0  # Add timing if needed
-        )
         
-        # Update learned concepts if new ones were introduced
-        if "new_concepts" in response_data and response_data["new_concepts"]:
-            new_concepts = response_data["new_concepts"]
-            updated_concepts = list(set(user_learned_concepts + new_concepts))
-            
-            # Update user's learned concepts in database
-            from sqlalchemy import update
-            from app.models.user import User
-            await db.execute(
-                update(User)
-                .where(User.id == user.id)
-                .values(learned_concepts=updated_concepts)
+        async with async_session_maker() as db:
+            cost_tracker = CostTracker(db)
+            await cost_tracker.record_api_call(
+                user_id=user.id,
+                website_id=website.id,
+                prompt=prompt,
+                response_type=response_type.value,  # Use .value to get the string value
+                response_data=response_data,
+                prompt_tokens=llm_response.prompt_tokens,
+                completion_tokens=llm_response.completion_tokens,
+                cost=cost,
+                timing=llm_response.timing,
+                model=llm_response.model,
+                cache_hit=llm_response.cached,
+                prompt_breakdown=llm_response.prompt_breakdown,
+                cached_tokens=llm_response.cached_tokens,
+                reservation=reservation
             )
-            await db.commit()
             
-            logger.info(f"Updated learned concepts for user {user.id}: added {new_concepts}")
+            # Update learned concepts if new ones were introduced
+            if "new_concepts" in response_data and response_data["new_concepts"]:
+                new_concepts = response_data["new_concepts"]
+                updated_concepts = list(set(user_learned_concepts + new_concepts))
+                
+                # Update user's learned concepts in database
+                from sqlalchemy import update
+                await db.execute(
+                    update(User)
+                    .where(User.id == user.id)
+                    .values(learned_concepts=updated_concepts)
+                )
+                await db.commit()
+                
+                logger.info(f"Updated learned concepts for user {user.id}: added {new_concepts}")
         
         # Send chat message
         await manager.send_personal_message({
@@ -353,19 +587,26 @@ async def handle_ai_request(
             # Check for ambiguous updates that need disambiguation
             if response_data["response_type"].lower() == "update" and response_data.get("updates"):
                 needs_disambiguation = await check_for_disambiguation_needed(
-                    response_data, actual_current_code, user, db, azure_ai, cost_tracker, prompt
+                    response_data, actual_current_code, user, website, azure_ai, prompt
                 )
                 if needs_disambiguation:
+                    # Previewed edits only stand if the clarification saved them
+                    async with async_session_maker() as db:
+                        saved = await db.get(Website, website.id)
+                        if saved:
+                            await preview.reset({"html": saved.html, "css": saved.css, "js": saved.js})
                     return  # Disambiguation request sent, don't process original request
             
-            # Refresh website object to ensure it's attached to the session
-            await db.refresh(website)
-            await process_code_changes(
-                response_data, website, user, db
-            )
+            async with async_session_maker() as db:
+                # Lock the row so concurrent code_updates of this project
+                # cannot interleave with applying the AI changes
+                locked = await db.get(Website, website.id, with_for_update=True)
+                if locked:
+                    await process_code_changes(response_data, locked, user, db)
         
         # Send cost update
-        stats = await cost_tracker.get_user_stats(user.id)
+        async with async_session_maker() as db:
+            stats = await CostTracker(db).get_user_stats(user.id)
         await manager.send_personal_message({
             "type": "cost_update",
             "totalCost": stats["total_cost"],
@@ -373,30 +614,78 @@ async def handle_ai_request(
             "costPercentage": stats["cost_percentage"]
         }, user.id)
         
+    except asyncio.CancelledError:
+        await preview.reset(actual_current_code)
+        if reservation.active:
+            # Not recorded yet
+            await record_failed_request(user.id, website.id, prompt, budget, azure_ai, "Abgebrochen")
+        raise
+    except BudgetExceededError as e:
+        await preview.reset(actual_current_code)
+        await record_failed_request(user.id, website.id, prompt, budget, azure_ai, str(e))
+        await manager.send_personal_message({
+            "type": "error",
+            "message": "Dein Restbudget reicht nicht, um die Anfrage fertigzustellen"
+        }, user.id)
     except Exception as e:
-        await db.rollback()  # Rollback transaction on error
+        await preview.reset(actual_current_code)
         logger.error(f"AI request error for user {user.id}: {e}")
+        if reservation.active:
+            # Not recorded yet
+            await record_failed_request(user.id, website.id, prompt, budget, azure_ai, str(e))
         await manager.send_personal_message({
             "type": "error",
             "message": "Fehler bei der KI-Anfrage"
         }, user.id)
+    finally:
+        cost_ledger.release(reservation)
+
+
+async def record_failed_request(
+    user_id: int,
+    website_id: int,
+    prompt: str,
+    budget: RequestBudget,
+    azure_ai: AzureAIService,
+    error_message: str
+):
+    """Charge the calls of a failed or cancelled AI request (the provider bills them anyway)"""
+    usage = budget.usage
+    if not usage.total_tokens:
+        return
+    async with async_session_maker() as db:
+        await CostTracker(db).record_api_call(
+            user_id=user_id,
+            website_id=website_id,
+            prompt=prompt,
+            response_type=ResponseType.CHAT.value,
+            response_data={},
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            cost=azure_ai.calculate_cost(usage.prompt_tokens, usage.completion_tokens,
+                                         cached_tokens=usage.cached_tokens),
+            error_message=error_message,
+            model=budget.model,
+            cached_tokens=usage.cached_tokens,
+            reservation=budget.reservation
+        )
 
 
 async def check_for_disambiguation_needed(
     response_data: dict,
     current_code: Dict[str, str],
     user: User,
-    db: AsyncSession,
+    website: Website,
     azure_ai: AzureAIService,
-    cost_tracker: CostTracker,
     original_prompt: str
 ) -> bool:
-    """Check if disambiguation is needed for update operations"""
+    """Check if disambiguation is needed for update operations (sessions only around DB work)"""
     updates = response_data.get("updates", [])
     
     for update in updates:
         old_str = update.get("old_str", "")
-        if not old_str:
+        if not old_str or update.get("offset") is not None:
+            # Pinned to the occurrence the AI saw in sliced code
             continue
             
         # Find all matches for this old_str
@@ -407,60 +696,72 @@ async def check_for_disambiguation_needed(
             logger.info(f"Found {len(matches)} matches for '{old_str}', requesting disambiguation")
             
             # Check if user can make another API call
-            can_call, reason = await cost_tracker.can_make_api_call(user.id)
-            if not can_call:
+            disambiguation_prompt = f"Disambiguation for: {original_prompt}"
+            call_cost = azure_ai.estimate_cost(disambiguation_prompt, current_code)
+            async with async_session_maker() as db:
+                reservation, reason = await CostTracker(db).reserve_api_call(user.id, call_cost)
+            if not reservation:
                 await manager.send_personal_message({
                     "type": "error",
                     "message": f"Mehrere Treffer gefunden, aber {reason}"
                 }, user.id)
                 return True  # Stop processing
+            budget = RequestBudget(reservation, call_cost)
                 
             try:
                 # Ask LLM for clarification
-                website = await get_user_active_website(user, db)
-                if not website:
-                    return False
-                    
                 llm_response, clarification_data = await azure_ai.disambiguate_multiple_matches(
                     original_request=original_prompt,
                     old_str=old_str,
                     matches=matches,
-                    current_code=current_code
+                    current_code=current_code,
+                    user_id=user.id,
+                    workshop_id=user.workshop_id,
+                    budget=budget
                 )
                 
                 # Calculate cost for disambiguation call
                 cost = azure_ai.calculate_cost(
                     llm_response.prompt_tokens,
-                    llm_response.completion_tokens
-                )
-                
-                # Record the disambiguation API call
-                from app.models.llm import ResponseType
-                await cost_tracker.record_api_call(
-                    user_id=user.id,
-                    website_id=website.id,
-                    prompt=f"Disambiguation for: {original_prompt}",
-                    response_type=ResponseType.CHAT,  # Disambiguation is always chat first
-                    response_data=clarification_data,
-                    prompt_tokens=llm_response.prompt_tokens,
-                    completion_tokens=llm_response.completion_tokens,
-                    cost=cost,
-                    duration_ms=0
+                    llm_response.completion_tokens,
+                    llm_response.endpoint,
+                    llm_response.cached_tokens
                 )
                 
-                # Send clarification message
-                await manager.send_personal_message({
-                    "type": "chat_message",
-                    "role": "assistant",
-                    "content": llm_response.content
-                }, user.id)
-                
-                # Process the clarification response
-                if clarification_data["response_type"].lower() in ["update", "update_all", "rewrite"]:
-                    await process_code_changes(clarification_data, website, user, db)
-                
-                # Send cost update
-                stats = await cost_tracker.get_user_stats(user.id)
+                async with async_session_maker() as db:
+                    cost_tracker = CostTracker(db)
+                    # Record the disambiguation API call
+                    await cost_tracker.record_api_call(
+                        user_id=user.id,
+                        website_id=website.id,
+                        prompt=disambiguation_prompt,
+                        response_type=ResponseType.CHAT,  # Disambiguation is always chat first
+                        response_data=clarification_data,
+                        prompt_tokens=llm_response.prompt_tokens,
+                        completion_tokens=llm_response.completion_tokens,
+                        cost=cost,
+                        timing=llm_response.timing,
+                        model=llm_response.model,
+                        prompt_breakdown=llm_response.prompt_breakdown,
+                        cached_tokens=llm_response.cached_tokens,
+                        reservation=reservation
+                    )
+                    
+                    # Send clarification message
+                    await manager.send_personal_message({
+                        "type": "chat_message",
+                        "role": "assistant",
+                        "content": llm_response.content
+                    }, user.id)
+                    
+                    # Process the clarification response
+                    if clarification_data["response_type"].lower() in ["update", "update_all", "rewrite"]:
+                        locked = await db.get(Website, website.id, with_for_update=True)
+                        if locked:
+                            await process_code_changes(clarification_data, locked, user, db)
+                    
+                    # Send cost update
+                    stats = await cost_tracker.get_user_stats(user.id)
                 await manager.send_personal_message({
                     "type": "cost_update",
                     "totalCost": stats["total_cost"],
@@ -470,13 +771,21 @@ async def check_for_disambiguation_needed(
                 
                 return True  # Disambiguation handled
                 
+            except asyncio.CancelledError:
+                if reservation.active:
+                    await record_failed_request(user.id, website.id, disambiguation_prompt, budget, azure_ai, "Abgebrochen")
+                raise
             except Exception as e:
                 logger.error(f"Disambiguation error: {e}")
+                if reservation.active:
+                    await record_failed_request(user.id, website.id, disambiguation_prompt, budget, azure_ai, str(e))
                 await manager.send_personal_message({
                     "type": "error",
                     "message": "Fehler bei der Klärung der Änderung"
                 }, user.id)
                 return True  # Stop processing
+            finally:
+                cost_ledger.release(reservation)
     
     return False  # No disambiguation needed
 
@@ -95,6 +95,7 @@ async def get_workshop_users(
     users = result.scalars().all()
     
     cost_tracker = CostTracker(db)
+    await cost_tracker.load_users([user.id for user in users])
     user_list = []
     
     for user in users:
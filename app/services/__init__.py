@@ -1,19 +1,36 @@
-from .azure_ai import AzureAIService, LLMResponse
+from .azure_ai import AzureAIService, LLMResponse, get_ai_service, close_ai_service
 from .code_processor import CodeProcessor
 from .cost_tracker import CostTracker
 from .image_service import ImageService
 from .image_validator import ImageSecurityValidator, ImageSecurityError
-from .rate_limiter import image_rate_limiter
+from .rate_limiter import image_rate_limiter, llm_rate_limiter
+from .session_cache import session_cache
+from .last_seen import last_seen_tracker
+from .cost_ledger import cost_ledger
+from .llm_call_writer import llm_call_writer
+from .llm_scheduler import llm_scheduler
+from .llm_telemetry import llm_telemetry
+from .response_cache import response_cache
 from .template_service import TemplateService
 
 __all__ = [
     "AzureAIService", 
     "LLMResponse", 
+    "get_ai_service",
+    "close_ai_service",
     "CodeProcessor", 
     "CostTracker",
     "ImageService",
     "ImageSecurityValidator",
     "ImageSecurityError",
     "image_rate_limiter",
+    "llm_rate_limiter",
+    "session_cache",
+    "last_seen_tracker",
+    "cost_ledger",
+    "llm_call_writer",
+    "llm_scheduler",
+    "llm_telemetry",
+    "response_cache",
     "TemplateService"
 ]
\ No newline at end of file
@@ -1,18 +1,26 @@
 import json
+import asyncio
 import logging
 import time
 import re
-from typing import Dict, Any, Optional, NamedTuple, List
-from openai import AsyncAzureOpenAI
-from openai.types.chat import (
-    ChatCompletionMessageParam,
-    ChatCompletionNamedToolChoiceParam,
-    ChatCompletionToolParam,
-    ChatCompletionSystemMessageParam,
-    ChatCompletionUserMessageParam
+from typing import Awaitable, Callable, Dict, Any, Optional, NamedTuple, List, Tuple
+import aiohttp
+import httpx
+from app.services.llm_stream import (
+    ChatDeltaCallback,
+    CodeEditCallback,
+    ToolCallStream,
+    estimate_usage,
+    recover_tool_arguments
 )
-from azure.ai.inference import ChatCompletionsClient
-from azure.core.credentials import AzureKeyCredential
+from app.services.llm_prompt import LLMRequest, build_system_prompt, build_website_request, estimate_prompt_tokens
+from app.services.code_context import locate_in_slice
+from app.services.llm_budget import RequestBudget
+from app.services.llm_providers import PROVIDERS
+from app.services.llm_scheduler import QueuePositionCallback, llm_scheduler
+from app.services.llm_telemetry import CallTiming, llm_telemetry
+from app.services.llm_endpoints import EndpointRouter, LLMEndpoint, is_failover_error
+from app.services.response_cache import response_cache
 from app.config import get_settings
 
 logger = logging.getLogger(__name__)
@@ -26,42 +34,46 @@ class LLMResponse(NamedTuple):
     completion_tokens: int
     total_tokens: int
     model: str = "gpt-4.1-mini"
+    endpoint: str = ""  # Name of the deployment that answered
+    cached: bool = False  # Replayed from the response cache, no tokens used
+    prompt_breakdown: Optional[Dict[str, Any]] = None  # Prompt tokens per section
+    cached_tokens: int = 0  # Prompt tokens read from the provider's prompt cache
+    timing: Optional[CallTiming] = None  # Queue wait, time to first token, duration and retries
+
+    def add_usage(self, earlier: "LLMResponse") -> "LLMResponse":
+        """This response with the tokens of an earlier, discarded completion added (both are billed)"""
+        return self._replace(
+            prompt_tokens=earlier.prompt_tokens + self.prompt_tokens,
+            completion_tokens=earlier.completion_tokens + self.completion_tokens,
+            total_tokens=earlier.total_tokens + self.total_tokens,
+            cached_tokens=earlier.cached_tokens + self.cached_tokens
+        )
 
 
-class AzureAIService:
-    """Azure AI service supporting both OpenAI and AI Inference endpoints"""
+CODE_RESPONSE_TYPES = ("update", "update_all", "rewrite")
 
-    def __init__(self):
-        self.settings = settings
-        self.endpoint_type = self._determine_endpoint_type(settings.azure_openai_endpoint)
-        logger.info(f"Detected Azure endpoint type: {self.endpoint_type}")
-
-        # Initialize appropriate client based on endpoint type
-        if self.endpoint_type == "openai":
-            self.openai_client = AsyncAzureOpenAI(
-                api_key=settings.azure_openai_api_key,
-                api_version=settings.azure_openai_api_version,
-                azure_endpoint=settings.azure_openai_endpoint
-            )
-            self.chat_client = None
-        elif self.endpoint_type == "ai-inference":
-            self.openai_client = None
-            self.chat_client = ChatCompletionsClient(
-                endpoint=settings.azure_openai_endpoint,
-                credential=AzureKeyCredential(settings.azure_openai_api_key),
-                api_version=settings.azure_openai_api_version
-            )
-        else:
-            raise ValueError(f"Unsupported endpoint type: {self.endpoint_type}")
+# Appended to the prompt when a response was cut off before any usable code change
+TRUNCATED_FOLLOW_UP_HINT = """
+
+WICHTIG: Deine letzte Antwort auf diese Anfrage war zu lang und wurde abgeschnitten.
+Antworte kürzer: nutze "update" mit kleinen, gezielten Änderungen statt "rewrite"."""
+
+TRUNCATED_FALLBACK_MESSAGE = (
+    "Meine Antwort war leider zu lang und wurde abgeschnitten. "
+    "Versuche es bitte mit einer kleineren Änderung."
+)
 
-        # System prompts for different contexts
-        self.system_prompts = {
-            "workshop": """Du bist ein KI-Assistent, der Jugendlichen hilft, ihre eigene Website zu erstellen.
+TRUNCATED_UPDATES_NOTE = "\n\n(Hinweis: Ein Teil meiner Änderungen wurde abgeschnitten und nicht übernommen.)"
+
+
+# System prompts for different contexts (built once per process)
+SYSTEM_PROMPTS = {
+    "workshop": """Du bist ein KI-Assistent, der Jugendlichen hilft, ihre eigene Website zu erstellen.
 Verwende einfache, verständliche Sprache. Erkläre was du tust und warum.
 Fördere Kreativität und Experimentierfreude. Sei geduldig und ermutigend.
 Antworte immer auf Deutsch, es sei denn der Nutzer schreibt in einer anderen Sprache.""",
 
-            "code_generation": """Du bist ein Experte für Webentwicklung und hilfst beim Erstellen von HTML, CSS und JavaScript Code.
+    "code_generation": """Du bist ein Experte für Webentwicklung und hilfst beim Erstellen von HTML, CSS und JavaScript Code.
 
 AUSFÜHRUNGSUMGEBUNG:
 - Code läuft in einem IFRAME mit srcdoc - vollständiger Zugriff auf moderne Web APIs
@@ -145,7 +157,118 @@ Du verwendest: Alpine.js x-show zum ersten Mal
 FOLLOW-UP VORSCHLÄGE:
 Nach jeder Änderung kannst du bis zu 3 passende Verbesserungsvorschläge machen.
 Diese werden als klickbare Buttons angezeigt."""
-        }
+}
+
+# Full system prompts of website requests. Built once, so together with the
+# tool schema they are a byte-identical prefix the provider can cache.
+PROMPT_PREFIXES = {context: build_system_prompt(prompt) for context, prompt in SYSTEM_PROMPTS.items()}
+
+
+class AzureAIService:
+    """AI service sending website requests to a pool of provider endpoints (Azure OpenAI, Azure AI Inference, local, fake)"""
+
+    def __init__(self):
+        self.settings = settings
+        self.endpoints = self._build_endpoints()
+        self.router = EndpointRouter(self.endpoints)
+        logger.info(f"LLM endpoints: {[(e.name, e.endpoint_type, e.model) for e in self.endpoints]}")
+
+        # Providers of all deployments share one keep-alive connection pool per
+        # transport, used by all participants of this process
+        self.http_client = None
+        self.http_session = None
+        for endpoint in self.endpoints:
+            provider_class = PROVIDERS[endpoint.endpoint_type]
+            transport = None
+            if provider_class.transport == "httpx":
+                transport = self._get_http_client()
+            elif provider_class.transport == "aiohttp":
+                transport = self._get_http_session()
+            endpoint.provider = provider_class(endpoint, transport)
+
+        self.system_prompts = PROMPT_PREFIXES
+
+    def _get_http_client(self) -> httpx.AsyncClient:
+        if self.http_client is None:
+            self.http_client = httpx.AsyncClient(
+                http2=settings.llm_http2,
+                limits=httpx.Limits(
+                    max_connections=settings.llm_max_connections,
+                    max_keepalive_connections=settings.llm_max_keepalive_connections,
+                    keepalive_expiry=settings.llm_keepalive_expiry
+                ),
+                timeout=httpx.Timeout(settings.llm_timeout, connect=10.0)
+            )
+        return self.http_client
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        if self.http_session is None:
+            # aiohttp has no HTTP/2 support; keep-alive pooling still applies
+            self.http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=settings.llm_max_connections,
+                    keepalive_timeout=settings.llm_keepalive_expiry
+                ),
+                timeout=aiohttp.ClientTimeout(total=settings.llm_timeout)
+            )
+        return self.http_session
+
+    def _build_endpoints(self) -> List[LLMEndpoint]:
+        """Build the deployment pool from LLM_ENDPOINTS, or the single AZURE_OPENAI_* deployment"""
+        configs = settings.llm_endpoints or [{"name": "default", "endpoint": settings.azure_openai_endpoint}]
+
+        endpoints = []
+        for i, config in enumerate(configs):
+            url = config.get("endpoint", "")
+            endpoint_type = config.get("provider") or self._determine_endpoint_type(url)
+            if endpoint_type not in PROVIDERS:
+                raise ValueError(f"Unsupported endpoint type: {endpoint_type}")
+            default_model = {
+                "ai-inference": settings.azure_model_name,
+                "fake": "fake"
+            }.get(endpoint_type, settings.azure_openai_deployment)
+
+            endpoints.append(LLMEndpoint(
+                name=config.get("name") or f"endpoint-{i + 1}",
+                url=url,
+                api_key=config.get("api_key") or ("" if endpoint_type == "local" else settings.azure_openai_api_key),
+                api_version=config.get("api_version") or settings.azure_openai_api_version,
+                model=config.get("deployment") or config.get("model") or default_model,
+                endpoint_type=endpoint_type,
+                tpm=int(config.get("tpm") or settings.llm_default_tpm),
+                max_tokens=config.get("max_tokens"),
+                options=config
+            ))
+        return endpoints
+
+    async def warm_up(self):
+        """Open keep-alive connections to every deployment so first requests skip TCP+TLS setup"""
+        results = await asyncio.gather(
+            *(
+                endpoint.provider.open_connection()
+                for endpoint in self.endpoints
+                for _ in range(settings.llm_warmup_connections)
+            ),
+            return_exceptions=True
+        )
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            logger.warning(f"LLM connection warm-up failed for {len(failed)} connections: {failed[0]}")
+        else:
+            logger.info(f"Warmed up {len(results)} LLM connections")
+
+    async def close(self):
+        """Close the providers and their shared connection pools"""
+        for endpoint in self.endpoints:
+            await endpoint.provider.close()
+        if self.http_client:
+            await self.http_client.aclose()
+        if self.http_session:
+            await self.http_session.close()
+
+    def get_endpoint_stats(self) -> List[Dict[str, Any]]:
+        """Get latency, error and quota counters of every deployment"""
+        return self.router.get_stats()
 
     def _determine_endpoint_type(self, endpoint: str) -> str:
         """Determine the type of Azure endpoint based on the URL pattern."""
@@ -168,402 +291,256 @@ Diese werden als klickbare Buttons angezeigt."""
             prompt: str,
             current_code: Dict[str, str],
             context: str = "workshop",
-            chat_history: Optional[List[ChatCompletionMessageParam]] = None,
+            chat_history: Optional[List[Dict[str, str]]] = None,
             user_images: Optional[List[Dict[str, Any]]] = None,
-            learned_concepts: Optional[List[str]] = None
+            learned_concepts: Optional[List[str]] = None,
+            on_chat_delta: Optional[ChatDeltaCallback] = None,
+            on_code_edit: Optional[CodeEditCallback] = None,
+            user_id: Optional[int] = None,
+            workshop_id: Optional[int] = None,
+            on_queue_position: Optional[QueuePositionCallback] = None,
+            use_cache: bool = True,
+            recent_edits: Optional[List[str]] = None,
+            budget: Optional[RequestBudget] = None
     ) -> tuple[LLMResponse, Dict[str, Any]]:
-        """Generate AI response for user prompt"""
-        start_time = time.time()
-
-        if self.endpoint_type == "openai":
-            return await self._generate_response_openai(prompt, current_code, context, chat_history, start_time, user_images, learned_concepts)
-        elif self.endpoint_type == "ai-inference":
-            return await self._generate_response_ai_inference(prompt, current_code, context, chat_history, start_time, user_images, learned_concepts)
-        else:
-            raise ValueError(f"Unsupported endpoint type: {self.endpoint_type}")
-
-    async def _generate_response_openai(self, prompt: str, current_code: Dict[str, str],
-                                        context: str, chat_history: Optional[List[ChatCompletionMessageParam]],
-                                        start_time: float, user_images: Optional[List[Dict[str, Any]]] = None,
-                                        learned_concepts: Optional[List[str]] = None) -> tuple[LLMResponse, Dict[str, Any]]:
-        """Generate response using Azure OpenAI SDK"""
-        # Build messages
-        messages: List[ChatCompletionMessageParam] = [
-            ChatCompletionSystemMessageParam(
-                role="system",
-                content=self.system_prompts.get(context, self.system_prompts["workshop"])
+        """
+        Generate AI response for user prompt
+
+        Large code is sent as the fragments relevant to the prompt and to
+        recent_edits (new_str of the last AI edits), plus an outline.
+
+        Identical requests (same normalized prompt, code, experience level
+        and models) are answered from the response cache unless use_cache
+        is False. Other requests wait for the user's turn in the shared LLM
+        scheduler; on_queue_position is told the position while waiting.
+
+        If callbacks are given (and streaming is enabled), the completion is
+        streamed: chat_message text goes to on_chat_delta while it is generated,
+        and every completed updates[] item or new_code file goes to on_code_edit.
+
+        budget extends the caller's reservation before every further call
+        and keeps the usage of all calls, so a failed or cancelled request
+        can still be charged. Calls that failed or were cancelled after
+        streaming are included in the returned usage as estimates.
+        """
+        timing = CallTiming()
+        budget = budget or RequestBudget()
+        if not self.settings.llm_streaming:
+            on_chat_delta = on_code_edit = None
+
+        async def generate(prompt_text: str, on_chat_delta=None, on_code_edit=None):
+            async def attempt():
+                timing.dispatched()
+                return await self._generate(
+                    prompt_text, current_code, context, chat_history, timing, budget, user_images,
+                    learned_concepts, on_chat_delta, on_code_edit, recent_edits
+                )
+
+            return await llm_scheduler.run(
+                attempt,
+                user_id,
+                workshop_id,
+                on_queue_position
             )
-        ]
-
-        # Add chat history if provided
-        if chat_history:
-            messages.extend(chat_history[-5:])  # Last 5 messages for context
-
-        # Add current code context with iframe execution info
-        code_context = f"""
-Aktueller Code der Website (läuft in iframe mit Tailwind + Alpine.js):
-
-HTML:
-```html
-{current_code.get('html', '')}
-```
-
-CSS:
-```css
-{current_code.get('css', '')}
-```
-
-JavaScript:
-```javascript
-{current_code.get('js', '')}
-```
-
-IFRAME-KONTEXT:
-- Vollständiger Zugriff auf Web APIs (localStorage, Canvas, etc.)
-- Alpine.js verfügbar für Navigation (da normale Links nicht funktionieren)
-- Tailwind CSS vollständig geladen
-- Real-time Preview mit sofortiger Aktualisierung
-"""
 
-        # Add learned concepts if available
-        if learned_concepts:
-            code_context += f"\n\nBereits erlernte Konzepte des Nutzers: {', '.join(learned_concepts)}"
-
-        # Add image context if available
-        image_context = ""
-        if user_images:
-            image_context = "\n\nVerfügbare Bilder:\n"
-            for img in user_images:
-                image_context += f"- {img['original_name']} ({img['width']}x{img['height']}) - ID: {img['id']}\n"
-                image_context += f"  URL für HTML-Code: /api/images/public/{img['id']}/data\n"
-                image_context += f"  Alt-Text: {img.get('alt_text', 'Kein Alt-Text')}\n"
-
-        # Add user message with code context
-        messages.append(ChatCompletionUserMessageParam(
-            role="user",
-            content=f"{code_context}{image_context}\n\nNutzer-Anfrage: {prompt}"
-        ))
-
-        # Define response format
-        tools: List[ChatCompletionToolParam] = [{
-            "type": "function",
-            "function": {
-                "name": "process_website_request",
-                "description": "Process user's website modification request",
-                # In azure_ai.py - erweiterte Tool-Definition
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "response_type": {
-                            "type": "string",
-                            "enum": ["chat", "update", "update_all", "rewrite"],
-                            "description": "Type of response: chat (just talk), update (modify one specific instance), update_all (replace all occurrences), rewrite (complete new code)"
-                        },
-                        "chat_message": {
-                            "type": "string",
-                            "description": "Message to show the user"
-                        },
-                        "updates": {
-                            "type": "array",
-                            "items": {
-                                "type": "object",
-                                "properties": {
-                                    "file": {"type": "string", "enum": ["html", "css", "js"]},
-                                    "old_str": {"type": "string"},
-                                    "new_str": {"type": "string"},
-                                    "description": {"type": "string"}
-                                },
-                                "required": ["file", "old_str", "new_str"]
-                            }
-                        },
-                        "new_code": {
-                            "type": "object",
-                            "properties": {
-                                "html": {"type": "string"},
-                                "css": {"type": "string"},
-                                "js": {"type": "string"}
-                            }
-                        },
-                        "explanation": {
-                            "type": "string",
-                            "description": "Technical explanation"
-                        },
-                        "follow_up_suggestions": {
-                            "type": "array",
-                            "maxItems": 3,
-                            "items": {
-                                "type": "object",
-                                "properties": {
-                                    "title": {
-                                        "type": "string",
-                                        "description": "Kurzer Button-Text (max 25 Zeichen)"
-                                    },
-                                    "prompt": {
-                                        "type": "string",
-                                        "description": "Der vollständige Prompt, der gesendet wird"
-                                    },
-                                    "icon": {
-                                        "type": "string",
-                                        "description": "Emoji für den Button"
-                                    }
-                                },
-                                "required": ["title", "prompt", "icon"]
-                            },
-                            "description": "Vorschläge für nächste Schritte"
-                        },
-                        "new_concepts": {
-                            "type": "array",
-                            "items": {"type": "string"},
-                            "description": "Liste neuer Konzepte, die in dieser Antwort eingeführt wurden"
-                        }
-                    },
-                    "required": ["response_type", "chat_message"]
-                }
-            }
-        }]
+        cache_key = None
+        if use_cache and response_cache.enabled:
+            cache_key = response_cache.make_key(
+                prompt, current_code, context, {e.model for e in self.endpoints},
+                learned_concepts, user_images, chat_history
+            )
+            # Identical requests arriving together share one completion
+            cached = response_cache.get(cache_key) or await response_cache.wait_or_claim(cache_key)
+            if cached:
+                model, response_data = cached
+                logger.info(f"Response cache hit: type={response_data['response_type']}")
+                timing.endpoint = "cache"
+                timing.finish()
+                return (
+                    LLMResponse(
+                        content=response_data.get("chat_message", ""),
+                        prompt_tokens=0,
+                        completion_tokens=0,
+                        total_tokens=0,
+                        model=model,
+                        endpoint="cache",
+                        cached=True,
+                        timing=timing
+                    ),
+                    response_data
+                )
 
         try:
-            # Make API call using Azure OpenAI deployment
-            response = await self.openai_client.chat.completions.create(
-                model=self.settings.azure_openai_deployment,
-                messages=messages,
-                tools=tools,
-                tool_choice=ChatCompletionNamedToolChoiceParam(type="function",
-                                                               function={"name": "process_website_request"}),
-                temperature=0.7,
-                max_tokens=2000
-            )
+            llm_response, response_data = await self._generate_with_follow_up(prompt, generate, on_chat_delta, on_code_edit)
+        except BaseException:
+            if cache_key:
+                response_cache.release(cache_key)
+            raise
 
-            # Extract response
-            message = response.choices[0].message
-            tool_call = message.tool_calls[0]
-            
-            # Log the raw arguments for debugging
-            logger.debug(f"Raw tool call arguments: {tool_call.function.arguments}")
-            
-            try:
-                response_data = json.loads(tool_call.function.arguments)
-            except json.JSONDecodeError as json_error:
-                logger.error(f"JSON decode error: {json_error}")
-                logger.error(f"Problematic JSON: {tool_call.function.arguments}")
-                
-                # Try to fix common JSON issues
-                fixed_json = tool_call.function.arguments
-                
-                # Fix unterminated strings by finding the last quote and adding closing quote if needed
-                if fixed_json.count('"') % 2 != 0:
-                    # Odd number of quotes, likely unterminated string
-                    fixed_json = fixed_json + '"'
-                    logger.info("Attempted to fix unterminated string by adding closing quote")
-                
-                # Try to parse the fixed JSON
-                try:
-                    response_data = json.loads(fixed_json)
-                    logger.info("Successfully parsed fixed JSON")
-                except json.JSONDecodeError:
-                    # If still can't parse, return a safe fallback response
-                    logger.error("Could not fix JSON, returning fallback response")
-                    response_data = {
-                        "response_type": "chat_only",
-                        "chat_message": "I apologize, but I encountered an error processing your request. Please try again."
-                    }
-
-            # Get token usage
-            usage = response.usage
-
-            duration_ms = int((time.time() - start_time) * 1000)
-
-            logger.info(f"Azure OpenAI response generated: type={response_data['response_type']}, "
-                        f"tokens={usage.total_tokens}, duration={duration_ms}ms")
+        if cache_key:
+            response_cache.release(cache_key, llm_response.model, response_data)
+
+        if budget.unfinished.total_tokens:
+            # Attempts that broke off mid-stream are billed too
+            unfinished = budget.unfinished
+            llm_response = llm_response.add_usage(LLMResponse(
+                content="",
+                prompt_tokens=unfinished.prompt_tokens,
+                completion_tokens=unfinished.completion_tokens,
+                total_tokens=unfinished.total_tokens,
+                cached_tokens=unfinished.cached_tokens
+            ))
+
+        timing.finish()
+        llm_telemetry.record(llm_response.model, timing, llm_response.completion_tokens)
+        logger.info(f"LLM request finished: model={llm_response.model}, endpoint={timing.endpoint}, "
+                    f"duration={timing.duration_ms}ms, queue_wait={timing.queue_wait_ms}ms, "
+                    f"ttft={timing.ttft_ms}ms, retries={timing.retries}")
+        return llm_response._replace(timing=timing), response_data
+
+    async def _generate_with_follow_up(
+            self,
+            prompt: str,
+            generate: Callable[..., Awaitable[tuple[LLMResponse, Dict[str, Any]]]],
+            on_chat_delta: Optional[ChatDeltaCallback] = None,
+            on_code_edit: Optional[CodeEditCallback] = None
+    ) -> tuple[LLMResponse, Dict[str, Any]]:
+        """Generate a response, asking once more if truncation left nothing usable"""
+        llm_response, response_data = await generate(prompt, on_chat_delta, on_code_edit)
+
+        recovery = response_data.get("recovery")
+        if not recovery or not recovery["needs_follow_up"]:
+            return llm_response, response_data
+
+        # Nothing usable survived the truncation: ask once more for a shorter answer
+        logger.warning(f"Response lost {recovery['lost_fields']}, sending follow-up request")
+        follow_up_response, follow_up_data = await generate(prompt + TRUNCATED_FOLLOW_UP_HINT)
+        if follow_up_data.get("recovery", {}).get("needs_follow_up"):
+            follow_up_data["response_type"] = "chat"
+            follow_up_data["chat_message"] = TRUNCATED_FALLBACK_MESSAGE
+
+        return (
+            follow_up_response.add_usage(llm_response)._replace(content=follow_up_data.get("chat_message", "")),
+            follow_up_data
+        )
 
-            return (
-                LLMResponse(
-                    content=response_data.get('chat_message', ''),
-                    prompt_tokens=usage.prompt_tokens,
-                    completion_tokens=usage.completion_tokens,
-                    total_tokens=usage.total_tokens,
-                    model=self.settings.azure_openai_deployment
-                ),
-                response_data
-            )
+    async def _generate(self, prompt: str, current_code: Dict[str, str], context: str,
+                        chat_history: Optional[List[Dict[str, str]]], timing: CallTiming,
+                        budget: RequestBudget,
+                        user_images: Optional[List[Dict[str, Any]]] = None,
+                        learned_concepts: Optional[List[str]] = None,
+                        on_chat_delta: Optional[ChatDeltaCallback] = None,
+                        on_code_edit: Optional[CodeEditCallback] = None,
+                        recent_edits: Optional[List[str]] = None) -> tuple[LLMResponse, Dict[str, Any]]:
+        """
+        Send one request to a deployment of the pool
+
+        Connection errors, 429s and 5xx fail over to the next deployment,
+        unless streamed output already reached the user. A rewrite answered
+        from sliced code is asked again with the full code.
+        """
+        streamed = False
+
+        async def forward_chat_delta(delta: str):
+            nonlocal streamed
+            streamed = True
+            await on_chat_delta(delta)
+
+        async def forward_code_edit(edit: Dict[str, Any]):
+            nonlocal streamed
+            streamed = True
+            await on_code_edit(edit)
+
+        callbacks = (forward_chat_delta if on_chat_delta else None, forward_code_edit if on_code_edit else None)
+
+        # Prompt and tool are built once, whichever deployment answers
+        system_prompt = self.system_prompts.get(context, self.system_prompts["workshop"])
+        request = build_website_request(
+            system_prompt, prompt, current_code, chat_history, user_images, learned_concepts,
+            recent_edits=recent_edits
+        )
+        discarded: Optional[LLMResponse] = None
+
+        tried: List[str] = []
+        last_error: Optional[Exception] = None
+        while True:
+            endpoint = self.router.choose(exclude=tried)
+            if endpoint is None:
+                if last_error:
+                    raise last_error
+                # Paused deployments: the scheduler retries once the first one reopens
+                raise self.router.unavailable_error()
+            tried.append(endpoint.name)
+
+            budget.before_call()
+            endpoint.start()
+            sent_at = time.monotonic()
+            try:
+                result = await self._complete(endpoint, request, timing, budget, *callbacks)
+            except asyncio.CancelledError:
+                endpoint.probing = False
+                raise
+            except Exception as e:
+                endpoint.record_failure(e, int((time.monotonic() - sent_at) * 1000))
+                timing.retries += 1
+                if streamed or not is_failover_error(e):
+                    raise
+                logger.warning(f"LLM endpoint {endpoint.name} failed ({e}), failing over")
+                last_error = e
+                continue
 
-        except Exception as e:
-            logger.error(f"Error generating Azure OpenAI response: {e}")
-            raise
+            latency_ms = int((time.monotonic() - sent_at) * 1000)
+            endpoint.record_success(latency_ms, result[0].total_tokens)
+            timing.generation_ms += latency_ms
+            timing.endpoint = endpoint.name
+
+            if result[1]["response_type"] == "rewrite" and request.token_breakdown["dropped"]["code_fragments"]:
+                # A rewrite of sliced code would delete everything that was left out
+                logger.warning("Rewrite based on sliced code, asking again with the full code")
+                discarded = result[0]
+                request = build_website_request(
+                    system_prompt, prompt, current_code, chat_history, user_images, learned_concepts,
+                    full_code=True
+                )
+                # The preview is replaced by the final code_update, so nothing more is streamed
+                callbacks = (None, None)
+                streamed = False
+                tried = []
+                continue
 
-    async def _generate_response_ai_inference(self, prompt: str, current_code: Dict[str, str],
-                                              context: str, chat_history: Optional[List[ChatCompletionMessageParam]],
-                                              start_time: float, user_images: Optional[List[Dict[str, Any]]] = None,
-                                              learned_concepts: Optional[List[str]] = None) -> tuple[LLMResponse, Dict[str, Any]]:
-        """Generate response using Azure AI Inference SDK"""
-        from azure.ai.inference.models import SystemMessage, UserMessage, AssistantMessage, ToolMessage
-
-        # Build messages using Azure AI message types
-        messages = [
-            SystemMessage(content=self.system_prompts.get(context, self.system_prompts["workshop"]))
-        ]
-
-        # Add chat history if provided
-        if chat_history:
-            for msg in chat_history[-5:]:  # Last 5 messages for context
-                if msg['role'] == 'user':
-                    messages.append(UserMessage(content=msg['content']))
-                elif msg['role'] == 'assistant':
-                    messages.append(AssistantMessage(content=msg['content']))
-                elif msg['role'] == 'tool':
-                    messages.append(ToolMessage(content=msg['content']))
-
-        # Add current code context with iframe execution info
-        code_context = f"""
-Aktueller Code der Website (läuft in iframe mit Tailwind + Alpine.js):
-
-HTML:
-```html
-{current_code.get('html', '')}
-```
-
-CSS:
-```css
-{current_code.get('css', '')}
-```
-
-JavaScript:
-```javascript
-{current_code.get('js', '')}
-```
-
-IFRAME-KONTEXT:
-- Vollständiger Zugriff auf Web APIs (localStorage, Canvas, etc.)
-- Alpine.js verfügbar für Navigation (da normale Links nicht funktionieren)
-- Tailwind CSS vollständig geladen
-- Real-time Preview mit sofortiger Aktualisierung
-"""
+            if request.visible_code:
+                self._locate_sliced_updates(result[1], current_code, request.visible_code)
 
-        # Add learned concepts if available
-        if learned_concepts:
-            code_context += f"\n\nBereits erlernte Konzepte des Nutzers: {', '.join(learned_concepts)}"
-
-        # Add image context if available
-        image_context = ""
-        if user_images:
-            image_context = "\n\nVerfügbare Bilder:\n"
-            for img in user_images:
-                image_context += f"- {img['original_name']} ({img['width']}x{img['height']}) - ID: {img['id']}\n"
-                image_context += f"  URL für HTML-Code: /api/images/public/{img['id']}/data\n"
-                image_context += f"  Alt-Text: {img.get('alt_text', 'Kein Alt-Text')}\n"
-
-        # Add user message with code context
-        messages.append(UserMessage(content=f"{code_context}{image_context}\n\nNutzer-Anfrage: {prompt}"))
-
-        # Define tools for structured response
-        tools = [{
-            "type": "function",
-            "function": {
-                "name": "process_website_request",
-                "description": "Process user's website modification request",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "response_type": {
-                            "type": "string",
-                            "enum": ["chat", "update", "update_all", "rewrite"],
-                            "description": "Type of response: chat (just talk), update (modify one specific instance), update_all (replace all occurrences), rewrite (complete new code)"
-                        },
-                        "chat_message": {
-                            "type": "string",
-                            "description": "Message to show the user explaining what you're doing"
-                        },
-                        "updates": {
-                            "type": "array",
-                            "items": {
-                                "type": "object",
-                                "properties": {
-                                    "file": {"type": "string", "enum": ["html", "css", "js"]},
-                                    "old_str": {"type": "string"},
-                                    "new_str": {"type": "string"},
-                                    "description": {"type": "string"}
-                                },
-                                "required": ["file", "old_str", "new_str"]
-                            },
-                            "description": "List of code updates to apply"
-                        },
-                        "new_code": {
-                            "type": "object",
-                            "properties": {
-                                "html": {"type": "string"},
-                                "css": {"type": "string"},
-                                "js": {"type": "string"}
-                            },
-                            "description": "Complete new code for rewrite"
-                        },
-                        "explanation": {
-                            "type": "string",
-                            "description": "Technical explanation of changes made"
-                        },
-                        "new_concepts": {
-                            "type": "array",
-                            "items": {"type": "string"},
-                            "description": "Liste neuer Konzepte, die in dieser Antwort eingeführt wurden"
-                        }
-                    },
-                    "required": ["response_type", "chat_message"]
-                }
-            }
-        }]
+            if discarded:
+                return result[0].add_usage(discarded), result[1]
+            return result
 
+    async def _complete(self, endpoint: LLMEndpoint, request: LLMRequest, timing: CallTiming,
+                        budget: RequestBudget,
+                        on_chat_delta: Optional[ChatDeltaCallback] = None,
+                        on_code_edit: Optional[CodeEditCallback] = None) -> tuple[LLMResponse, Dict[str, Any]]:
+        """Send a request through the endpoint's provider and parse the tool call"""
         try:
-            # Make API call using Azure AI Inference with model name
-            # Note: DeepSeek only supports "auto", "required", or "none" for tool_choice
-            response = self.chat_client.complete(
-                model=self.settings.azure_model_name,
-                messages=messages,
-                tools=tools,
-                tool_choice="required",  # Force tool use since we need structured output
-                temperature=0.7,
-                max_tokens=5000
-            )
-
-            # Extract response
-            message = response.choices[0].message
-            tool_call = message.tool_calls[0]
-            
-            # Log the raw arguments for debugging
-            logger.debug(f"Raw tool call arguments: {tool_call.function.arguments}")
-            
+            # Stream and forward chat_message and finished edits while the rest is generated
+            stream = ToolCallStream(on_chat_delta, on_code_edit) if on_chat_delta or on_code_edit else None
             try:
-                response_data = json.loads(tool_call.function.arguments)
-            except json.JSONDecodeError as json_error:
-                logger.error(f"JSON decode error: {json_error}")
-                logger.error(f"Problematic JSON: {tool_call.function.arguments}")
-                
-                # Try to fix common JSON issues
-                fixed_json = tool_call.function.arguments
-                
-                # Fix unterminated strings by finding the last quote and adding closing quote if needed
-                if fixed_json.count('"') % 2 != 0:
-                    # Odd number of quotes, likely unterminated string
-                    fixed_json = fixed_json + '"'
-                    logger.info("Attempted to fix unterminated string by adding closing quote")
-                
-                # Try to parse the fixed JSON
-                try:
-                    response_data = json.loads(fixed_json)
-                    logger.info("Successfully parsed fixed JSON")
-                except json.JSONDecodeError:
-                    # If still can't parse, return a safe fallback response
-                    logger.error("Could not fix JSON, returning fallback response")
-                    response_data = {
-                        "response_type": "chat_only",
-                        "chat_message": "I apologize, but I encountered an error processing your request. Please try again."
-                    }
-
-            # Get token usage
-            usage = response.usage
-
-            duration_ms = int((time.time() - start_time) * 1000)
-
-            logger.info(f"Azure AI Inference response generated: type={response_data['response_type']}, "
-                        f"tokens={usage.total_tokens}, duration={duration_ms}ms")
+                arguments, usage = await endpoint.provider.complete(request, stream)
+            except BaseException:
+                if stream and stream.fragments and endpoint.billable:
+                    # Broken off mid-stream (error or cancel): the output so far is billed
+                    budget.add(endpoint.model, estimate_usage(
+                        [m["content"] for m in request.messages], stream.arguments
+                    ), finished=False)
+                raise
+            if endpoint.billable:
+                budget.add(endpoint.model, usage)
+            if stream and stream.first_fragment_at:
+                timing.first_fragment(stream.first_fragment_at)
+
+            response_data = self._parse_tool_arguments(arguments)
+
+            logger.info(f"LLM response generated by {endpoint.name}: type={response_data['response_type']}, "
+                        f"tokens={usage.total_tokens}, duration={timing.elapsed_ms()}ms")
 
             return (
                 LLMResponse(
@@ -571,22 +548,84 @@ IFRAME-KONTEXT:
                     prompt_tokens=usage.prompt_tokens,
                     completion_tokens=usage.completion_tokens,
                     total_tokens=usage.total_tokens,
-                    model=self.settings.azure_model_name
+                    model=endpoint.model,
+                    endpoint=endpoint.name,
+                    prompt_breakdown=request.token_breakdown,
+                    cached_tokens=usage.cached_tokens
                 ),
                 response_data
             )
 
         except Exception as e:
-            logger.error(f"Error generating Azure AI Inference response: {e}")
+            logger.error(f"Error generating response with {endpoint.name}: {e}")
             raise
 
+    @staticmethod
+    def _parse_tool_arguments(arguments: str) -> Dict[str, Any]:
+        """
+        Parse tool call arguments into response data
+
+        Truncated or malformed arguments keep every field that was complete.
+        The result then carries a "recovery" entry listing the lost fields and
+        whether a follow-up request is needed because no usable code change
+        survived.
+        """
+        # Log the raw arguments for debugging
+        logger.debug(f"Raw tool call arguments: {arguments}")
+
+        try:
+            return json.loads(arguments)
+        except json.JSONDecodeError as json_error:
+            logger.warning(f"Tool call arguments are not valid JSON ({json_error}), recovering complete fields")
+
+        recovered = recover_tool_arguments(arguments)
+        response_data = recovered.data
+        lost_fields = list(recovered.lost_fields)
+
+        response_type = str(response_data.get("response_type", "")).lower()
+        if response_type not in ("chat",) + CODE_RESPONSE_TYPES:
+            if response_data.get("updates"):
+                response_type = "update"
+            elif response_data.get("new_code"):
+                response_type = "rewrite"
+            else:
+                response_type = "chat"
+        response_data["response_type"] = response_type
+
+        needs_follow_up = False
+        if response_type == "rewrite":
+            # A rewrite with a missing file would pair new HTML with old CSS/JS
+            if not response_data.get("new_code") or any(field.startswith("new_code") for field in lost_fields):
+                response_data.pop("new_code", None)
+                needs_follow_up = True
+        elif response_type in ("update", "update_all"):
+            if not response_data.get("updates"):
+                needs_follow_up = True
+
+        if "chat_message" not in response_data:
+            response_data["chat_message"] = recovered.partial_strings.get("chat_message", TRUNCATED_FALLBACK_MESSAGE)
+        if not needs_follow_up and any(field.startswith("updates") for field in lost_fields):
+            response_data["chat_message"] += TRUNCATED_UPDATES_NOTE
+
+        response_data["recovery"] = {
+            "lost_fields": lost_fields,
+            "needs_follow_up": needs_follow_up
+        }
+        logger.info(f"Recovered tool call arguments: type={response_type}, lost={lost_fields}, "
+                    f"follow_up={needs_follow_up}")
+        return response_data
+
     async def disambiguate_multiple_matches(
             self,
             original_request: str,
             old_str: str,
             matches: List[Dict[str, Any]],
             current_code: Dict[str, str],
-            context: str = "workshop"
+            context: str = "workshop",
+            user_id: Optional[int] = None,
+            workshop_id: Optional[int] = None,
+            on_queue_position: Optional[QueuePositionCallback] = None,
+            budget: Optional[RequestBudget] = None
     ) -> tuple[LLMResponse, Dict[str, Any]]:
         """Ask LLM to clarify when multiple matches are found for an update"""
         
@@ -617,9 +656,34 @@ Beispiele für erweiterten Kontext:
         return await self.generate_response(
             prompt=disambiguation_prompt,
             current_code=current_code,
-            context=context
+            context=context,
+            user_id=user_id,
+            workshop_id=workshop_id,
+            on_queue_position=on_queue_position,
+            budget=budget
         )
 
+    @classmethod
+    def _locate_sliced_updates(cls, response_data: Dict[str, Any], current_code: Dict[str, str],
+                               visible_code: Dict[str, List[Tuple[int, int]]]):
+        """
+        Pin updates to the occurrence the model saw in sliced code
+
+        An old_str that was unique in the slice may occur again in the
+        omitted code. Such updates get "offset" (the position of that match in
+        the current file), so they are applied there instead of being
+        disambiguated.
+        """
+        if response_data["response_type"].lower() != "update":
+            return
+        for update in response_data.get("updates") or []:
+            old_str = update.get("old_str", "")
+            if not old_str or len(cls.find_multiple_matches(old_str, current_code)) <= 1:
+                continue
+            located = locate_in_slice(old_str, current_code, visible_code)
+            if located and located[0] == update.get("file"):
+                update["offset"] = located[1]
+
     @staticmethod
     def find_multiple_matches(old_str: str, current_code: Dict[str, str]) -> List[Dict[str, Any]]:
         """Find all occurrences of old_str in current code with context"""
@@ -655,8 +719,59 @@ Beispiele für erweiterten Kontext:
         
         return matches
 
-    def calculate_cost(self, prompt_tokens: int, completion_tokens: int) -> float:
-        """Calculate cost based on token usage"""
-        input_cost = (prompt_tokens / 1_000_000) * self.settings.cost_per_1m_input_tokens
+    def estimate_cost(self, prompt: str, current_code: Dict[str, str], context: str = "workshop",
+                      chat_history: Optional[List[Dict[str, str]]] = None,
+                      user_images: Optional[List[Dict[str, Any]]] = None,
+                      learned_concepts: Optional[List[str]] = None) -> float:
+        """
+        Worst-case cost of one call of a request (tiktoken prompt count, full completion), to reserve budget
+
+        Further calls of the same request (failover, retries, follow-up,
+        full-code resend) are reserved one by one through RequestBudget.
+        """
+        billable = [e for e in self.endpoints if e.billable]
+        if not billable:
+            return 0.0
+        prompt_tokens = estimate_prompt_tokens(
+            self.system_prompts.get(context, self.system_prompts["workshop"]),
+            prompt, current_code, chat_history, user_images, learned_concepts
+        )
+        completion_tokens = max(e.provider.max_tokens for e in billable)
+        return self.calculate_cost(prompt_tokens, completion_tokens)
+
+    def calculate_cost(self, prompt_tokens: int, completion_tokens: int, endpoint: Optional[str] = None,
+                       cached_tokens: int = 0) -> float:
+        """
+        Calculate cost based on token usage (cache hits, local and fake endpoints are free)
+
+        cached_tokens are the part of prompt_tokens read from the provider's
+        prompt cache and are billed at the discounted cached-input price.
+        """
+        billable = {e.name: e.billable for e in self.endpoints}
+        if not billable.get(endpoint, True):
+            return 0.0
+        cached_tokens = min(cached_tokens, prompt_tokens)
+        input_cost = ((prompt_tokens - cached_tokens) / 1_000_000) * self.settings.cost_per_1m_input_tokens
+        input_cost += (cached_tokens / 1_000_000) * self.settings.cost_per_1m_cached_input_tokens
         output_cost = (completion_tokens / 1_000_000) * self.settings.cost_per_1m_output_tokens
         return round(input_cost + output_cost, 6)
+
+
+# Process-wide service instance, created and closed by the application lifespan
+_shared_service: Optional[AzureAIService] = None
+
+
+def get_ai_service() -> AzureAIService:
+    """Get the shared AI service (one client and connection pool per process)"""
+    global _shared_service
+    if _shared_service is None:
+        _shared_service = AzureAIService()
+    return _shared_service
+
+
+async def close_ai_service():
+    """Close the shared AI service"""
+    global _shared_service
+    if _shared_service is not None:
+        await _shared_service.close()
+        _shared_service = None
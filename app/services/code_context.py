@@ -0,0 +1,365 @@
+import re
+import bisect
+import logging
+from html.parser import HTMLParser
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from app.services.llm_stream import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Elements without an end tag
+VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input",
+    "link", "meta", "param", "source", "track", "wbr"
+}
+
+# German workshop vocabulary -> terms that appear in the code
+SYNONYMS: Dict[str, Tuple[str, ...]] = {
+    "knopf": ("button", "btn"),
+    "schaltfläche": ("button", "btn"),
+    "überschrift": ("h1", "h2", "h3", "heading", "title"),
+    "titel": ("title", "h1", "heading"),
+    "bild": ("img", "image"),
+    "bilder": ("img", "image", "gallery"),
+    "galerie": ("gallery",),
+    "menü": ("nav", "menu"),
+    "navigation": ("nav", "menu"),
+    "kopfzeile": ("header",),
+    "fußzeile": ("footer",),
+    "liste": ("ul", "ol", "li", "list"),
+    "tabelle": ("table",),
+    "formular": ("form", "input"),
+    "eingabe": ("input",),
+    "absatz": ("p",),
+    "text": ("p", "span"),
+    "farbe": ("color", "bg"),
+    "hintergrund": ("background", "bg"),
+    "schrift": ("font", "text"),
+    "rand": ("border",),
+    "abstand": ("margin", "padding", "gap"),
+    "karte": ("card",),
+    "karten": ("card",),
+    "animation": ("animation", "transition", "keyframes"),
+    "klick": ("click", "onclick"),
+    "spiel": ("game",),
+    "zähler": ("counter", "count"),
+}
+
+
+class CodeFragment(NamedTuple):
+    """Verbatim slice of one file with a short label for the outline"""
+    file: str
+    start: int
+    end: int
+    label: str
+
+
+def code_terms(text: str) -> Set[str]:
+    """Lowercase words of text; kebab-case and camelCase are split into their parts"""
+    terms = set()
+    for word in re.findall(r"[\wäöüß-]+", text):
+        parts = re.split(r"[-_]|(?<=[a-z])(?=[A-Z])", word)
+        terms.update(part.lower() for part in parts if part)
+        terms.add(word.lower())
+    return terms
+
+
+def prompt_terms(prompt: str) -> Set[str]:
+    """Terms of the prompt plus the code words its German vocabulary stands for"""
+    terms = {term for term in code_terms(prompt) if len(term) > 2}
+    for term in list(terms):
+        terms.update(SYNONYMS.get(term, ()))
+    return terms
+
+
+class _ElementSpans(HTMLParser):
+    """Collect the source offsets of every element, as a tree"""
+
+    def __init__(self, html: str):
+        super().__init__(convert_charrefs=True)
+        self.html = html
+        self.line_starts = [0] + [m.end() for m in re.finditer("\n", html)]
+        # [tag, attrs, start, end, children]
+        self.roots: List[list] = []
+        self.stack: List[list] = []
+
+    def _offset(self) -> int:
+        line, column = self.getpos()
+        return self.line_starts[line - 1] + column
+
+    def _add(self, element: list):
+        (self.stack[-1][4] if self.stack else self.roots).append(element)
+
+    def handle_starttag(self, tag, attrs):
+        start = self._offset()
+        element = [tag, dict(attrs), start, None, []]
+        self._add(element)
+        if tag in VOID_ELEMENTS:
+            element[3] = start + len(self.get_starttag_text() or "")
+        else:
+            self.stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        start = self._offset()
+        self._add([tag, dict(attrs), start, start + len(self.get_starttag_text() or ""), []])
+
+    def handle_endtag(self, tag):
+        if not any(element[0] == tag for element in self.stack):
+            return
+        end = self.html.find(">", self._offset()) + 1 or len(self.html)
+        while self.stack:
+            element = self.stack.pop()
+            element[3] = end
+            if element[0] == tag:
+                break
+
+    def parse(self) -> List[list]:
+        self.feed(self.html)
+        self.close()
+        for element in self.stack:
+            element[3] = len(self.html)
+        return self.roots
+
+
+def _html_label(tag: str, attrs: Dict[str, Optional[str]]) -> str:
+    label = tag
+    if attrs.get("id"):
+        label += f"#{attrs['id']}"
+    classes = (attrs.get("class") or "").split()
+    if classes:
+        label += "." + ".".join(classes[:3])
+    return f"<{label}>"
+
+
+def split_html(html: str, max_tokens: int) -> List[CodeFragment]:
+    """Split HTML into the largest elements that fit max_tokens (large ones into their children)"""
+    try:
+        roots = _ElementSpans(html).parse()
+    except Exception as e:
+        logger.debug(f"Could not parse HTML for code context: {e}")
+        return [CodeFragment("html", 0, len(html), "HTML")]
+
+    fragments: List[CodeFragment] = []
+
+    def visit(element: list):
+        tag, attrs, start, end, children = element
+        if children and count_tokens(html[start:end]) > max_tokens:
+            for child in children:
+                visit(child)
+        else:
+            fragments.append(CodeFragment("html", start, end, _html_label(tag, attrs)))
+
+    for root in roots:
+        visit(root)
+    return fragments
+
+
+def _strip_literals(line: str) -> str:
+    """Drop strings and line comments so braces inside them are not counted"""
+    line = re.sub(r"\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*'|`(?:\\.|[^`\\])*`", "", line)
+    return re.sub(r"//.*$", "", line)
+
+
+def split_blocks(file_type: str, code: str) -> List[CodeFragment]:
+    """
+    Split CSS or JS into top-level blocks (rules, functions, statement groups)
+
+    A block ends when its braces are closed again, or at a blank line
+    between top-level statements.
+    """
+    fragments: List[CodeFragment] = []
+    start: Optional[int] = None
+    depth = 0
+    opened = False
+    offset = 0
+
+    for line in code.splitlines(keepends=True):
+        line_start, offset = offset, offset + len(line)
+        stripped = line.strip()
+        if start is None:
+            if not stripped:
+                continue
+            start = line_start
+
+        code_part = _strip_literals(line) if file_type == "js" else line
+        depth += code_part.count("{") - code_part.count("}")
+        opened = opened or "{" in code_part
+
+        if depth <= 0 and (opened or not stripped):
+            end = offset if stripped else line_start
+            label = " ".join(code[start:end].split("{", 1)[0].split())[:60]
+            fragments.append(CodeFragment(file_type, start, end, label))
+            start, depth, opened = None, 0, False
+
+    if start is not None:
+        label = " ".join(code[start:].split("{", 1)[0].split())[:60]
+        fragments.append(CodeFragment(file_type, start, len(code), label))
+    return fragments
+
+
+class CodeSlice(NamedTuple):
+    """Code shown to the model: relevant fragments verbatim, the rest as outline markers"""
+    code: Dict[str, str]
+    fragments: int
+    omitted: int
+    # (start, end) offsets in each original file of the text shown verbatim
+    visible: Dict[str, List[Tuple[int, int]]]
+
+
+# Marker for omitted fragments, in each file's comment syntax
+OMITTED_MARKERS = {
+    "html": "<!-- … ausgelassen (Zeilen {lines}): {labels} -->",
+    "css": "/* … ausgelassen (Zeilen {lines}): {labels} */",
+    "js": "/* … ausgelassen (Zeilen {lines}): {labels} */"
+}
+
+
+def _render(file_type: str, code: str, fragments: List[CodeFragment],
+            keep: Set[CodeFragment]) -> Tuple[str, List[Tuple[int, int]]]:
+    """
+    Rebuild the file with every run of omitted fragments replaced by one marker
+
+    Returns the text and the (start, end) offsets of the code it shows verbatim.
+    """
+    line_starts = [0] + [m.end() for m in re.finditer("\n", code)]
+
+    def line_of(offset: int) -> int:
+        return bisect.bisect_right(line_starts, offset)
+
+    parts: List[str] = []
+    visible: List[Tuple[int, int]] = []
+    position = 0
+    omitted_run: List[CodeFragment] = []
+
+    def copy(start: int, end: int):
+        if start >= end:
+            return
+        parts.append(code[start:end])
+        if visible and visible[-1][1] == start:
+            visible[-1] = (visible[-1][0], end)
+        else:
+            visible.append((start, end))
+
+    def flush():
+        if not omitted_run:
+            return
+        labels = [f.label for f in omitted_run if f.label]
+        label_text = ", ".join(labels[:5]) + (f" und {len(labels) - 5} weitere" if len(labels) > 5 else "")
+        lines = f"{line_of(omitted_run[0].start)}-{line_of(max(omitted_run[-1].end - 1, 0))}"
+        parts.append(OMITTED_MARKERS[file_type].format(lines=lines, labels=label_text))
+        omitted_run.clear()
+
+    for fragment in fragments:
+        gap = code[position:fragment.start]
+        if fragment in keep:
+            flush()
+            copy(position, fragment.end)
+        else:
+            # Wrapper tags between omitted elements stay visible
+            if gap.strip():
+                flush()
+            if not omitted_run:
+                copy(position, fragment.start)
+            omitted_run.append(fragment)
+        position = fragment.end
+    flush()
+    copy(position, len(code))
+    return "".join(parts), visible
+
+
+def slice_code(current_code: Dict[str, str], prompt: str, max_tokens: Optional[int],
+               recent_edits: Iterable[str] = ()) -> CodeSlice:
+    """
+    Select the code relevant to a prompt
+
+    Code within max_tokens (or any code if it is None) is sent whole. Otherwise fragments are scored by
+    the prompt terms they contain and by whether the last edits touched them.
+    The best match of every file is kept first, then the other matches by
+    score; what is left of max_tokens shows the start of each file, in equal
+    shares. Every omitted run becomes a one-line outline marker. Kept text
+    is copied unchanged, so old_str taken from it still matches the full
+    document.
+    """
+    files = {file_type: current_code.get(file_type) or "" for file_type in ("html", "css", "js")}
+    if max_tokens is None or sum(count_tokens(code) for code in files.values()) <= max_tokens:
+        return CodeSlice(files, 0, 0, {file_type: [(0, len(code))] if code else [] for file_type, code in files.items()})
+
+    fragment_limit = max(max_tokens // 4, 1)
+    per_file = {
+        "html": split_html(files["html"], fragment_limit),
+        "css": split_blocks("css", files["css"]),
+        "js": split_blocks("js", files["js"])
+    }
+
+    terms = prompt_terms(prompt)
+    edits = [edit.strip() for edit in recent_edits if edit and len(edit.strip()) >= 3]
+
+    scored: List[Tuple[int, int, CodeFragment]] = []
+    for file_type, fragments in per_file.items():
+        for index, fragment in enumerate(fragments):
+            text = files[file_type][fragment.start:fragment.end]
+            score = 3 * len(terms & code_terms(text))
+            score += 2 * sum(1 for edit in edits if edit in text)
+            scored.append((score, index, fragment))
+
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    keep: Set[CodeFragment] = set()
+    remaining = max_tokens
+
+    def take(fragment: CodeFragment, limit: int) -> bool:
+        nonlocal remaining
+        tokens = count_tokens(files[fragment.file][fragment.start:fragment.end])
+        if tokens > limit:
+            return False
+        keep.add(fragment)
+        remaining -= tokens
+        return True
+
+    # The best match of each file first, so the matches of one file cannot crowd out another's
+    matches = [fragment for score, _, fragment in scored if score > 0]
+    best: Dict[str, CodeFragment] = {}
+    for fragment in matches:
+        best.setdefault(fragment.file, fragment)
+    for fragment in list(best.values()) + matches:
+        if fragment not in keep:
+            take(fragment, remaining)
+
+    # The rest gives an overview: the start of each file, in equal shares
+    overview = [file_type for file_type, fragments in per_file.items() if any(f not in keep for f in fragments)]
+    for index, file_type in enumerate(overview):
+        share = remaining // (len(overview) - index)
+        for fragment in per_file[file_type]:
+            if fragment in keep:
+                continue
+            if not take(fragment, share):
+                break
+            share -= count_tokens(files[file_type][fragment.start:fragment.end])
+
+    rendered = {
+        file_type: _render(file_type, files[file_type], per_file[file_type], keep) for file_type in files
+    }
+    total = sum(len(fragments) for fragments in per_file.values())
+    return CodeSlice(
+        {file_type: text for file_type, (text, _) in rendered.items()},
+        fragments=total,
+        omitted=total - len(keep),
+        visible={file_type: visible for file_type, (_, visible) in rendered.items()}
+    )
+
+
+def locate_in_slice(old_str: str, current_code: Dict[str, str],
+                    visible: Dict[str, List[Tuple[int, int]]]) -> Optional[Tuple[str, int]]:
+    """
+    Find the occurrence of old_str the model saw in sliced code
+
+    Returns (file, offset) if exactly one occurrence lies in the verbatim
+    part of the slice (offset is its position in the file), otherwise None.
+    """
+    found: List[Tuple[str, int]] = []
+    for file_type, ranges in visible.items():
+        code = current_code.get(file_type) or ""
+        for match in re.finditer(re.escape(old_str), code):
+            if any(start <= match.start() and match.end() <= end for start, end in ranges):
+                found.append((file_type, match.start()))
+    return found[0] if len(found) == 1 else None
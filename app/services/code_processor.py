@@ -152,21 +152,35 @@ class CodeProcessor:
             Updated code dict
         """
         new_code = current_code.copy()
+        # Pinned updates (see AzureAIService._locate_sliced_updates): their offset
+        # in current_code, moved along as earlier updates change the file
+        offsets = {i: update['offset'] for i, update in enumerate(updates) if update.get('offset') is not None}
         
-        for update in updates:
+        for i, update in enumerate(updates):
             file_type = update.get('file')
             old_str = update.get('old_str', '')
             new_str = update.get('new_str', '')
             
             if file_type in new_code and old_str in new_code[file_type]:
+                code = new_code[file_type]
                 if apply_all:
                     # Replace all occurrences
-                    new_code[file_type] = new_code[file_type].replace(old_str, new_str)
+                    new_code[file_type] = code.replace(old_str, new_str)
                     logger.info(f"Applied update_all to {file_type}: {update.get('description', 'No description')} (all occurrences)")
+                    continue
+                if i in offsets:
+                    # The occurrence the AI saw in sliced code
+                    start = offsets[i]
+                    if start < 0 or code[start:start + len(old_str)] != old_str:
+                        logger.warning(f"Could not apply update to {file_type}: pinned occurrence was changed by an earlier update.")
+                        continue
+                    logger.info(f"Applied update to {file_type}: {update.get('description', 'No description')} (pinned occurrence)")
                 else:
                     # Replace only first occurrence
-                    new_code[file_type] = new_code[file_type].replace(old_str, new_str, 1)
+                    start = code.find(old_str)
                     logger.info(f"Applied update to {file_type}: {update.get('description', 'No description')} (first occurrence)")
+                new_code[file_type] = code[:start] + new_str + code[start + len(old_str):]
+                cls._shift_offsets(offsets, updates, file_type, start, len(old_str), len(new_str))
             else:
                 logger.warning(f"Could not apply update to {file_type}: string not found.")
                 logger.warning(f"Looking for: '{old_str}'")
@@ -176,6 +190,18 @@ class CodeProcessor:
         
         return new_code
     
+    @staticmethod
+    def _shift_offsets(offsets: Dict[int, int], updates: List[Dict], file_type: str, start: int, old_len: int, new_len: int):
+        """Move pinned offsets behind a replacement; invalidate (-1) those it overlapped"""
+        end = start + old_len
+        for i, offset in offsets.items():
+            if updates[i].get('file') != file_type or offset < 0:
+                continue
+            if offset >= end:
+                offsets[i] = offset + new_len - old_len
+            elif offset + len(updates[i].get('old_str', '')) > start:
+                offsets[i] = -1
+    
     @classmethod
     def sanitize_code(cls, code: Dict[str, str]) -> Dict[str, str]:
         """
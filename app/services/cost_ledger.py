@@ -0,0 +1,332 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Any, Deque, Dict, Iterable, List, Optional
+
+from sqlalchemy import select, func, and_, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import async_session_maker
+from app.models import LLMCall, UserCostLedger
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Window of call timestamps kept per user (rate limit and "recent calls" stats)
+RECENT_WINDOW = timedelta(minutes=5)
+# Only users without calls in this period are reconciled
+RECONCILE_QUIET_PERIOD = timedelta(minutes=1)
+
+
+class LedgerEntry:
+    """In-memory copy of a user's ledger row plus the times of their recent calls"""
+
+    __slots__ = ("total_cost", "total_calls", "total_tokens", "last_call_at", "recent", "expires_at")
+
+    def __init__(self, total_cost: float, total_calls: int, total_tokens: int,
+                 last_call_at: Optional[datetime], recent: Iterable[datetime], ttl_seconds: int):
+        self.total_cost = total_cost
+        self.total_calls = total_calls
+        self.total_tokens = total_tokens
+        self.last_call_at = last_call_at
+        self.recent: Deque[datetime] = deque(sorted(recent))
+        self.expires_at = time.monotonic() + ttl_seconds
+
+    def recent_calls(self, minutes: int) -> int:
+        """Calls in the last N minutes (at most RECENT_WINDOW)"""
+        now = datetime.utcnow()
+        while self.recent and self.recent[0] < now - RECENT_WINDOW:
+            self.recent.popleft()
+        since = now - timedelta(minutes=minutes)
+        return sum(1 for called_at in self.recent if called_at >= since)
+
+
+class Reservation:
+    """Budget held for an AI request until its real cost is recorded"""
+
+    __slots__ = ("user_id", "amount", "limit", "total_cost", "active")
+
+    def __init__(self, user_id: int, amount: float, limit: float, total_cost: float):
+        self.user_id = user_id
+        self.amount = amount
+        self.limit = limit
+        self.total_cost = total_cost  # The user's total when reserved (used if the entry was evicted since)
+        self.active = True
+
+
+class CostLedger:
+    """
+    Per-user running cost totals (user_cost_ledger), cached in memory
+
+    queued() applies a call to the cached totals as soon as it is queued
+    for writing; record() adds a batch of calls to the ledger rows inside
+    the writer's transaction. Calls queued but not yet written are kept in
+    unflushed and added whenever totals are loaded from the database.
+    Rows are reconciled against llm_calls periodically, so drift from other
+    processes or manual edits is corrected.
+
+    Requests in flight hold a reservation of their worst-case cost, so
+    concurrent requests of one user cannot together overrun the budget.
+    Reservations live in this process only.
+    """
+
+    def __init__(self, ttl_seconds: int, max_entries: int, reconcile_interval: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.reconcile_interval = reconcile_interval
+        self.entries: "OrderedDict[int, LedgerEntry]" = OrderedDict()
+        # user_id -> reserved cost of requests in flight (kept when entries expire)
+        self.reserved: Dict[int, float] = {}
+        # user_id -> [cost, calls, tokens] of calls queued but not yet written
+        self.unflushed: Dict[int, List] = {}
+        # Bumped by every written batch, so load() notices batches written while it queried
+        self.flush_generation = 0
+        self.reconcile_task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.corrections = 0
+
+    async def get(self, user_id: int, db: AsyncSession) -> LedgerEntry:
+        """Get a user's totals, from memory if possible"""
+        entry = self.entries.get(user_id)
+        if entry is not None and entry.expires_at >= time.monotonic():
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        await self.load([user_id], db)
+        return self.entries[user_id]
+
+    async def load(self, user_ids: Iterable[int], db: AsyncSession):
+        """Load the totals of several users with two queries (e.g. for admin lists)"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+
+        # A batch written between the queries and reading unflushed would be
+        # missing from both, so the queries are repeated (at most a few times)
+        for _ in range(3):
+            generation = self.flush_generation
+            result = await db.execute(select(UserCostLedger).where(UserCostLedger.user_id.in_(user_ids)))
+            rows = {row.user_id: row for row in result.scalars()}
+
+            result = await db.execute(
+                select(LLMCall.user_id, LLMCall.created_at)
+                .where(LLMCall.user_id.in_(user_ids))
+                .where(LLMCall.created_at >= datetime.utcnow() - RECENT_WINDOW)
+            )
+            recent: Dict[int, List[datetime]] = {}
+            for user_id, created_at in result:
+                recent.setdefault(user_id, []).append(created_at)
+
+            if generation == self.flush_generation:
+                break
+
+        for user_id in user_ids:
+            row = rows.get(user_id)
+            cost, calls, tokens, pending_times = self.unflushed.get(user_id, (0.0, 0, 0, []))
+            self._store(user_id, LedgerEntry(
+                total_cost=(float(row.total_cost) if row else 0.0) + cost,
+                total_calls=(row.total_calls if row else 0) + calls,
+                total_tokens=(row.total_tokens if row else 0) + tokens,
+                last_call_at=max(pending_times) if pending_times else (row.last_call_at if row else None),
+                recent=recent.get(user_id, []) + pending_times,
+                ttl_seconds=self.ttl_seconds
+            ))
+
+    def _store(self, user_id: int, entry: LedgerEntry):
+        self.entries[user_id] = entry
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def record(self, db: AsyncSession, totals: Dict[int, List]):
+        """
+        Add written calls to the ledger rows in one statement (committed by the caller with the calls)
+
+        totals maps user_id -> [cost, calls, tokens, last_call_at].
+        """
+        if not totals:
+            return
+        stmt = insert(UserCostLedger).values([
+            {
+                "user_id": user_id,
+                "total_cost": cost,
+                "total_calls": calls,
+                "total_tokens": tokens,
+                "last_call_at": last_call_at
+            }
+            for user_id, (cost, calls, tokens, last_call_at) in totals.items()
+        ])
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[UserCostLedger.user_id],
+            set_={
+                "total_cost": UserCostLedger.total_cost + stmt.excluded.total_cost,
+                "total_calls": UserCostLedger.total_calls + stmt.excluded.total_calls,
+                "total_tokens": UserCostLedger.total_tokens + stmt.excluded.total_tokens,
+                "last_call_at": func.greatest(UserCostLedger.last_call_at, stmt.excluded.last_call_at)
+            }
+        ))
+
+    def queued(self, user_id: int, cost: float, tokens: int, called_at: datetime):
+        """Apply a call queued for writing to the cached totals (uncached users include it when loaded)"""
+        pending = self.unflushed.setdefault(user_id, [0.0, 0, 0, []])
+        pending[0] += cost
+        pending[1] += 1
+        pending[2] += tokens
+        pending[3].append(called_at)
+
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return
+        entry.total_cost += cost
+        entry.total_calls += 1
+        entry.total_tokens += tokens
+        entry.last_call_at = called_at
+        entry.recent.append(called_at)
+
+    def flushed(self, totals: Dict[int, List]):
+        """Forget calls that are now in the database (totals as passed to record())"""
+        self.flush_generation += 1
+        for user_id, (cost, calls, tokens, _) in totals.items():
+            pending = self.unflushed.get(user_id)
+            if pending is None:
+                continue
+            pending[0] -= cost
+            pending[1] -= calls
+            pending[2] -= tokens
+            # Calls are written in the order they were queued
+            del pending[3][:calls]
+            if pending[1] <= 0:
+                del self.unflushed[user_id]
+
+    def reserve(self, user_id: int, entry: LedgerEntry, amount: float, limit: float) -> Optional[Reservation]:
+        """Reserve amount if it fits into the user's remaining budget (no await, so atomic)"""
+        reserved = self.reserved.get(user_id, 0.0)
+        if entry.total_cost + reserved + amount > limit:
+            return None
+        self.reserved[user_id] = reserved + amount
+        return Reservation(user_id, amount, limit, entry.total_cost)
+
+    def extend(self, reservation: Reservation, amount: float) -> bool:
+        """Add amount to a reservation if it still fits into the user's budget (no await, so atomic)"""
+        if not reservation.active:
+            return False
+        entry = self.entries.get(reservation.user_id)
+        total_cost = entry.total_cost if entry is not None else reservation.total_cost
+        reserved = self.reserved.get(reservation.user_id, 0.0)
+        if total_cost + reserved + amount > reservation.limit:
+            return False
+        self.reserved[reservation.user_id] = reserved + amount
+        reservation.amount += amount
+        return True
+
+    def release(self, reservation: Optional[Reservation]):
+        """Give back a reservation once the call is recorded or failed (repeated calls are no-ops)"""
+        if not reservation or not reservation.active:
+            return
+        reservation.active = False
+        remaining = self.reserved.get(reservation.user_id, 0.0) - reservation.amount
+        if remaining > 1e-9:
+            self.reserved[reservation.user_id] = remaining
+        else:
+            self.reserved.pop(reservation.user_id, None)
+
+    def invalidate_user(self, user_id: int):
+        self.entries.pop(user_id, None)
+
+    async def reconcile(self):
+        """Rewrite ledger rows that differ from the sums over llm_calls"""
+        totals = (
+            select(
+                LLMCall.user_id,
+                func.coalesce(func.sum(LLMCall.cost), 0),
+                func.count(LLMCall.id),
+                func.coalesce(func.sum(LLMCall.total_tokens), 0),
+                func.max(LLMCall.created_at)
+            )
+            .where(LLMCall.user_id.isnot(None))
+            .group_by(LLMCall.user_id)
+        )
+        stmt = insert(UserCostLedger).from_select(
+            ["user_id", "total_cost", "total_calls", "total_tokens", "last_call_at"], totals
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserCostLedger.user_id],
+            set_={
+                "total_cost": stmt.excluded.total_cost,
+                "total_calls": stmt.excluded.total_calls,
+                "total_tokens": stmt.excluded.total_tokens,
+                "last_call_at": stmt.excluded.last_call_at
+            },
+            where=and_(
+                # A call committed while the sums were taken must not be overwritten
+                UserCostLedger.last_call_at < datetime.utcnow() - RECONCILE_QUIET_PERIOD,
+                or_(
+                    UserCostLedger.total_cost != stmt.excluded.total_cost,
+                    UserCostLedger.total_calls != stmt.excluded.total_calls,
+                    UserCostLedger.total_tokens != stmt.excluded.total_tokens
+                )
+            )
+        ).returning(UserCostLedger.user_id)
+
+        try:
+            async with async_session_maker() as db:
+                result = await db.execute(stmt)
+                # Rows inserted for users without a ledger row are returned too
+                corrected = list(result.scalars())
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Failed to reconcile cost ledger: {e}")
+            return
+
+        if corrected:
+            self.corrections += len(corrected)
+            logger.warning(f"Cost ledger corrected for users {corrected}")
+            for user_id in corrected:
+                self.invalidate_user(user_id)
+
+    async def _reconcile_loop(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            await self.reconcile()
+
+    def start(self):
+        """Start the periodic reconciliation task"""
+        if not self.reconcile_task and self.reconcile_interval > 0:
+            self.reconcile_task = asyncio.create_task(self._reconcile_loop())
+
+    async def stop(self):
+        """Stop the periodic reconciliation task"""
+        if self.reconcile_task:
+            self.reconcile_task.cancel()
+            try:
+                await self.reconcile_task
+            except asyncio.CancelledError:
+                pass
+            self.reconcile_task = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache statistics"""
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "corrections": self.corrections,
+            "unflushed_users": len(self.unflushed),
+            "reservations": len(self.reserved),
+            "reserved_cost": round(sum(self.reserved.values()), 6)
+        }
+
+
+# Global cost ledger instance
+cost_ledger = CostLedger(
+    ttl_seconds=settings.cost_ledger_cache_ttl,
+    max_entries=settings.cost_ledger_max_entries,
+    reconcile_interval=settings.cost_ledger_reconcile_interval
+)
@@ -1,15 +1,32 @@
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, Optional
-from sqlalchemy import select, func
+from datetime import datetime
+from typing import Any, Dict, List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.models import LLMCall, User
+from app.models import LLMCall
+from app.services.cost_ledger import LedgerEntry, Reservation, cost_ledger
+from app.services.llm_call_writer import llm_call_writer
+from app.services.llm_telemetry import CallTiming
 from app.config import get_settings
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
 
 
+def compact_response_data(response_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Response data as stored in llm_calls: a rewrite's complete code is
+    replaced by its size per file (the website and its code_history keep it)
+    """
+    new_code = response_data.get("new_code")
+    if not isinstance(new_code, dict):
+        return response_data
+    compacted = {key: value for key, value in response_data.items() if key != "new_code"}
+    compacted["new_code_chars"] = {
+        file_type: len(code) for file_type, code in new_code.items() if isinstance(code, str)
+    }
+    return compacted
+
+
 class CostTracker:
     """Track and manage API costs per user"""
     
@@ -18,41 +35,56 @@ class CostTracker:
     
     async def can_make_api_call(self, user_id: int) -> tuple[bool, str]:
         """
-        Check if user can make an API call based on cost and rate limits
+        Check if user can make an API call based on their cost limit
         
         Returns:
             Tuple of (allowed, reason_if_not)
         """
-        # Check cost limit
-        total_cost = await self.get_user_total_cost(user_id)
-        if total_cost >= settings.max_cost_per_user:
-            return False, f"Kostenlimit erreicht (€{settings.max_cost_per_user:.2f})"
+        ledger = await cost_ledger.get(user_id, self.db)
+        reason = self._check_limits(user_id, ledger)
+        return not reason, reason
+    
+    async def reserve_api_call(self, user_id: int, estimated_cost: float) -> tuple[Optional[Reservation], str]:
+        """
+        Check the limits and reserve the worst-case cost of a call
+        
+        The reservation is settled by record_api_call; release it with
+        cost_ledger.release() if the call fails (releasing twice is harmless).
         
-        # Check rate limit
-        recent_calls = await self.get_recent_api_calls(user_id, minutes=1)
-        if recent_calls >= settings.max_api_calls_per_minute:
-            return False, f"Zu viele Anfragen (max. {settings.max_api_calls_per_minute}/Minute)"
+        Returns:
+            Tuple of (reservation or None, reason_if_not)
+        """
+        ledger = await cost_ledger.get(user_id, self.db)
+        # Check and reservation run without an await in between, so concurrent
+        # requests of the same user always see each other's reservations
+        reason = self._check_limits(user_id, ledger)
+        if reason:
+            return None, reason
+        
+        reservation = cost_ledger.reserve(user_id, ledger, estimated_cost, settings.max_cost_per_user)
+        if not reservation:
+            remaining = max(settings.max_cost_per_user - ledger.total_cost - cost_ledger.reserved.get(user_id, 0.0), 0.0)
+            return None, f"Restbudget reicht nicht für diese Anfrage (€{remaining:.2f} übrig)"
+        return reservation, ""
+    
+    def _check_limits(self, user_id: int, ledger: LedgerEntry) -> str:
+        """Reason the user may not call the AI now, or "" if they may"""
+        # Check cost limit (including calls still in flight); request rates
+        # are limited by llm_rate_limiter before a call gets here
+        if ledger.total_cost + cost_ledger.reserved.get(user_id, 0.0) >= settings.max_cost_per_user:
+            return f"Kostenlimit erreicht (€{settings.max_cost_per_user:.2f})"
         
-        return True, ""
+        return ""
     
     async def get_user_total_cost(self, user_id: int) -> float:
         """Get total cost for a user"""
-        result = await self.db.execute(
-            select(func.sum(LLMCall.cost))
-            .where(LLMCall.user_id == user_id)
-        )
-        total = result.scalar()
-        return float(total) if total else 0.0
+        ledger = await cost_ledger.get(user_id, self.db)
+        return ledger.total_cost
     
     async def get_recent_api_calls(self, user_id: int, minutes: int = 1) -> int:
-        """Count API calls in the last N minutes"""
-        since = datetime.utcnow() - timedelta(minutes=minutes)
-        result = await self.db.execute(
-            select(func.count(LLMCall.id))
-            .where(LLMCall.user_id == user_id)
-            .where(LLMCall.created_at >= since)
-        )
-        return result.scalar() or 0
+        """Count API calls in the last N minutes (up to 5)"""
+        ledger = await cost_ledger.get(user_id, self.db)
+        return ledger.recent_calls(minutes)
     
     async def record_api_call(
         self,
@@ -64,61 +96,72 @@ class CostTracker:
         prompt_tokens: int,
         completion_tokens: int,
         cost: float,
-        duration_ms: int,
-        error_message: Optional[str] = None
-    ) -> LLMCall:
-        """Record an API call in the database"""
-        logger.info(f"Creating LLMCall with response_type: {response_type} (type: {type(response_type)})")
+        timing: Optional[CallTiming] = None,
+        error_message: Optional[str] = None,
+        model: Optional[str] = None,
+        cache_hit: bool = False,
+        prompt_breakdown: Optional[Dict] = None,
+        cached_tokens: int = 0,
+        reservation: Optional[Reservation] = None
+    ):
+        """
+        Queue an API call for writing to the database
         
-        llm_call = LLMCall(
-            user_id=user_id,
-            website_id=website_id,
-            prompt=prompt,
-            response_type=response_type,
-            response_data=response_data,
-            prompt_tokens=prompt_tokens,
-            completion_tokens=completion_tokens,
-            total_tokens=prompt_tokens + completion_tokens,
-            cost=cost,
-            duration_ms=duration_ms,
-            error_message=error_message
-        )
+        The cost counts towards the user's limits immediately; the row is
+        written by llm_call_writer in the background. Waits only if the
+        write queue is full.
+        """
+        total_tokens = prompt_tokens + completion_tokens
+        called_at = datetime.utcnow()
+        row = {
+            "user_id": user_id,
+            "website_id": website_id,
+            "prompt": prompt,
+            "response_type": response_type,
+            "response_data": compact_response_data(response_data),
+            "model": model or LLMCall.__table__.c.model.default.arg,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "cost": cost,
+            "duration_ms": None,
+            "queue_wait_ms": None,
+            "ttft_ms": None,
+            "tokens_per_second": None,
+            "retries": 0,
+            "endpoint": None,
+            "error_message": error_message,
+            "cache_hit": cache_hit,
+            "prompt_breakdown": prompt_breakdown,
+            "created_at": called_at
+        }
+        if timing:
+            row.update(timing.as_columns(completion_tokens))
         
-        self.db.add(llm_call)
-        await self.db.commit()
+        # The real cost replaces the reserved estimate before anything is awaited
+        cost_ledger.queued(user_id, cost, total_tokens, called_at)
+        cost_ledger.release(reservation)
+        await llm_call_writer.put(row)
         
         logger.info(f"Recorded API call for user {user_id}: "
-                   f"cost=€{cost:.4f}, tokens={prompt_tokens + completion_tokens}")
-        
-        return llm_call
+                   f"cost=€{cost:.4f}, tokens={total_tokens}, cache_hit={cache_hit}")
+    
+    async def load_users(self, user_ids: List[int]):
+        """Load the ledgers of many users at once before asking for their stats"""
+        await cost_ledger.load(user_ids, self.db)
     
     async def get_user_stats(self, user_id: int) -> Dict:
         """Get usage statistics for a user"""
-        # Total cost
-        total_cost = await self.get_user_total_cost(user_id)
-        
-        # Total calls
-        result = await self.db.execute(
-            select(func.count(LLMCall.id))
-            .where(LLMCall.user_id == user_id)
-        )
-        total_calls = result.scalar() or 0
-        
-        # Total tokens
-        result = await self.db.execute(
-            select(func.sum(LLMCall.total_tokens))
-            .where(LLMCall.user_id == user_id)
-        )
-        total_tokens = result.scalar() or 0
-        
-        # Recent activity
-        recent_calls = await self.get_recent_api_calls(user_id, minutes=5)
+        ledger = await cost_ledger.get(user_id, self.db)
+        total_cost = ledger.total_cost
         
         return {
             "total_cost": total_cost,
-            "total_calls": total_calls,
-            "total_tokens": total_tokens,
-            "recent_calls_5min": recent_calls,
+            "total_calls": ledger.total_calls,
+            "total_tokens": ledger.total_tokens,
+            "recent_calls_5min": ledger.recent_calls(minutes=5),
+            "last_call_at": ledger.last_call_at.isoformat() if ledger.last_call_at else None,
             "cost_limit": settings.max_cost_per_user,
             "cost_percentage": (total_cost / settings.max_cost_per_user * 100) if settings.max_cost_per_user > 0 else 0
-        }
\ No newline at end of file
+        }
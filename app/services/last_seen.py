@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Set
+from sqlalchemy import update, case
+
+from app.database import async_session_maker
+from app.models import User
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+
+class LastSeenTracker:
+    """Buffer User.last_seen updates in memory and flush them in bulk"""
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self.pending: Dict[int, datetime] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.stopping = asyncio.Event()
+
+    def touch(self, user_id: int):
+        """Record that a user was just seen"""
+        self.pending[user_id] = datetime.utcnow()
+
+    def get(self, user_id: int) -> Optional[datetime]:
+        """Get a buffered last_seen timestamp that is not yet flushed"""
+        return self.pending.get(user_id)
+
+    def get_recent_user_ids(self, since: datetime) -> Set[int]:
+        """Get users seen since a point in time that are not yet flushed"""
+        return {user_id for user_id, seen in self.pending.items() if seen >= since}
+
+    async def flush(self):
+        """Write all buffered timestamps in one bulk UPDATE"""
+        if not self.pending:
+            return
+
+        batch = self.pending
+        self.pending = {}
+
+        try:
+            async with async_session_maker() as db:
+                await db.execute(
+                    update(User)
+                    .where(User.id.in_(list(batch)))
+                    .values(last_seen=case(batch, value=User.id))
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Failed to flush last_seen for {len(batch)} users: {e}")
+            # Keep newer timestamps recorded while flushing
+            for user_id, seen in batch.items():
+                self.pending.setdefault(user_id, seen)
+
+    async def _flush_loop(self):
+        # Never cancelled: a flush in progress finishes, so its batch is not lost
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self):
+        """Start the periodic flush task"""
+        if not self.flush_task:
+            self.stopping.clear()
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stop the periodic flush task after its current flush and flush what is left"""
+        if self.flush_task:
+            self.stopping.set()
+            await self.flush_task
+            self.flush_task = None
+        await self.flush()
+
+
+# Global last_seen tracker instance
+last_seen_tracker = LastSeenTracker(flush_interval=settings.last_seen_flush_interval)
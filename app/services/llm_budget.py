@@ -0,0 +1,57 @@
+import logging
+from typing import Optional
+
+from app.services.cost_ledger import Reservation, cost_ledger
+from app.services.llm_stream import TokenUsage
+
+logger = logging.getLogger(__name__)
+
+
+class BudgetExceededError(Exception):
+    """The user's remaining budget does not cover another call of the request"""
+
+
+class RequestBudget:
+    """
+    Billable calls of one AI request
+
+    A request can take several completions: failover, scheduler retries,
+    the truncation follow-up and the full-code resend of a sliced rewrite.
+    The reservation covers one call; whenever every reserved call has been
+    billed, it is extended by call_cost before the next one is sent, and
+    the request stops with BudgetExceededError if that no longer fits.
+
+    Completed calls add the usage they reported. A call that fails or is
+    cancelled after it streamed output adds an estimate (prompt plus the
+    arguments streamed so far), since the provider bills it anyway.
+    """
+
+    def __init__(self, reservation: Optional[Reservation] = None, call_cost: float = 0.0):
+        self.reservation = reservation
+        self.call_cost = call_cost
+        self.reserved_calls = 1
+        self.billed_calls = 0
+        self.usage = TokenUsage(0, 0, 0)  # All billed calls
+        self.unfinished = TokenUsage(0, 0, 0)  # Estimated part: calls that failed or were cancelled
+        self.model: Optional[str] = None
+
+    def before_call(self):
+        """Make sure the reservation covers the call about to be sent"""
+        if self.billed_calls < self.reserved_calls:
+            return
+        if self.reservation and not cost_ledger.extend(self.reservation, self.call_cost):
+            logger.info(f"Budget of user {self.reservation.user_id} does not cover call {self.billed_calls + 1}")
+            raise BudgetExceededError("Restbudget reicht nicht für einen weiteren KI-Aufruf")
+        self.reserved_calls += 1
+
+    def add(self, model: str, usage: TokenUsage, finished: bool = True):
+        """Count the usage of a call sent to a billable deployment"""
+        self.billed_calls += 1
+        self.model = model
+        self.usage = _add_usage(self.usage, usage)
+        if not finished:
+            self.unfinished = _add_usage(self.unfinished, usage)
+
+
+def _add_usage(a: TokenUsage, b: TokenUsage) -> TokenUsage:
+    return TokenUsage(*(x + y for x, y in zip(a, b)))
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+
+from app.database import async_session_maker
+from app.models import LLMCall
+from app.services.cost_ledger import cost_ledger
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Attempts per batch once shutdown has begun (before that, failed batches are retried until the database is back)
+SHUTDOWN_ATTEMPTS = 3
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a failed write may succeed later (lost connection, database restarting, timeout)"""
+    if isinstance(error, (OperationalError, InterfaceError, OSError, asyncio.TimeoutError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+class LLMCallWriter:
+    """
+    Write-behind queue for llm_calls rows
+
+    Rows are queued on the response path and written by a background task
+    in multi-row INSERTs, together with the matching user_cost_ledger
+    update in the same transaction. The in-memory ledger is updated when a
+    row is queued, so cost limits never wait for the write.
+
+    The queue is bounded: when the database falls behind, put() waits for
+    free space instead of dropping rows. A batch that failed on a
+    connection or operational error is retried with backoff; any other
+    error is bisected down to the offending rows, which are logged and
+    dropped. stop() drains the queue before the process exits.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=max_queue)
+        self.writer_task: Optional[asyncio.Task] = None
+        self.stopping = False
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.lost = 0
+        self.backpressure_waits = 0
+
+    async def put(self, row: Dict[str, Any]):
+        """Queue one llm_calls row; waits while the queue is full"""
+        if not self.writer_task:
+            # Not started (scripts, shutdown): write directly
+            await self._write_with_retry([row])
+            return
+        if self.queue.full():
+            self.backpressure_waits += 1
+            logger.warning(f"LLM call queue full ({self.queue.qsize()} rows), waiting for the database")
+        await self.queue.put(row)
+
+    async def _write(self, batch: List[Dict[str, Any]]):
+        """Insert a batch and add it to the ledger rows in one transaction"""
+        totals: Dict[int, List] = {}
+        for row in batch:
+            if row["user_id"] is None:
+                continue
+            total = totals.setdefault(row["user_id"], [0.0, 0, 0, row["created_at"]])
+            total[0] += row["cost"]
+            total[1] += 1
+            total[2] += row["total_tokens"]
+            total[3] = max(total[3], row["created_at"])
+
+        async with async_session_maker() as db:
+            await db.execute(insert(LLMCall).values(batch))
+            await cost_ledger.record(db, totals)
+            await db.commit()
+        cost_ledger.flushed(totals)
+
+    async def _write_with_retry(self, batch: List[Dict[str, Any]]):
+        delay = 0.5
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                await self._write(batch)
+                self.written += len(batch)
+                self.batches += 1
+                return
+            except Exception as e:
+                self.failures += 1
+                if not is_transient(e):
+                    await self._write_bisected(batch, e)
+                    return
+                if self.stopping and attempt >= SHUTDOWN_ATTEMPTS:
+                    self.lost += len(batch)
+                    logger.error(f"Dropping {len(batch)} LLM call rows after {attempt} failed attempts: {e}")
+                    return
+                logger.error(f"Failed to write {len(batch)} LLM call rows (attempt {attempt}), retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30.0)
+
+    async def _write_bisected(self, batch: List[Dict[str, Any]], error: Exception):
+        """Write the halves of a batch the database rejected, dropping the rows that fail on their own"""
+        if len(batch) == 1:
+            # The call stays counted in the in-memory ledger: its cost was spent
+            row = batch[0]
+            self.lost += 1
+            logger.error(
+                f"Dropping LLM call row of user {row['user_id']} ({row['model']}, {row['created_at']}): {error}"
+            )
+            return
+        middle = len(batch) // 2
+        await self._write_with_retry(batch[:middle])
+        await self._write_with_retry(batch[middle:])
+
+    async def _next_batch(self) -> List[Dict[str, Any]]:
+        """Wait for a row, then collect more for up to flush_interval or batch_size rows"""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0 or self.stopping:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _writer_loop(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._write_with_retry(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def start(self):
+        """Start the background writer"""
+        if not self.writer_task:
+            self.stopping = False
+            self.writer_task = asyncio.create_task(self._writer_loop())
+
+    async def stop(self, timeout: float = 30.0):
+        """Write all queued rows, then stop the background writer"""
+        if not self.writer_task:
+            return
+        self.stopping = True
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"LLM call queue not drained within {timeout:.0f}s, {self.queue.qsize()} rows left")
+        self.writer_task.cancel()
+        try:
+            await self.writer_task
+        except asyncio.CancelledError:
+            pass
+        self.writer_task = None
+
+        # Rows the writer did not get to are written directly
+        while not self.queue.empty():
+            batch = [self.queue.get_nowait() for _ in range(min(self.batch_size, self.queue.qsize()))]
+            await self._write_with_retry(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get queue statistics"""
+        return {
+            "queued": self.queue.qsize(),
+            "max_queue": self.queue.maxsize,
+            "written": self.written,
+            "batches": self.batches,
+            "failures": self.failures,
+            "lost": self.lost,
+            "backpressure_waits": self.backpressure_waits
+        }
+
+
+# Global LLM call writer instance
+llm_call_writer = LLMCallWriter(
+    batch_size=settings.llm_call_batch_size,
+    flush_interval=settings.llm_call_flush_interval,
+    max_queue=settings.llm_call_queue_size
+)
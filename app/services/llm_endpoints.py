@@ -0,0 +1,206 @@
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import TYPE_CHECKING, Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+import aiohttp
+import httpx
+from openai import APIConnectionError
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+
+from app.services.llm_scheduler import get_retry_after
+from app.config import get_settings
+
+if TYPE_CHECKING:
+    from app.services.llm_providers import LLMProvider
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Errors after which the same request is tried on another deployment
+CONNECTION_ERRORS = (
+    APIConnectionError,
+    ServiceRequestError,
+    ServiceResponseError,
+    httpx.TransportError,
+    aiohttp.ClientError,
+    asyncio.TimeoutError
+)
+
+
+class NoEndpointAvailableError(Exception):
+    """Every deployment is paused; retry_after is the time until the first one may be tried again"""
+
+    status_code = 503
+
+    def __init__(self, retry_after: float, last_error: Optional[Exception] = None):
+        self.retry_after = retry_after
+        message = f"No LLM endpoint available for {retry_after:.1f}s"
+        if last_error:
+            message += f" (last error: {last_error})"
+        super().__init__(message)
+
+
+def is_failover_error(error: Exception) -> bool:
+    """Whether a failed request may succeed on another deployment"""
+    return isinstance(error, CONNECTION_ERRORS) or get_retry_after(error) is not None
+
+
+class LLMEndpoint:
+    """One deployment (Azure, local or fake) with its own quota, health and counters"""
+
+    def __init__(self, name: str, url: str, api_key: str, api_version: str, model: str,
+                 endpoint_type: str, tpm: int, max_tokens: Optional[int] = None,
+                 options: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.api_version = api_version
+        self.model = model
+        self.endpoint_type = endpoint_type
+        self.tpm = tpm
+        self.max_tokens = max_tokens
+        # Provider-specific settings from the LLM_ENDPOINTS entry
+        self.options = options or {}
+        # Set by AzureAIService
+        self.provider: Optional["LLMProvider"] = None
+
+        # (monotonic time, tokens) of the last minute
+        self.token_log: Deque[Tuple[float, int]] = deque()
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.slow_calls = 0
+        self.latency_ms_avg = 0.0
+        self.latency_ms_last = 0
+
+        # Circuit breaker: closed -> open after repeated failures -> half-open probe
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.last_error: Optional[Exception] = None
+
+    @property
+    def billable(self) -> bool:
+        return self.provider.billable if self.provider else True
+
+    @property
+    def circuit_state(self) -> str:
+        if self.open_until > time.monotonic():
+            return "open"
+        if self.consecutive_failures >= settings.llm_circuit_failure_threshold:
+            return "half_open"
+        return "closed"
+
+    def is_available(self) -> bool:
+        state = self.circuit_state
+        if state == "open":
+            return False
+        # Half-open: let a single request probe whether the deployment recovered
+        return state == "closed" or not self.probing
+
+    def tokens_last_minute(self) -> int:
+        cutoff = time.monotonic() - 60
+        while self.token_log and self.token_log[0][0] < cutoff:
+            self.token_log.popleft()
+        return sum(tokens for _, tokens in self.token_log)
+
+    def remaining_tpm(self) -> int:
+        return max(self.tpm - self.tokens_last_minute(), 0)
+
+    def start(self):
+        """Mark a request as sent to this deployment"""
+        self.requests += 1
+        if self.circuit_state == "half_open":
+            self.probing = True
+
+    def record_success(self, latency_ms: int, tokens: int):
+        self.token_log.append((time.monotonic(), tokens))
+        self._record_latency(latency_ms)
+        self.probing = False
+
+        if latency_ms > settings.llm_slow_call_seconds * 1000:
+            # Latency spikes count toward the breaker like errors
+            self.slow_calls += 1
+            self._trip()
+        else:
+            self.consecutive_failures = 0
+
+    def record_failure(self, error: Exception, latency_ms: int):
+        self.errors += 1
+        self.last_error = error
+        self._record_latency(latency_ms)
+        self.probing = False
+
+        retry_after = get_retry_after(error)
+        if retry_after is not None and getattr(error, "status_code", None) == 429:
+            # Quota exhausted, not unhealthy: pause only as long as upstream asks
+            # (without Retry-After, the scheduler's backoff decides when to retry)
+            self.rate_limited += 1
+            if retry_after:
+                self.open_until = max(self.open_until, time.monotonic() + retry_after)
+                logger.warning(f"LLM endpoint {self.name} rate limited, paused for {retry_after:.0f}s")
+            return
+        self._trip()
+
+    def _trip(self):
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= settings.llm_circuit_failure_threshold:
+            self.open_until = max(self.open_until, time.monotonic() + settings.llm_circuit_cooldown)
+            logger.warning(f"LLM endpoint {self.name} circuit opened after "
+                           f"{self.consecutive_failures} failures")
+
+    def _record_latency(self, latency_ms: int):
+        self.latency_ms_last = latency_ms
+        if self.latency_ms_avg:
+            self.latency_ms_avg = 0.8 * self.latency_ms_avg + 0.2 * latency_ms
+        else:
+            self.latency_ms_avg = float(latency_ms)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get latency, error and quota counters"""
+        return {
+            "name": self.name,
+            "model": self.model,
+            "type": self.endpoint_type,
+            "circuit": self.circuit_state,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "slow_calls": self.slow_calls,
+            "latency_ms_avg": round(self.latency_ms_avg),
+            "latency_ms_last": self.latency_ms_last,
+            "tokens_last_minute": self.tokens_last_minute(),
+            "tpm": self.tpm
+        }
+
+
+class EndpointRouter:
+    """Pick a deployment for each request, weighted by its remaining TPM budget"""
+
+    def __init__(self, endpoints: List[LLMEndpoint]):
+        self.endpoints = endpoints
+
+    def choose(self, exclude: Iterable[str] = ()) -> Optional[LLMEndpoint]:
+        """Choose an available deployment that was not tried yet for this request"""
+        excluded: Set[str] = set(exclude)
+        candidates = [e for e in self.endpoints if e.name not in excluded and e.is_available()]
+        if not candidates:
+            return None
+
+        weights = [e.remaining_tpm() for e in candidates]
+        if not any(weights):
+            # Every quota looks spent: use the least loaded one and let upstream decide
+            return min(candidates, key=lambda e: e.tokens_last_minute() / max(e.tpm, 1))
+        return random.choices(candidates, weights=weights)[0]
+
+    def unavailable_error(self) -> NoEndpointAvailableError:
+        """Error for a request that found every deployment paused, retryable when the first one reopens"""
+        now = time.monotonic()
+        first = min(self.endpoints, key=lambda e: e.open_until)
+        return NoEndpointAvailableError(max(first.open_until - now, 0.0), first.last_error)
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        return [endpoint.get_stats() for endpoint in self.endpoints]
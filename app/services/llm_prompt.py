@@ -0,0 +1,323 @@
+import re
+import json
+import logging
+from functools import lru_cache
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from app.services.llm_stream import count_tokens
+from app.services.code_context import slice_code
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Structured response of every website request, shared by all providers
+WEBSITE_TOOL_NAME = "process_website_request"
+
+WEBSITE_TOOL: Dict[str, Any] = {
+    "type": "function",
+    "function": {
+        "name": WEBSITE_TOOL_NAME,
+        "description": "Process user's website modification request",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "response_type": {
+                    "type": "string",
+                    "enum": ["chat", "update", "update_all", "rewrite"],
+                    "description": "Type of response: chat (just talk), update (modify one specific instance), update_all (replace all occurrences), rewrite (complete new code)"
+                },
+                "chat_message": {
+                    "type": "string",
+                    "description": "Message to show the user explaining what you're doing"
+                },
+                "updates": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "file": {"type": "string", "enum": ["html", "css", "js"]},
+                            "old_str": {"type": "string"},
+                            "new_str": {"type": "string"},
+                            "description": {"type": "string"}
+                        },
+                        "required": ["file", "old_str", "new_str"]
+                    },
+                    "description": "List of code updates to apply"
+                },
+                "new_code": {
+                    "type": "object",
+                    "properties": {
+                        "html": {"type": "string"},
+                        "css": {"type": "string"},
+                        "js": {"type": "string"}
+                    },
+                    "description": "Complete new code for rewrite"
+                },
+                "explanation": {
+                    "type": "string",
+                    "description": "Technical explanation of changes made"
+                },
+                "follow_up_suggestions": {
+                    "type": "array",
+                    "maxItems": 3,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "title": {
+                                "type": "string",
+                                "description": "Kurzer Button-Text (max 25 Zeichen)"
+                            },
+                            "prompt": {
+                                "type": "string",
+                                "description": "Der vollständige Prompt, der gesendet wird"
+                            },
+                            "icon": {
+                                "type": "string",
+                                "description": "Emoji für den Button"
+                            }
+                        },
+                        "required": ["title", "prompt", "icon"]
+                    },
+                    "description": "Vorschläge für nächste Schritte"
+                },
+                "new_concepts": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Liste neuer Konzepte, die in dieser Antwort eingeführt wurden"
+                }
+            },
+            "required": ["response_type", "chat_message"]
+        }
+    }
+}
+
+
+# Tool list of every website request; the same object keeps the serialized prefix identical
+WEBSITE_TOOLS: List[Dict[str, Any]] = [WEBSITE_TOOL]
+
+# Static part of the code context, sent with the system prompt so that
+# system prompt + tools form a prefix the provider can cache between requests
+WEBSITE_RULES = """
+
+IFRAME-KONTEXT:
+- Vollständiger Zugriff auf Web APIs (localStorage, Canvas, etc.)
+- Alpine.js verfügbar für Navigation (da normale Links nicht funktionieren)
+- Tailwind CSS vollständig geladen
+- Real-time Preview mit sofortiger Aktualisierung
+
+GEKÜRZTER CODE:
+Bei großen Websites sind nur die für die Anfrage relevanten Teile wörtlich
+enthalten, ausgelassene Teile sind durch "… ausgelassen"-Kommentare ersetzt.
+- old_str muss vollständig aus einem gezeigten Teil stammen, nie über einen Auslassungs-Kommentar hinweg
+- Verwende dann update oder update_all, kein rewrite (ausgelassene Teile würden sonst gelöscht)"""
+
+
+def build_system_prompt(base_prompt: str) -> str:
+    """System prompt of website requests: the context's prompt plus the static website rules"""
+    return base_prompt + WEBSITE_RULES
+
+
+@lru_cache()
+def tools_tokens() -> int:
+    return count_tokens(json.dumps(WEBSITE_TOOLS))
+
+
+class LLMRequest(NamedTuple):
+    """Provider-neutral chat request: OpenAI-style messages plus the tool to call"""
+    messages: List[Dict[str, str]]
+    tools: List[Dict[str, Any]]
+    tool_name: str
+    temperature: float = 0.7
+    # Prompt tokens per section, plus how many list items did not fit the budget
+    token_breakdown: Optional[Dict[str, Any]] = None
+    # Offsets of the code shown verbatim per file, if the code was sliced
+    visible_code: Optional[Dict[str, List[Tuple[int, int]]]] = None
+
+
+# Tokens the API adds around every chat message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def build_code_context(current_code: Dict[str, str], sliced: bool = False) -> str:
+    """Describe the current website code (the dynamic part of the prompt)"""
+    return f"""
+Aktueller Code der Website (läuft in iframe mit Tailwind + Alpine.js){" – GEKÜRZT" if sliced else ""}:
+
+HTML:
+```html
+{current_code.get('html', '')}
+```
+
+CSS:
+```css
+{current_code.get('css', '')}
+```
+
+JavaScript:
+```javascript
+{current_code.get('js', '')}
+```
+"""
+
+
+def build_image_line(img: Dict[str, Any]) -> str:
+    """Describe one image with the URL the generated code may use"""
+    return (
+        f"- {img['original_name']} ({img['width']}x{img['height']}) - ID: {img['id']}\n"
+        f"  URL für HTML-Code: /api/images/public/{img['id']}/data\n"
+        f"  Alt-Text: {img.get('alt_text', 'Kein Alt-Text')}\n"
+    )
+
+
+def _words(text: str) -> set:
+    return {word for word in re.split(r"\W+", text.lower()) if len(word) > 2}
+
+
+def rank_images(user_images: List[Dict[str, Any]], prompt: str, current_code: Dict[str, str]) -> List[Dict[str, Any]]:
+    """Images named in the prompt first, then images used in the code, then newest first"""
+    prompt_words = _words(prompt)
+    code = "".join(current_code.get(file_type, "") for file_type in ("html", "css", "js"))
+
+    def score(img: Dict[str, Any]) -> int:
+        described = _words(f"{img.get('original_name', '')} {img.get('alt_text') or ''}")
+        return (2 if prompt_words & described else 0) + (1 if f"/api/images/public/{img['id']}/" in code else 0)
+
+    # sorted() is stable, so equal scores keep the newest-first order of the query
+    return sorted(user_images, key=score, reverse=True)
+
+
+def rank_concepts(learned_concepts: List[str], prompt: str) -> List[str]:
+    """Concepts named in the prompt first, then the most recently learned"""
+    prompt_words = _words(prompt)
+    recent_first = list(reversed(learned_concepts))
+    return sorted(recent_first, key=lambda concept: bool(prompt_words & _words(concept)), reverse=True)
+
+
+def _fit(items: List[str], budget: int) -> List[str]:
+    """Take items in order while their tokens fit the budget"""
+    fitted = []
+    for item in items:
+        tokens = count_tokens(item)
+        if tokens > budget:
+            break
+        fitted.append(item)
+        budget -= tokens
+    return fitted
+
+
+def estimate_prompt_tokens(system_prompt: str, prompt: str, current_code: Dict[str, str],
+                           chat_history: Optional[List[Dict[str, str]]] = None,
+                           user_images: Optional[List[Dict[str, Any]]] = None,
+                           learned_concepts: Optional[List[str]] = None,
+                           token_budget: Optional[int] = None) -> int:
+    """
+    Upper bound of the prompt tokens of a website request, without building it
+
+    Counts the code unsliced (a rewrite of sliced code is resent in full)
+    and the optional sections as far as the budget would let them in.
+    """
+    budget = token_budget or settings.llm_prompt_token_budget
+    required = (
+        count_tokens(system_prompt) + tools_tokens()
+        + count_tokens(build_code_context(current_code))
+        + count_tokens(f"\n\nNutzer-Anfrage: {prompt}")
+        + 2 * MESSAGE_OVERHEAD_TOKENS
+    )
+    optional = count_tokens(", ".join((learned_concepts or [])[-settings.llm_prompt_max_concepts:]))
+    optional += sum(count_tokens(build_image_line(img)) for img in (user_images or [])[:settings.llm_prompt_max_images])
+    optional += sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in (chat_history or [])[-5:])
+    return required + min(optional, max(budget - required, 0))
+
+
+def build_website_request(system_prompt: str, prompt: str, current_code: Dict[str, str],
+                          chat_history: Optional[List[Dict[str, str]]] = None,
+                          user_images: Optional[List[Dict[str, Any]]] = None,
+                          learned_concepts: Optional[List[str]] = None,
+                          token_budget: Optional[int] = None,
+                          recent_edits: Optional[List[str]] = None,
+                          full_code: bool = False) -> LLMRequest:
+    """
+    Build the messages and tool of a website request once, for any provider
+
+    Messages are ordered from stable to dynamic: system prompt (with
+    build_system_prompt applied by the caller), chat history, then one
+    user message with code, concepts, images and the request.
+
+    System prompt, tool, code and the request itself are always sent; large
+    code is cut to the fragments relevant to the prompt and recent edits
+    unless full_code is set. The rest of the token budget goes to learned
+    concepts, then images, then chat history, each ranked by relevance and
+    cut where the budget ends.
+    """
+    budget = token_budget or settings.llm_prompt_token_budget
+    code_slice = slice_code(
+        current_code, prompt,
+        max_tokens=None if full_code else settings.llm_code_context_tokens,
+        recent_edits=recent_edits or ()
+    )
+    code_context = build_code_context(code_slice.code, sliced=code_slice.omitted > 0)
+    request_text = f"\n\nNutzer-Anfrage: {prompt}"
+
+    breakdown: Dict[str, Any] = {
+        "system": count_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS,
+        "tools": tools_tokens(),
+        "code": count_tokens(code_context) + MESSAGE_OVERHEAD_TOKENS,
+        "request": count_tokens(request_text)
+    }
+    remaining = budget - sum(breakdown.values())
+    if remaining < 0:
+        logger.warning(f"Prompt exceeds token budget before optional sections: {sum(breakdown.values())} > {budget}")
+
+    # Learned concepts keep the AI from re-explaining what the user knows
+    concepts = rank_concepts(learned_concepts or [], prompt)[:settings.llm_prompt_max_concepts]
+    concepts = _fit([f"{concept}, " for concept in concepts], max(remaining, 0))
+    concepts_context = ""
+    if concepts:
+        concepts_context = f"\n\nBereits erlernte Konzepte des Nutzers: {''.join(concepts).rstrip(', ')}"
+    breakdown["concepts"] = count_tokens(concepts_context)
+    remaining -= breakdown["concepts"]
+
+    images = rank_images(user_images or [], prompt, current_code)[:settings.llm_prompt_max_images]
+    image_lines = _fit([build_image_line(img) for img in images], max(remaining, 0))
+    image_context = ""
+    if image_lines:
+        image_context = "\n\nVerfügbare Bilder:\n" + "".join(image_lines)
+        if len(image_lines) < len(user_images):
+            image_context += f"(und {len(user_images) - len(image_lines)} weitere Bilder)\n"
+    breakdown["images"] = count_tokens(image_context)
+    remaining -= breakdown["images"]
+
+    # Most recent turns first; the API needs them back in chronological order
+    history = []
+    for message in reversed((chat_history or [])[-5:]):  # Last 5 messages for context
+        tokens = count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if tokens > remaining:
+            break
+        history.insert(0, message)
+        remaining -= tokens
+    breakdown["history"] = sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in history)
+
+    breakdown["total"] = sum(breakdown.values())
+    breakdown["budget"] = budget
+    breakdown["dropped"] = {
+        "code_fragments": code_slice.omitted,
+        "concepts": len(learned_concepts or []) - len(concepts),
+        "images": len(user_images or []) - len(image_lines),
+        "history": len((chat_history or [])[-5:]) - len(history)
+    }
+
+    messages: List[Dict[str, str]] = [{"role": "system", "content": system_prompt}]
+    messages.extend(history)
+    messages.append({
+        "role": "user",
+        "content": f"{code_context}{concepts_context}{image_context}{request_text}"
+    })
+
+    return LLMRequest(
+        messages=messages,
+        tools=WEBSITE_TOOLS,
+        tool_name=WEBSITE_TOOL_NAME,
+        token_breakdown=breakdown,
+        visible_code=code_slice.visible if code_slice.omitted else None
+    )
@@ -0,0 +1,277 @@
+import json
+import asyncio
+import logging
+from itertools import count
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Type
+
+import aiohttp
+import httpx
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+from azure.ai.inference.aio import ChatCompletionsClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport
+
+from app.services.llm_prompt import LLMRequest
+from app.services.llm_stream import TokenUsage, ToolCallStream, estimate_usage, usage_from_payload
+
+if TYPE_CHECKING:
+    from app.services.llm_endpoints import LLMEndpoint
+
+logger = logging.getLogger(__name__)
+
+# First Azure OpenAI API version that accepts stream_options (older ones answer 400)
+STREAM_USAGE_MIN_API_VERSION = "2024-09-01"
+
+
+class ProviderResult(NamedTuple):
+    """Raw tool-call arguments and token usage of one completion"""
+    arguments: str
+    usage: TokenUsage
+
+
+class LLMProvider:
+    """
+    Transport of one deployment
+
+    Providers only send an LLMRequest and return the tool-call arguments;
+    prompts, parsing, routing and retries are shared by all of them.
+    """
+
+    # "httpx", "aiohttp" or None: the shared connection pool the provider needs
+    transport: Optional[str] = None
+    # Whether calls cost money (local and fake backends are free)
+    billable = True
+    default_max_tokens = 2000
+
+    def __init__(self, endpoint: "LLMEndpoint", transport: Any = None):
+        self.endpoint = endpoint
+
+    @property
+    def max_tokens(self) -> int:
+        return self.endpoint.max_tokens or self.default_max_tokens
+
+    async def complete(self, request: LLMRequest, stream: Optional[ToolCallStream] = None) -> ProviderResult:
+        """Send a request; if stream is given, feed it the arguments as they arrive"""
+        raise NotImplementedError
+
+    @staticmethod
+    def _usage(request: LLMRequest, arguments: str, reported: Any = None) -> TokenUsage:
+        """Usage reported by the server, or estimated locally if it sent none"""
+        return usage_from_payload(reported) or estimate_usage(
+            [m["content"] for m in request.messages], arguments
+        )
+
+    async def open_connection(self):
+        """Open one keep-alive connection ahead of the first request"""
+
+    async def close(self):
+        """Close the client (shared connection pools are closed by the service)"""
+
+
+class OpenAIProvider(LLMProvider):
+    """Any server speaking the OpenAI chat completions API"""
+
+    transport = "httpx"
+    # Named tool choice; servers that only know "required" override this
+    named_tool_choice = True
+
+    @property
+    def stream_usage(self) -> bool:
+        """Whether to ask for token usage in the last stream chunk (estimated locally otherwise)"""
+        return True
+
+    def __init__(self, endpoint: "LLMEndpoint", transport: httpx.AsyncClient):
+        super().__init__(endpoint)
+        self.http_client = transport
+        self.client = self._create_client()
+
+    def _create_client(self) -> AsyncOpenAI:
+        raise NotImplementedError
+
+    async def complete(self, request: LLMRequest, stream: Optional[ToolCallStream] = None) -> ProviderResult:
+        if self.named_tool_choice:
+            tool_choice: Any = {"type": "function", "function": {"name": request.tool_name}}
+        else:
+            tool_choice = "required"
+
+        request_args = dict(
+            model=self.endpoint.model,
+            messages=request.messages,
+            tools=request.tools,
+            tool_choice=tool_choice,
+            temperature=request.temperature,
+            max_tokens=self.max_tokens
+        )
+
+        if not stream:
+            response = await self.client.chat.completions.create(**request_args)
+            arguments = response.choices[0].message.tool_calls[0].function.arguments
+            return ProviderResult(arguments, self._usage(request, arguments, response.usage))
+
+        if self.stream_usage:
+            request_args["extra_body"] = {"stream_options": {"include_usage": True}}
+        chunks = await self.client.chat.completions.create(**request_args, stream=True)
+        async for chunk in chunks:
+            stream.set_usage(getattr(chunk, "usage", None))
+            if not chunk.choices:
+                continue
+            for tool_call_delta in chunk.choices[0].delta.tool_calls or []:
+                if tool_call_delta.index == 0 and tool_call_delta.function and tool_call_delta.function.arguments:
+                    await stream.feed(tool_call_delta.function.arguments)
+
+        arguments = stream.arguments
+        return ProviderResult(arguments, self._usage(request, arguments, stream.usage))
+
+    async def open_connection(self):
+        await self.http_client.get(self.endpoint.url, timeout=10.0)
+
+    async def close(self):
+        await self.client.close()
+
+
+class AzureOpenAIProvider(OpenAIProvider):
+    """Azure OpenAI deployment"""
+
+    @property
+    def stream_usage(self) -> bool:
+        # API versions are dates ("2024-12-01-preview"), so they compare as strings
+        return (self.endpoint.api_version or "")[:10] >= STREAM_USAGE_MIN_API_VERSION
+
+    def _create_client(self) -> AsyncOpenAI:
+        return AsyncAzureOpenAI(
+            api_key=self.endpoint.api_key,
+            api_version=self.endpoint.api_version,
+            azure_endpoint=self.endpoint.url,
+            http_client=self.http_client,
+            max_retries=0  # Retries go through the LLM scheduler
+        )
+
+
+class LocalOpenAIProvider(OpenAIProvider):
+    """OpenAI-compatible server on the local network (llama.cpp, vLLM, Ollama)"""
+
+    billable = False
+    named_tool_choice = False
+
+    def _create_client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(
+            base_url=self.endpoint.url,
+            api_key=self.endpoint.api_key or "local",
+            http_client=self.http_client,
+            max_retries=0  # Retries go through the LLM scheduler
+        )
+
+
+class AzureInferenceProvider(LLMProvider):
+    """Azure AI Inference model (e.g. DeepSeek)"""
+
+    transport = "aiohttp"
+    default_max_tokens = 5000
+
+    def __init__(self, endpoint: "LLMEndpoint", transport: aiohttp.ClientSession):
+        super().__init__(endpoint)
+        self.http_session = transport
+        self.client = ChatCompletionsClient(
+            endpoint=endpoint.url,
+            credential=AzureKeyCredential(endpoint.api_key),
+            api_version=endpoint.api_version,
+            transport=AioHttpTransport(session=transport, session_owner=False),
+            retry_total=0  # Retries go through the LLM scheduler
+        )
+
+    @staticmethod
+    def _convert_messages(messages: List[Dict[str, str]]) -> list:
+        from azure.ai.inference.models import SystemMessage, UserMessage, AssistantMessage, ToolMessage
+
+        message_types = {
+            "system": SystemMessage,
+            "user": UserMessage,
+            "assistant": AssistantMessage,
+            "tool": ToolMessage
+        }
+        return [
+            message_types[msg["role"]](content=msg["content"])
+            for msg in messages
+            if msg["role"] in message_types
+        ]
+
+    async def complete(self, request: LLMRequest, stream: Optional[ToolCallStream] = None) -> ProviderResult:
+        # Note: DeepSeek only supports "auto", "required", or "none" for tool_choice
+        request_args = dict(
+            model=self.endpoint.model,
+            messages=self._convert_messages(request.messages),
+            tools=request.tools,
+            tool_choice="required",  # Force tool use since we need structured output
+            temperature=request.temperature,
+            max_tokens=self.max_tokens
+        )
+
+        if not stream:
+            # Async client: the event loop keeps serving other sockets while DeepSeek thinks
+            response = await self.client.complete(**request_args)
+            arguments = response.choices[0].message.tool_calls[0].function.arguments
+            return ProviderResult(arguments, self._usage(request, arguments, response.usage))
+
+        updates = await self.client.complete(**request_args, stream=True)
+        async for update in updates:
+            stream.set_usage(getattr(update, "usage", None))
+            if not update.choices:
+                continue
+            for tool_call_delta in update.choices[0].delta.tool_calls or []:
+                if tool_call_delta.function and tool_call_delta.function.arguments:
+                    await stream.feed(tool_call_delta.function.arguments)
+
+        arguments = stream.arguments
+        return ProviderResult(arguments, self._usage(request, arguments, stream.usage))
+
+    async def open_connection(self):
+        async with self.http_session.get(self.endpoint.url) as response:
+            await response.read()
+
+    async def close(self):
+        await self.client.close()
+
+
+class FakeProvider(LLMProvider):
+    """
+    Deterministic provider for tests and benchmarks
+
+    Answers with the endpoint's "responses" (tool-call argument objects,
+    used in turn) or echoes the request as a chat reply. "latency" adds a
+    fixed delay; streamed answers arrive in chunks of "chunk_size" characters.
+    """
+
+    billable = False
+
+    def __init__(self, endpoint: "LLMEndpoint", transport: Any = None):
+        super().__init__(endpoint)
+        self.responses: List[Dict[str, Any]] = endpoint.options.get("responses") or []
+        self.latency = float(endpoint.options.get("latency", 0))
+        self.chunk_size = int(endpoint.options.get("chunk_size", 16))
+        self.calls = count()
+
+    async def complete(self, request: LLMRequest, stream: Optional[ToolCallStream] = None) -> ProviderResult:
+        call = next(self.calls)
+        if self.responses:
+            response_data = self.responses[call % len(self.responses)]
+        else:
+            prompt = request.messages[-1]["content"].rsplit("Nutzer-Anfrage: ", 1)[-1]
+            response_data = {"response_type": "chat", "chat_message": f"Test-Antwort auf: {prompt}"}
+        arguments = json.dumps(response_data, ensure_ascii=False)
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if stream:
+            for start in range(0, len(arguments), self.chunk_size):
+                await stream.feed(arguments[start:start + self.chunk_size])
+
+        return ProviderResult(arguments, self._usage(request, arguments))
+
+
+# Provider per endpoint type; "provider" in LLM_ENDPOINTS selects one explicitly
+PROVIDERS: Dict[str, Type[LLMProvider]] = {
+    "openai": AzureOpenAIProvider,
+    "ai-inference": AzureInferenceProvider,
+    "local": LocalOpenAIProvider,
+    "fake": FakeProvider
+}
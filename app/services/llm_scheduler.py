@@ -0,0 +1,256 @@
+import time
+import random
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set, TypeVar
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+T = TypeVar("T")
+QueuePositionCallback = Callable[[int], Awaitable[None]]
+
+
+class _Ticket:
+    """One request waiting for an LLM slot"""
+
+    def __init__(self, user_id: int, workshop_id: Optional[int], on_position: Optional[QueuePositionCallback]):
+        self.user_id = user_id
+        self.workshop_id = workshop_id
+        self.on_position = on_position
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.last_position = 0
+        self.sent_position = 0
+        self.sender: Optional[asyncio.Task] = None
+
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    Get the Retry-After delay of a rate-limited (429) or overloaded upstream error
+
+    Returns:
+        Seconds to wait (0 if the response had no usable header),
+        or None if the error is not worth retrying
+    """
+    # Raised locally, e.g. while every deployment is paused
+    if isinstance(getattr(error, "retry_after", None), (int, float)):
+        return float(error.retry_after)
+
+    status_code = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    if status_code is None and response is not None:
+        status_code = getattr(response, "status_code", None)
+    if status_code not in RETRYABLE_STATUS_CODES:
+        return None
+
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return 0.0
+
+
+class LLMScheduler:
+    """
+    Process-wide fair-share queue in front of the LLM endpoint
+
+    At most max_concurrent requests run at once (and at most
+    max_per_workshop per workshop). Every user has one request in flight at
+    a time; waiting users are served round-robin, so a burst from one user
+    cannot starve the others. 429/5xx errors are retried with jittered
+    backoff, and a Retry-After from upstream pauses all dispatching.
+    """
+
+    def __init__(self, max_concurrent: int, max_per_workshop: int, max_retries: int,
+                 backoff_base: float, backoff_max: float):
+        self.max_concurrent = max_concurrent
+        self.max_per_workshop = max_per_workshop
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # user_id -> waiting tickets; order is the round-robin order
+        self.queues: "OrderedDict[int, Deque[_Ticket]]" = OrderedDict()
+        self.active_users: Set[int] = set()
+        self.active_per_workshop: Dict[Optional[int], int] = {}
+        self.resume_at = 0.0
+        self.resume_handle: Optional[asyncio.TimerHandle] = None
+        self.position_tasks: Set[asyncio.Task] = set()
+        self.retries = 0
+
+    @property
+    def active(self) -> int:
+        return len(self.active_users)
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def run(self, call: Callable[[], Awaitable[T]], user_id: int, workshop_id: Optional[int] = None,
+                  on_position: Optional[QueuePositionCallback] = None) -> T:
+        """Run an LLM call in the user's turn, retrying rate-limit and overload errors"""
+        async with self.slot(user_id, workshop_id, on_position):
+            attempt = 0
+            while True:
+                try:
+                    return await call()
+                except Exception as e:
+                    retry_after = get_retry_after(e)
+                    if retry_after is None or attempt >= self.max_retries:
+                        raise
+
+                    self.retries += 1
+                    if retry_after:
+                        self.pause(retry_after)
+                    delay = self._backoff(attempt, retry_after)
+                    attempt += 1
+                    logger.warning(f"LLM request of user {user_id} failed ({e}), retry {attempt} in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, workshop_id: Optional[int] = None,
+                   on_position: Optional[QueuePositionCallback] = None):
+        """Wait for the user's turn and hold one LLM slot"""
+        ticket = _Ticket(user_id, workshop_id, on_position)
+        self.queues.setdefault(user_id, deque()).append(ticket)
+        self._dispatch()
+
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # Granted just as the waiter was cancelled
+                self._release(ticket)
+            else:
+                self._remove(ticket)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    def pause(self, seconds: float):
+        """Stop granting slots until upstream accepts requests again"""
+        resume_at = time.monotonic() + seconds
+        if resume_at <= self.resume_at:
+            return
+        self.resume_at = resume_at
+        if self.resume_handle:
+            self.resume_handle.cancel()
+        self.resume_handle = asyncio.get_running_loop().call_later(seconds, self._dispatch)
+
+    def _backoff(self, attempt: int, retry_after: float) -> float:
+        # Jitter spreads the retries of everyone who was limited at the same moment
+        if retry_after:
+            return retry_after + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _dispatch(self):
+        """Grant free slots to waiting users in round-robin order"""
+        if time.monotonic() < self.resume_at:
+            return
+
+        granted = True
+        while granted and self.active < self.max_concurrent:
+            granted = False
+            for user_id, queue in self.queues.items():
+                ticket = queue[0]
+                if user_id in self.active_users:
+                    continue
+                if self.active_per_workshop.get(ticket.workshop_id, 0) >= self.max_per_workshop:
+                    continue
+
+                queue.popleft()
+                if queue:
+                    # The user goes to the back of the round
+                    self.queues.move_to_end(user_id)
+                else:
+                    del self.queues[user_id]
+
+                self.active_users.add(user_id)
+                self.active_per_workshop[ticket.workshop_id] = self.active_per_workshop.get(ticket.workshop_id, 0) + 1
+                ticket.future.set_result(None)
+                granted = True
+                break
+
+        self._notify_positions()
+
+    def _release(self, ticket: _Ticket):
+        self.active_users.discard(ticket.user_id)
+        if ticket.user_id in self.queues:
+            # Requests queued while this one ran wait for everyone else first
+            self.queues.move_to_end(ticket.user_id)
+        remaining = self.active_per_workshop.get(ticket.workshop_id, 1) - 1
+        if remaining > 0:
+            self.active_per_workshop[ticket.workshop_id] = remaining
+        else:
+            self.active_per_workshop.pop(ticket.workshop_id, None)
+        self._dispatch()
+
+    def _remove(self, ticket: _Ticket):
+        queue = self.queues.get(ticket.user_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self.queues[ticket.user_id]
+        self._notify_positions()
+
+    def _notify_positions(self):
+        """Tell waiting users their position whenever it changes"""
+        for rank, queue in enumerate(self.queues.values()):
+            for depth, ticket in enumerate(queue):
+                # Each round serves one request per user
+                position = depth * len(self.queues) + rank + 1
+                if ticket.on_position and position != ticket.last_position:
+                    ticket.last_position = position
+                    if not ticket.sender:
+                        # One sender per ticket keeps the updates in order
+                        ticket.sender = asyncio.create_task(self._send_positions(ticket))
+                        self.position_tasks.add(ticket.sender)
+                        ticket.sender.add_done_callback(self.position_tasks.discard)
+
+    @staticmethod
+    async def _send_positions(ticket: _Ticket):
+        """Send the ticket's latest position until the user has seen it"""
+        try:
+            while ticket.sent_position != ticket.last_position:
+                position = ticket.last_position
+                try:
+                    await ticket.on_position(position)
+                except Exception as e:
+                    logger.debug(f"Could not send queue position: {e}")
+                    return
+                ticket.sent_position = position
+        finally:
+            ticket.sender = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get scheduler statistics"""
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "paused_for": max(0.0, round(self.resume_at - time.monotonic(), 1)),
+            "retries": self.retries
+        }
+
+
+# Global LLM scheduler instance
+llm_scheduler = LLMScheduler(
+    max_concurrent=settings.llm_max_concurrent_requests,
+    max_per_workshop=settings.llm_max_concurrent_per_workshop,
+    max_retries=settings.llm_max_retries,
+    backoff_base=settings.llm_backoff_base,
+    backoff_max=settings.llm_backoff_max
+)
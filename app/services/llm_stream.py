@@ -0,0 +1,422 @@
+import re
+import json
+import time
+import logging
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+ChatDeltaCallback = Callable[[str], Awaitable[None]]
+# Receives {"response_type", "update"} or {"response_type", "file", "content"}
+CodeEditCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
+_JSON_SCALAR = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null')
+_JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class TokenUsage(NamedTuple):
+    """Token usage of a streamed completion"""
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+    cached_tokens: int = 0  # Prompt tokens served from the provider's prompt cache
+
+
+# Rough size of a token, for counting without the encoding
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache()
+def _get_encoding():
+    """cl100k_base, or None if it is neither cached nor downloadable (offline, CI)"""
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"Could not load tiktoken encoding, estimating tokens from characters: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens locally with the cl100k_base encoding (estimated from the length without it)"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def estimate_usage(prompt_texts: List[str], completion_text: str) -> TokenUsage:
+    """Estimate usage locally when the provider does not report it for a stream"""
+    prompt_tokens = sum(count_tokens(text) for text in prompt_texts)
+    completion_tokens = count_tokens(completion_text)
+    return TokenUsage(prompt_tokens, completion_tokens, prompt_tokens + completion_tokens)
+
+
+def usage_from_payload(usage: Any) -> Optional[TokenUsage]:
+    """Read a usage payload that may be an SDK object or a plain dict"""
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        get = usage.get
+    else:
+        get = lambda key: getattr(usage, key, None)
+    prompt_tokens = get("prompt_tokens")
+    completion_tokens = get("completion_tokens")
+    if prompt_tokens is None or completion_tokens is None:
+        return None
+    total_tokens = get("total_tokens") or prompt_tokens + completion_tokens
+
+    # OpenAI-style prompt_tokens_details.cached_tokens (absent without a cache hit)
+    details = get("prompt_tokens_details")
+    if isinstance(details, dict):
+        cached_tokens = details.get("cached_tokens")
+    else:
+        cached_tokens = getattr(details, "cached_tokens", None)
+    return TokenUsage(prompt_tokens, completion_tokens, total_tokens, cached_tokens or 0)
+
+
+def decode_partial_json_string(buffer: str, pos: int) -> Tuple[str, int, bool]:
+    """
+    Decode a JSON string body starting at pos (just after the opening quote)
+
+    Returns:
+        Tuple of (decoded_text, next_pos, finished); decoding stops before an
+        escape sequence that is cut off at the end of the buffer
+    """
+    out = []
+    i = pos
+    while i < len(buffer):
+        char = buffer[i]
+        if char == '"':
+            return "".join(out), i + 1, True
+        if char != '\\':
+            out.append(char)
+            i += 1
+            continue
+
+        # Escape sequence: wait for more input if it is cut off
+        if i + 1 >= len(buffer):
+            break
+        escape = buffer[i + 1]
+        if escape != 'u':
+            out.append(_JSON_ESCAPES.get(escape, escape))
+            i += 2
+            continue
+        if i + 6 > len(buffer):
+            break
+        code = int(buffer[i + 2:i + 6], 16)
+        if 0xD800 <= code < 0xDC00:
+            # High surrogate: needs the following \uXXXX low surrogate
+            if i + 12 > len(buffer):
+                break
+            low = int(buffer[i + 8:i + 12], 16)
+            code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+            i += 12
+        else:
+            i += 6
+        out.append(chr(code))
+
+    return "".join(out), i, False
+
+
+class StreamEvent(NamedTuple):
+    """Something usable that completed inside the streamed tool-call arguments"""
+    kind: str  # "chat_delta", "response_type", "update" or "file"
+    value: Any
+
+
+class StreamingToolCallParser:
+    """
+    Incremental parser for process_website_request arguments
+
+    Scans the arguments as they arrive and reports chat_message text, the
+    response_type, every completed updates[] item and every completed
+    new_code file without waiting for the whole JSON document.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        # One entry per open container: [kind, current_key, expecting_key, value_start]
+        self.stack: List[list] = []
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.string_is_key = False
+        self.chat_pos: Optional[int] = None
+
+    def _path(self) -> Tuple[Optional[str], ...]:
+        """Keys leading to the current position (arrays add no key)"""
+        return tuple(frame[1] for frame in self.stack if frame[0] == '{')
+
+    def feed(self, fragment: str) -> List[StreamEvent]:
+        """Add an arguments fragment and return the events it completed"""
+        self.buffer += fragment
+        events: List[StreamEvent] = []
+        buffer = self.buffer
+
+        while self.pos < len(buffer):
+            char = buffer[self.pos]
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    self._end_string(events)
+                self.pos += 1
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.string_start = self.pos
+                frame = self.stack[-1] if self.stack else None
+                self.string_is_key = bool(frame and frame[0] == '{' and frame[2])
+                if not self.string_is_key and self._path() == ("chat_message",):
+                    self.chat_pos = self.pos + 1
+            elif char in '{[':
+                self.stack.append([char, None, char == '{', self.pos])
+            elif char in '}]':
+                frame = self.stack.pop() if self.stack else None
+                in_array = bool(self.stack) and self.stack[-1][0] == '['
+                if frame and frame[0] == '{' and in_array and self._path() == ("updates",):
+                    self._emit_json(events, "update", buffer[frame[3]:self.pos + 1])
+            elif char == ':':
+                if self.stack:
+                    self.stack[-1][2] = False
+            elif char == ',':
+                if self.stack and self.stack[-1][0] == '{':
+                    self.stack[-1][2] = True
+                    self.stack[-1][1] = None
+            self.pos += 1
+
+        # Forward the part of chat_message that arrived so far
+        if self.chat_pos is not None:
+            text, self.chat_pos, finished = decode_partial_json_string(buffer, self.chat_pos)
+            if text:
+                events.append(StreamEvent("chat_delta", text))
+            if finished:
+                self.chat_pos = None
+
+        return events
+
+    def _end_string(self, events: List[StreamEvent]):
+        raw = self.buffer[self.string_start:self.pos + 1]
+        frame = self.stack[-1] if self.stack else None
+
+        if self.string_is_key:
+            frame[1] = json.loads(raw)
+            return
+
+        path = self._path()
+        if path == ("chat_message",) and self.chat_pos is not None:
+            text, _, _ = decode_partial_json_string(self.buffer, self.chat_pos)
+            if text:
+                events.append(StreamEvent("chat_delta", text))
+            self.chat_pos = None
+        elif path == ("response_type",):
+            self._emit_json(events, "response_type", raw)
+        elif len(path) == 2 and path[0] == "new_code":
+            try:
+                events.append(StreamEvent("file", {"file": path[1], "content": json.loads(raw)}))
+            except json.JSONDecodeError:
+                pass
+
+    @staticmethod
+    def _emit_json(events: List[StreamEvent], kind: str, raw: str):
+        try:
+            events.append(StreamEvent(kind, json.loads(raw)))
+        except json.JSONDecodeError:
+            logger.debug(f"Skipping unparsable streamed {kind}: {raw[:200]}")
+
+
+class ToolCallStream:
+    """Accumulate streamed tool-call arguments and forward what completes early"""
+
+    def __init__(self, on_chat_delta: Optional[ChatDeltaCallback] = None,
+                 on_code_edit: Optional[CodeEditCallback] = None):
+        self.on_chat_delta = on_chat_delta
+        self.on_code_edit = on_code_edit
+        self.fragments: List[str] = []
+        self.usage: Optional[TokenUsage] = None
+        self.response_type: Optional[str] = None
+        self.parser = StreamingToolCallParser()
+        self.first_fragment_at: Optional[float] = None  # time.monotonic() of the first fragment
+
+    @property
+    def arguments(self) -> str:
+        return "".join(self.fragments)
+
+    async def feed(self, fragment: str):
+        if self.first_fragment_at is None:
+            self.first_fragment_at = time.monotonic()
+        self.fragments.append(fragment)
+        for event in self.parser.feed(fragment):
+            if event.kind == "chat_delta":
+                if self.on_chat_delta:
+                    await self.on_chat_delta(event.value)
+            elif event.kind == "response_type":
+                self.response_type = str(event.value).lower()
+            elif self.on_code_edit:
+                if event.kind == "update":
+                    await self.on_code_edit({"response_type": self.response_type, "update": event.value})
+                else:
+                    await self.on_code_edit({"response_type": self.response_type, **event.value})
+
+    def set_usage(self, usage: Any):
+        parsed = usage_from_payload(usage)
+        if parsed:
+            self.usage = parsed
+
+
+class RecoveredArguments(NamedTuple):
+    """What could be salvaged from truncated or malformed tool-call arguments"""
+    data: Dict[str, Any]
+    lost_fields: List[str]  # e.g. ["new_code.css", "updates[2]"]
+    partial_strings: Dict[str, str]  # text of strings that were cut off, by path
+
+
+class TolerantJSONParser:
+    """
+    Parse as much of a broken JSON document as possible
+
+    Parsing stops at the first syntax error or at the end of the input.
+    Complete members of open objects and complete items of open arrays are
+    kept; the value that was cut off is reported as lost. A container cut
+    between its members (or inside a key) is reported itself, since members
+    may be missing. Objects inside arrays (like updates[] items) are only
+    kept when they are complete.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+        self.lost_fields: List[str] = []
+        self.partial_strings: Dict[str, str] = {}
+
+    def parse(self) -> RecoveredArguments:
+        # Skip anything the model put before the object (e.g. a code fence)
+        self.pos = max(self.text.find("{"), 0)
+        data, _ = self._value("")
+        if not isinstance(data, dict):
+            data = {}
+        return RecoveredArguments(data, self.lost_fields, self.partial_strings)
+
+    def _skip_whitespace(self):
+        while self.pos < len(self.text) and self.text[self.pos] in " \t\r\n":
+            self.pos += 1
+
+    def _consume(self, char: str) -> bool:
+        self._skip_whitespace()
+        if self.text.startswith(char, self.pos):
+            self.pos += 1
+            return True
+        return False
+
+    def _lose(self, path: str):
+        self.lost_fields.append(path or "<root>")
+
+    def _value(self, path: str) -> Tuple[Any, bool]:
+        """Parse one value; returns (value, complete)"""
+        self._skip_whitespace()
+        if self.pos >= len(self.text):
+            return None, False
+
+        char = self.text[self.pos]
+        if char == "{":
+            return self._object(path)
+        if char == "[":
+            return self._array(path)
+        if char == '"':
+            try:
+                text, self.pos, finished = decode_partial_json_string(self.text, self.pos + 1)
+            except ValueError:  # Invalid \u escape
+                return None, False
+            if not finished and text:
+                self.partial_strings[path] = text
+            return text, finished
+
+        match = _JSON_SCALAR.match(self.text, self.pos)
+        if not match:
+            return None, False
+        self.pos = match.end()
+        # A number at the very end may have been cut off mid-digits
+        return json.loads(match.group()), self.pos < len(self.text)
+
+    def _object(self, path: str) -> Tuple[Dict[str, Any], bool]:
+        self.pos += 1
+        result: Dict[str, Any] = {}
+        while True:
+            if self._consume("}"):
+                return result, True
+            if not self._consume('"'):
+                # Cut (or broken) between members: later members may be missing
+                self._lose(path)
+                return result, False
+            try:
+                key, self.pos, finished = decode_partial_json_string(self.text, self.pos)
+            except ValueError:
+                self._lose(path)
+                return result, False
+            member_path = f"{path}.{key}" if path else key
+            if not finished:
+                # Cut inside a key: its member and the container are incomplete
+                self._lose(member_path)
+                self._lose(path)
+                return result, False
+            if not self._consume(":"):
+                self._lose(member_path)
+                return result, False
+
+            value, complete = self._value(member_path)
+            if complete or isinstance(value, (dict, list)):
+                # Open containers keep the members that did complete
+                result[key] = value
+            if not complete:
+                if not isinstance(value, (dict, list)):
+                    self._lose(member_path)
+                return result, False
+
+            if self._consume(","):
+                continue
+            if self._consume("}"):
+                return result, True
+            self._lose(path)
+            return result, False
+
+    def _array(self, path: str) -> Tuple[List[Any], bool]:
+        self.pos += 1
+        result: List[Any] = []
+        while True:
+            if self._consume("]"):
+                return result, True
+            item_path = f"{path}[{len(result)}]"
+            value, complete = self._value(item_path)
+            if not complete:
+                # The whole item is dropped, so report it instead of its members;
+                # an array cut between items may be missing further items too
+                inside = (item_path + ".", item_path + "[")
+                self.lost_fields = [
+                    field for field in self.lost_fields if field != item_path and not field.startswith(inside)
+                ]
+                self.partial_strings = {
+                    key: text for key, text in self.partial_strings.items() if not key.startswith(inside)
+                }
+                self._lose(item_path)
+                return result, False
+            result.append(value)
+
+            if self._consume(","):
+                continue
+            if self._consume("]"):
+                return result, True
+            self._lose(f"{path}[{len(result)}]")
+            return result, False
+
+
+def recover_tool_arguments(arguments: str) -> RecoveredArguments:
+    """Salvage every complete field from truncated or malformed tool-call arguments"""
+    return TolerantJSONParser(arguments).parse()
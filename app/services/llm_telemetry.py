@@ -0,0 +1,136 @@
+import time
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+PERCENTILES = (50, 95, 99)
+
+
+class CallTiming:
+    """Timing of one AI request, filled in while it passes scheduler, deployments and stream"""
+
+    __slots__ = ("started_at", "queue_wait_ms", "ttft_ms", "duration_ms", "generation_ms", "retries", "endpoint")
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.queue_wait_ms: Optional[int] = None
+        self.ttft_ms: Optional[int] = None  # Until the first streamed fragment (None if not streamed)
+        self.duration_ms = 0
+        self.generation_ms = 0  # Time the deployments spent on successful attempts
+        self.retries = 0  # Failed attempts (scheduler retries and failovers)
+        self.endpoint = ""
+
+    def elapsed_ms(self) -> int:
+        return int((time.monotonic() - self.started_at) * 1000)
+
+    def dispatched(self):
+        """The scheduler granted a slot (only the first grant counts as queue wait)"""
+        if self.queue_wait_ms is None:
+            self.queue_wait_ms = self.elapsed_ms()
+
+    def first_fragment(self, at: float):
+        """The first streamed fragment arrived at monotonic time at"""
+        if self.ttft_ms is None:
+            self.ttft_ms = int((at - self.started_at) * 1000)
+
+    def finish(self):
+        self.duration_ms = self.elapsed_ms()
+
+    def tokens_per_second(self, completion_tokens: int) -> Optional[float]:
+        if not self.generation_ms or not completion_tokens:
+            return None
+        return round(completion_tokens / (self.generation_ms / 1000), 1)
+
+    def as_columns(self, completion_tokens: int) -> Dict[str, Any]:
+        """Values of the llm_calls timing columns"""
+        return {
+            "duration_ms": self.duration_ms,
+            "queue_wait_ms": self.queue_wait_ms,
+            "ttft_ms": self.ttft_ms,
+            "tokens_per_second": self.tokens_per_second(completion_tokens),
+            "retries": self.retries,
+            "endpoint": self.endpoint or None
+        }
+
+
+class _Sample(NamedTuple):
+    at: float
+    duration_ms: int
+    queue_wait_ms: Optional[int]
+    ttft_ms: Optional[int]
+    tokens_per_second: Optional[float]
+    retries: int
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """Nearest-rank p50/p95/p99 of values (None without values)"""
+    if not values:
+        return {f"p{p}": None for p in PERCENTILES}
+    ordered = sorted(values)
+    return {f"p{p}": ordered[max(int(len(ordered) * p / 100 + 0.5) - 1, 0)] for p in PERCENTILES}
+
+
+class LLMTelemetry:
+    """
+    Rolling latency percentiles of AI requests per model
+
+    Keeps the samples of the last window_seconds (at most max_samples per
+    model); percentiles are computed from them when stats are requested.
+    """
+
+    def __init__(self, window_seconds: int, max_samples: int):
+        self.window_seconds = window_seconds
+        self.max_samples = max_samples
+        self.samples: Dict[str, Deque[_Sample]] = {}
+        self.calls = 0
+
+    def record(self, model: str, timing: CallTiming, completion_tokens: int):
+        """Add a finished request"""
+        samples = self.samples.setdefault(model, deque(maxlen=self.max_samples))
+        samples.append(_Sample(
+            at=time.monotonic(),
+            duration_ms=timing.duration_ms,
+            queue_wait_ms=timing.queue_wait_ms,
+            ttft_ms=timing.ttft_ms,
+            tokens_per_second=timing.tokens_per_second(completion_tokens),
+            retries=timing.retries
+        ))
+        self.calls += 1
+
+    def _prune(self, samples: Deque[_Sample]):
+        cutoff = time.monotonic() - self.window_seconds
+        while samples and samples[0].at < cutoff:
+            samples.popleft()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get percentiles per model over the window"""
+        models = {}
+        for model, samples in self.samples.items():
+            self._prune(samples)
+            if not samples:
+                continue
+            models[model] = {
+                "calls": len(samples),
+                "retries": sum(s.retries for s in samples),
+                "duration_ms": percentiles([s.duration_ms for s in samples]),
+                "queue_wait_ms": percentiles([s.queue_wait_ms for s in samples if s.queue_wait_ms is not None]),
+                "ttft_ms": percentiles([s.ttft_ms for s in samples if s.ttft_ms is not None]),
+                "tokens_per_second": percentiles([s.tokens_per_second for s in samples if s.tokens_per_second is not None])
+            }
+        return {
+            "window_seconds": self.window_seconds,
+            "calls": self.calls,
+            "models": models
+        }
+
+
+# Global LLM telemetry instance
+llm_telemetry = LLMTelemetry(
+    window_seconds=settings.llm_telemetry_window,
+    max_samples=settings.llm_telemetry_max_samples
+)
@@ -1,10 +1,13 @@
 import time
 import logging
-from typing import Dict, Tuple
+from typing import Any, Dict, Hashable, List, Optional, Tuple
 from collections import defaultdict, deque
 import asyncio
 
+from app.config import get_settings
+
 logger = logging.getLogger(__name__)
+settings = get_settings()
 
 
 class RateLimiter:
@@ -102,5 +105,109 @@ class RateLimiter:
         return stats
 
 
-# Global rate limiter instance
-image_rate_limiter = RateLimiter()
\ No newline at end of file
+class GCRALimiter:
+    """
+    Token-bucket limiter using the generic cell rate algorithm (GCRA)
+
+    Each key only stores its theoretical arrival time (TAT): requests are
+    allowed at rate_per_minute on average and up to burst at once. A denied
+    request gets the exact time until the bucket has room again.
+    """
+
+    def __init__(self):
+        # key -> theoretical arrival time (monotonic seconds)
+        self.tat: Dict[Hashable, float] = {}
+        self.last_cleanup = time.monotonic()
+        self.cleanup_interval = 300
+        self.allowed = 0
+        self.denied = 0
+
+    def acquire(self, limits: List[Tuple[Hashable, float, int]]) -> float:
+        """
+        Take one request from every (key, rate_per_minute, burst) bucket
+
+        Returns:
+            0 if allowed (all buckets charged), otherwise seconds until it
+            would be allowed (no bucket charged)
+        """
+        now = time.monotonic()
+        self._cleanup(now)
+
+        retry_after = 0.0
+        new_tats = []
+        for key, rate_per_minute, burst in limits:
+            if rate_per_minute <= 0:
+                continue
+            interval = 60.0 / rate_per_minute
+            new_tat = max(self.tat.get(key, now), now) + interval
+            allow_at = new_tat - max(burst, 1) * interval
+            if allow_at > now:
+                retry_after = max(retry_after, allow_at - now)
+            new_tats.append((key, new_tat))
+
+        if retry_after:
+            self.denied += 1
+            return retry_after
+
+        for key, new_tat in new_tats:
+            self.tat[key] = new_tat
+        self.allowed += 1
+        return 0.0
+
+    def _cleanup(self, now: float):
+        """Forget keys whose bucket is full again"""
+        if now - self.last_cleanup < self.cleanup_interval:
+            return
+        for key in [key for key, tat in self.tat.items() if tat <= now]:
+            del self.tat[key]
+        self.last_cleanup = now
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "keys": len(self.tat),
+            "allowed": self.allowed,
+            "denied": self.denied
+        }
+
+
+class LLMRateLimiter(GCRALimiter):
+    """
+    Rate limit of AI requests per user and per workshop
+
+    Rates come from the settings and can be overridden per workshop with
+    Workshop.settings["rate_limit"], e.g.
+    {"user_per_minute": 6, "user_burst": 2, "workshop_per_minute": 120, "workshop_burst": 20}
+    A rate of 0 disables that limit.
+    """
+
+    def check(self, user_id: int, workshop_id: Optional[int],
+              workshop_settings: Optional[Dict[str, Any]] = None) -> float:
+        """Charge one AI request; returns 0 if allowed, otherwise seconds to wait"""
+        overrides = (workshop_settings or {}).get("rate_limit") or {}
+        limits: List[Tuple[Hashable, float, int]] = [(
+            ("user", user_id),
+            float(overrides.get("user_per_minute", settings.max_api_calls_per_minute)),
+            int(overrides.get("user_burst", settings.llm_user_burst))
+        )]
+        if workshop_id is not None:
+            limits.append((
+                ("workshop", workshop_id),
+                float(overrides.get("workshop_per_minute", settings.llm_workshop_calls_per_minute)),
+                int(overrides.get("workshop_burst", settings.llm_workshop_burst))
+            ))
+
+        retry_after = self.acquire(limits)
+        if retry_after:
+            logger.info(f"AI request of user {user_id} rate limited for {retry_after:.1f}s")
+        return retry_after
+
+    def reset_workshop(self, workshop_id: int, user_ids: List[int]):
+        """Refill the buckets of a workshop and its users, e.g. after its limits changed"""
+        self.tat.pop(("workshop", workshop_id), None)
+        for user_id in user_ids:
+            self.tat.pop(("user", user_id), None)
+
+
+# Global rate limiter instances
+image_rate_limiter = RateLimiter()
+llm_rate_limiter = LLMRateLimiter()
\ No newline at end of file
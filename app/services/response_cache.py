@@ -0,0 +1,141 @@
+import re
+import copy
+import asyncio
+import json
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Learned-concept counts that get the same cached answers
+CONCEPT_BUCKETS = (0, 1, 5, 15)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return re.sub(r"\s+", " ", prompt).strip().lower().rstrip(".!?")
+
+
+def hash_code(current_code: Dict[str, str]) -> str:
+    """Hash of the html/css/js a response was generated for"""
+    digest = hashlib.sha256()
+    for file_type in ("html", "css", "js"):
+        digest.update(current_code.get(file_type, "").encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def concepts_bucket(learned_concepts: Optional[List[str]]) -> int:
+    """Coarse experience level, so beginners and advanced users get separate answers"""
+    count = len(learned_concepts or [])
+    return sum(1 for threshold in CONCEPT_BUCKETS[1:] if count >= threshold)
+
+
+class ResponseCache:
+    """In-memory TTL/LRU cache of tool-call results for identical requests"""
+
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # key -> (expires_at, model, response_data)
+        self.entries: "OrderedDict[str, Tuple[float, str, Dict[str, Any]]]" = OrderedDict()
+        # key -> result of the request currently generating it
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def make_key(self, prompt: str, current_code: Dict[str, str], context: str, models: Iterable[str],
+                 learned_concepts: Optional[List[str]] = None,
+                 user_images: Optional[List[Dict[str, Any]]] = None,
+                 chat_history: Optional[List[Dict[str, str]]] = None) -> str:
+        """Build the cache key of a request"""
+        key = json.dumps([
+            normalize_prompt(prompt),
+            hash_code(current_code),
+            concepts_bucket(learned_concepts),
+            sorted(models),
+            context,
+            # Answers may reference image URLs or earlier turns
+            sorted(img["id"] for img in user_images or []),
+            chat_history or []
+        ], ensure_ascii=False)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Get the model and a copy of a cached response if present and not expired"""
+        if not self.enabled:
+            return None
+
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], copy.deepcopy(entry[2])
+
+    def set(self, key: str, model: str, response_data: Dict[str, Any]):
+        """Cache a complete response (recovered partial ones are not replayed)"""
+        if not self.enabled or "recovery" in response_data:
+            return
+
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, model, copy.deepcopy(response_data))
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def wait_or_claim(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        Wait for an identical request that is already being generated
+
+        Returns its result, or None if the caller has to generate the
+        response itself; it then must call release(key) when done.
+        """
+        while key in self.inflight:
+            result = await asyncio.shield(self.inflight[key])
+            if result:
+                self.hits += 1
+                return result[0], copy.deepcopy(result[1])
+        self.inflight[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def release(self, key: str, model: Optional[str] = None, response_data: Optional[Dict[str, Any]] = None):
+        """Cache the claimed request's response and hand it to everyone who waited"""
+        if response_data is not None:
+            self.set(key, model, response_data)
+        future = self.inflight.pop(key, None)
+        if future and not future.done():
+            usable = response_data is not None and "recovery" not in response_data
+            future.set_result((model, copy.deepcopy(response_data)) if usable else None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get cache statistics"""
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+# Global response cache instance
+response_cache = ResponseCache(
+    ttl_seconds=settings.response_cache_ttl,
+    max_entries=settings.response_cache_max_entries
+)
@@ -0,0 +1,115 @@
+import copy
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+
+from app.models import User, Workshop
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+
+def _column_values(instance) -> Dict[str, Any]:
+    """Copy loaded column values of an ORM instance"""
+    mapper = inspect(instance).mapper
+    return {
+        attr.key: copy.deepcopy(getattr(instance, attr.key))
+        for attr in mapper.column_attrs
+    }
+
+
+class SessionCache:
+    """In-memory TTL/LRU cache of session_token -> user snapshot"""
+
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # session_token -> (expires_at, snapshot)
+        self.entries: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def get(self, session_token: str) -> Optional[Dict[str, Any]]:
+        """Get a cached user snapshot if present and not expired"""
+        if not self.enabled:
+            return None
+
+        entry = self.entries.get(session_token)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[session_token]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(session_token)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, session_token: str, user: User):
+        """Cache a snapshot of a loaded user (and its workshop)"""
+        if not self.enabled:
+            return
+
+        workshop = user.workshop if "workshop" not in inspect(user).unloaded else None
+        snapshot = {
+            "user": _column_values(user),
+            "workshop": _column_values(workshop) if workshop else None
+        }
+
+        self.entries[session_token] = (time.monotonic() + self.ttl_seconds, snapshot)
+        self.entries.move_to_end(session_token)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def attach(self, snapshot: Dict[str, Any], db: AsyncSession) -> User:
+        """Rebuild the user from a snapshot inside db without querying"""
+        if snapshot["workshop"]:
+            workshop = Workshop(**copy.deepcopy(snapshot["workshop"]))
+            make_transient_to_detached(workshop)
+            await db.merge(workshop, load=False)
+
+        user = User(**copy.deepcopy(snapshot["user"]))
+        make_transient_to_detached(user)
+        return await db.merge(user, load=False)
+
+    def invalidate_token(self, session_token: Optional[str]):
+        """Drop a single session token"""
+        if session_token:
+            self.entries.pop(session_token, None)
+
+    def invalidate_user(self, user_id: int):
+        """Drop all cached sessions of a user (e.g. after a role change)"""
+        for token, (_, snapshot) in list(self.entries.items()):
+            if snapshot["user"]["id"] == user_id:
+                del self.entries[token]
+
+    def invalidate_workshop(self, workshop_id: int):
+        """Drop all cached sessions of a workshop (e.g. after it was stopped)"""
+        for token, (_, snapshot) in list(self.entries.items()):
+            if snapshot["user"]["workshop_id"] == workshop_id:
+                del self.entries[token]
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get cache statistics"""
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+# Global session cache instance
+session_cache = SessionCache(
+    ttl_seconds=settings.session_cache_ttl,
+    max_entries=settings.session_cache_max_entries
+)
@@ -0,0 +1,88 @@
+import secrets
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, NamedTuple, Optional
+from jose import jwt, JWTError
+
+from app.models import User
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+
+class SessionClaims(NamedTuple):
+    """Claims carried by a signed session token"""
+    user_id: int
+    workshop_id: Optional[int]
+    role: str
+    generation: int
+
+
+# user_id -> current token generation, updated on login/logout
+_token_generations: Dict[int, int] = {}
+
+
+def is_signed_mode() -> bool:
+    """Whether session tokens are signed (verified in CPU) or opaque (looked up in the DB)"""
+    return settings.session_token_mode == "signed"
+
+
+def issue_session_token(user: User) -> str:
+    """
+    Create a new session token for a user.
+
+    In signed mode this bumps the user's token generation, which revokes all
+    previously issued tokens; the caller must commit the user afterwards.
+    """
+    if not is_signed_mode():
+        return secrets.token_urlsafe(32)
+
+    user.token_generation = (user.token_generation or 0) + 1
+    _token_generations[user.id] = user.token_generation
+
+    role = user.role.value if hasattr(user.role, "value") else user.role
+    claims = {
+        "sub": str(user.id),
+        "wid": user.workshop_id,
+        "role": role,
+        "gen": user.token_generation,
+        "exp": datetime.utcnow() + timedelta(hours=settings.session_expire_hours)
+    }
+    return jwt.encode(claims, settings.secret_key, algorithm=settings.jwt_algorithm)
+
+
+def revoke_session_tokens(user: User):
+    """Invalidate every signed token of a user; the caller must commit the user afterwards"""
+    user.token_generation = (user.token_generation or 0) + 1
+    _token_generations[user.id] = user.token_generation
+
+
+def verify_session_token(session_token: str) -> Optional[SessionClaims]:
+    """Verify a signed session token without touching the database"""
+    try:
+        payload = jwt.decode(
+            session_token,
+            settings.secret_key,
+            algorithms=[settings.jwt_algorithm]
+        )
+        claims = SessionClaims(
+            user_id=int(payload["sub"]),
+            workshop_id=payload.get("wid"),
+            role=payload["role"],
+            generation=int(payload["gen"])
+        )
+    except (JWTError, KeyError, ValueError, TypeError):
+        return None
+
+    # Tokens older than the last login/logout of this user are revoked
+    if claims.generation < _token_generations.get(claims.user_id, claims.generation):
+        return None
+
+    return claims
+
+
+def is_current_generation(user: User, claims: SessionClaims) -> bool:
+    """Check claims against a loaded user row and remember its generation"""
+    _token_generations[user.id] = max(_token_generations.get(user.id, 0), user.token_generation or 0)
+    return claims.generation == (user.token_generation or 0)
@@ -32,6 +32,9 @@ function workshopApp() {
         messages: [],
         currentMessage: '',
         isAiThinking: false,
+        streamingMessage: null,
+        queuePosition: 0,
+        rateLimitedUntil: 0,
         followUpSuggestions: [],
 
         // Code State
@@ -385,8 +388,30 @@ function workshopApp() {
                     }
                     break;
 
+                case 'ai_queue_position':
+                    // Waiting for a free AI slot while many participants ask at once
+                    this.queuePosition = message.position;
+                    break;
+
+                case 'chat_delta':
+                    // Streamed answer: grow one assistant message while the AI writes
+                    this.queuePosition = 0;
+                    if (!this.streamingMessage) {
+                        this.addMessage('assistant', '');
+                        this.streamingMessage = this.messages[this.messages.length - 1];
+                    }
+                    this.streamingMessage.content += message.content;
+                    break;
+
                 case 'chat_message':
-                    this.addMessage(message.role, message.content);
+                    this.queuePosition = 0;
+                    if (this.streamingMessage) {
+                        // Final text replaces the streamed draft
+                        this.streamingMessage.content = message.content;
+                        this.streamingMessage = null;
+                    } else {
+                        this.addMessage(message.role, message.content);
+                    }
                     this.isAiThinking = false;
 
                     // Handle follow-up suggestions
@@ -401,7 +426,10 @@ function workshopApp() {
                         console.log('Syncing code from server...');
                         this.code = message.code;
                         this.refreshPreview();
-                        this.lastSaved = this.formatTime(new Date());
+                        // Streamed AI edits are shown before they are saved
+                        if (!message.preview) {
+                            this.lastSaved = this.formatTime(new Date());
+                        }
                     }
                     break;
 
@@ -452,12 +480,24 @@ function workshopApp() {
                     this.showNotification(message.message, 'success');
                     break;
 
+                case 'ai_request_cancelled':
+                    this.streamingMessage = null;
+                    this.queuePosition = 0;
+                    this.addMessage('system', 'KI-Anfrage abgebrochen');
+                    this.isAiThinking = false;
+                    break;
+
                 case 'cost_update':
                     this.totalCost = message.totalCost;
                     this.costPercentage = message.costPercentage;
                     break;
 
                 case 'error':
+                    this.streamingMessage = null;
+                    this.queuePosition = 0;
+                    if (message.retry_after) {
+                        this.rateLimitedUntil = Date.now() + message.retry_after * 1000;
+                    }
                     this.addMessage('system', `❌ Fehler: ${message.message}`);
                     this.isAiThinking = false;
                     break;
@@ -497,10 +537,18 @@ function workshopApp() {
         async sendMessage() {
             if (!this.currentMessage.trim() || this.isAiThinking) return;
 
+            // Rate limited: keep the message and tell how long to wait
+            const waitSeconds = Math.ceil((this.rateLimitedUntil - Date.now()) / 1000);
+            if (waitSeconds > 0) {
+                this.addMessage('system', `⏳ Bitte warte noch ${waitSeconds} Sekunde${waitSeconds === 1 ? '' : 'n'}`);
+                return;
+            }
+
             const message = this.currentMessage.trim();
             this.addMessage('user', message);
             this.currentMessage = '';
             this.isAiThinking = true;
+            this.queuePosition = 0;
             this.followUpSuggestions = [];
 
             this.sendWebSocketMessage({
@@ -514,6 +562,14 @@ function workshopApp() {
             this.checkAchievements('message_sent');
         },
 
+        cancelAiRequest() {
+            // Without a project, the server cancels every AI request of this connection
+            this.sendWebSocketMessage({
+                type: 'cancel_ai_request',
+                project_id: this.currentProject ? this.currentProject.id : null
+            });
+        },
+
         sendQuickAction(action) {
             this.currentMessage = action.prompt;
             this.sendMessage();
@@ -0,0 +1,6 @@
+-- Add token generation counter for signed session tokens
+-- Bumping it on login/logout revokes all previously issued signed tokens
+
+ALTER TABLE users ADD COLUMN token_generation INTEGER DEFAULT 0 NOT NULL;
+
+COMMENT ON COLUMN users.token_generation IS 'Generation of the currently valid signed session token (SESSION_TOKEN_MODE=signed)';
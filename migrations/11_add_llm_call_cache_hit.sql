@@ -0,0 +1,6 @@
+-- Mark LLM calls answered from the response cache
+-- Cache hits are recorded with zero tokens and zero cost
+
+ALTER TABLE llm_calls ADD COLUMN cache_hit BOOLEAN DEFAULT FALSE NOT NULL;
+
+COMMENT ON COLUMN llm_calls.cache_hit IS 'Response replayed from the in-memory response cache (no tokens used)';
@@ -0,0 +1,6 @@
+-- Record how the prompt token budget was spent per LLM call
+-- Keys: system, tools, code, request, concepts, images, history, total, budget, dropped
+
+ALTER TABLE llm_calls ADD COLUMN prompt_breakdown JSON;
+
+COMMENT ON COLUMN llm_calls.prompt_breakdown IS 'Prompt tokens per section and list items dropped to fit the token budget';
@@ -0,0 +1,6 @@
+-- Prompt tokens served from the provider's prompt cache
+-- Billed at the cached-input price (COST_PER_1M_CACHED_INPUT_TOKENS)
+
+ALTER TABLE llm_calls ADD COLUMN cached_tokens INTEGER DEFAULT 0 NOT NULL;
+
+COMMENT ON COLUMN llm_calls.cached_tokens IS 'Part of prompt_tokens read from the provider prompt cache';
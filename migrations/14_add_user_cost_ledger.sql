@@ -0,0 +1,22 @@
+-- Running per-user cost totals, so budget checks and cost_update frames
+-- do not aggregate llm_calls on every AI request
+
+CREATE TABLE user_cost_ledger (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    total_cost DECIMAL(12, 6) DEFAULT 0 NOT NULL,
+    total_calls INTEGER DEFAULT 0 NOT NULL,
+    total_tokens INTEGER DEFAULT 0 NOT NULL,
+    last_call_at TIMESTAMP
+);
+
+-- Rate-limit lookups of a user's recent calls
+CREATE INDEX IF NOT EXISTS idx_llm_calls_user_created_at ON llm_calls(user_id, created_at);
+
+-- Backfill from existing calls
+INSERT INTO user_cost_ledger (user_id, total_cost, total_calls, total_tokens, last_call_at)
+SELECT user_id, COALESCE(SUM(cost), 0), COUNT(id), COALESCE(SUM(total_tokens), 0), MAX(created_at)
+FROM llm_calls
+WHERE user_id IS NOT NULL
+GROUP BY user_id;
+
+COMMENT ON TABLE user_cost_ledger IS 'Running totals of llm_calls per user, reconciled periodically by the app';
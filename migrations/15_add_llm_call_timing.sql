@@ -0,0 +1,15 @@
+-- Timing of every AI request, for latency telemetry
+-- duration_ms already exists and is now filled in
+
+ALTER TABLE llm_calls ADD COLUMN queue_wait_ms INTEGER;
+ALTER TABLE llm_calls ADD COLUMN ttft_ms INTEGER;
+ALTER TABLE llm_calls ADD COLUMN tokens_per_second REAL;
+ALTER TABLE llm_calls ADD COLUMN retries INTEGER DEFAULT 0 NOT NULL;
+ALTER TABLE llm_calls ADD COLUMN endpoint VARCHAR(100);
+
+COMMENT ON COLUMN llm_calls.duration_ms IS 'From receiving the request to the complete answer, including queue wait';
+COMMENT ON COLUMN llm_calls.queue_wait_ms IS 'Time waiting for a slot in the LLM scheduler';
+COMMENT ON COLUMN llm_calls.ttft_ms IS 'Time to the first streamed token, NULL if the answer was not streamed';
+COMMENT ON COLUMN llm_calls.tokens_per_second IS 'Completion tokens per second of deployment time';
+COMMENT ON COLUMN llm_calls.retries IS 'Failed attempts before the answer (scheduler retries and failovers)';
+COMMENT ON COLUMN llm_calls.endpoint IS 'Deployment that answered (LLM_ENDPOINTS name, or cache)';
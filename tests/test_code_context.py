@@ -0,0 +1,175 @@
+from app.services.code_context import (
+    _render,
+    locate_in_slice,
+    slice_code,
+    split_blocks,
+    split_html
+)
+from app.services.code_processor import CodeProcessor
+
+HTML = """<header id="top">
+  <h1>Titel</h1>
+</header>
+<main>
+  <section class="cards">
+    <div class="card">Eins</div>
+    <div class="card">Zwei</div>
+  </section>
+</main>
+<footer>Ende</footer>
+"""
+
+CSS = """body {
+  margin: 0;
+}
+
+.card {
+  color: red;
+}
+
+@media (max-width: 600px) {
+  .card { color: blue; }
+}
+"""
+
+JS = """const count = 0;
+let label = "{";
+
+function increment() {
+  // closing } in a comment
+  return count + 1;
+}
+"""
+
+
+def test_split_html_offsets_cover_whole_elements():
+    fragments = split_html(HTML, max_tokens=1000)
+
+    assert [HTML[f.start:f.end] for f in fragments] == [
+        '<header id="top">\n  <h1>Titel</h1>\n</header>',
+        '<main>\n  <section class="cards">\n    <div class="card">Eins</div>\n'
+        '    <div class="card">Zwei</div>\n  </section>\n</main>',
+        "<footer>Ende</footer>"
+    ]
+    assert [f.label for f in fragments] == ["<header#top>", "<main>", "<footer>"]
+
+
+def test_split_html_splits_large_elements_into_children():
+    fragments = split_html(HTML, max_tokens=3)
+
+    texts = [HTML[f.start:f.end] for f in fragments]
+    assert '<div class="card">Eins</div>' in texts
+    assert '<div class="card">Zwei</div>' in texts
+    assert all(f.end <= g.start for f, g in zip(fragments, fragments[1:]))
+
+
+def test_split_blocks_css_rules_and_at_rules():
+    fragments = split_blocks("css", CSS)
+
+    assert [CSS[f.start:f.end] for f in fragments] == [
+        "body {\n  margin: 0;\n}\n",
+        ".card {\n  color: red;\n}\n",
+        "@media (max-width: 600px) {\n  .card { color: blue; }\n}\n"
+    ]
+    assert [f.label for f in fragments] == ["body", ".card", "@media (max-width: 600px)"]
+
+
+def test_split_blocks_js_ignores_braces_in_strings_and_comments():
+    fragments = split_blocks("js", JS)
+
+    assert [JS[f.start:f.end] for f in fragments] == [
+        'const count = 0;\nlet label = "{";\n',
+        "function increment() {\n  // closing } in a comment\n  return count + 1;\n}\n"
+    ]
+
+
+def test_render_keeps_fragments_verbatim_and_marks_omitted_lines():
+    fragments = split_blocks("css", CSS)
+
+    text, visible = _render("css", CSS, fragments, keep={fragments[1]})
+
+    assert text == (
+        "/* … ausgelassen (Zeilen 1-3): body */\n"
+        ".card {\n  color: red;\n}\n"
+        "\n"
+        "/* … ausgelassen (Zeilen 9-11): @media (max-width: 600px) */"
+    )
+    # The blank lines around the kept rule are shown as well
+    assert visible == [(fragments[0].end, fragments[2].start)]
+
+
+def test_render_merges_runs_separated_by_blank_lines_into_one_marker():
+    fragments = split_blocks("css", CSS)
+
+    text, visible = _render("css", CSS, fragments, keep=set())
+
+    assert text == "/* … ausgelassen (Zeilen 1-11): body, .card, @media (max-width: 600px) */"
+    assert visible == []
+
+
+def test_slice_keeps_best_match_of_every_file():
+    html = "".join(f'<section class="filler"><p>Text {i} ohne Bezug</p></section>\n' for i in range(40))
+    css = "".join(f".filler-{i} {{ margin: {i}px; }}\n\n" for i in range(40)) + ".button { color: red; }\n"
+    code = {"html": html + '<button class="button">Klick</button>\n', "css": css, "js": ""}
+
+    code_slice = slice_code(code, "Mach den Knopf rot", max_tokens=60)
+
+    assert "<button class=\"button\">Klick</button>" in code_slice.code["html"]
+    assert ".button { color: red; }" in code_slice.code["css"]
+    assert code_slice.omitted > 0
+
+
+def test_update_unique_in_slice_is_pinned_to_the_occurrence_shown():
+    filler = "".join(f".filler-{i} {{ margin: {i}px; }}\n\n" for i in range(40))
+    css = filler + ".intro { color: red; }\n\n" + filler + ".button { color: red; }\n"
+    code = {"html": '<button class="button">Klick</button>\n', "css": css, "js": ""}
+
+    code_slice = slice_code(code, "Mach den Knopf blau", max_tokens=30)
+    assert ".intro" not in code_slice.code["css"]
+
+    offset = css.index(".button") + len(".button { ")
+    assert locate_in_slice("color: red;", code, code_slice.visible) == ("css", offset)
+    updated = CodeProcessor.apply_updates(
+        code, [{"file": "css", "old_str": "color: red;", "new_str": "color: blue;", "offset": offset}]
+    )
+    assert ".intro { color: red; }" in updated["css"]
+    assert ".button { color: blue; }" in updated["css"]
+
+
+def test_pinned_update_follows_earlier_updates_to_the_same_snippet():
+    css = ".a { color: red; }\n.b { color: red; }\n.c { color: red; }\n"
+    code = {"html": "", "css": css, "js": ""}
+    pinned = {"file": "css", "old_str": "color: red;", "new_str": "color: green;", "offset": css.index(".c") + 5}
+
+    # An earlier update removes a copy before the pinned one
+    updated = CodeProcessor.apply_updates(
+        code, [{"file": "css", "old_str": "color: red;", "new_str": "color: blue;"}, pinned]
+    )
+    assert updated["css"] == ".a { color: blue; }\n.b { color: red; }\n.c { color: green; }\n"
+
+    # An earlier update adds a copy before the pinned one
+    updated = CodeProcessor.apply_updates(
+        code, [{"file": "css", "old_str": ".a {", "new_str": ".z { color: red; }\n.a {"}, pinned]
+    )
+    assert updated["css"] == ".z { color: red; }\n.a { color: red; }\n.b { color: red; }\n.c { color: green; }\n"
+
+
+def test_pinned_update_is_skipped_if_an_earlier_update_changed_it():
+    css = ".a { color: red; }\n.b { color: red; }\n"
+    code = {"html": "", "css": css, "js": ""}
+
+    updated = CodeProcessor.apply_updates(code, [
+        {"file": "css", "old_str": ".b { color: red; }", "new_str": ".b { color: blue; }"},
+        {"file": "css", "old_str": "color: red;", "new_str": "color: green;", "offset": css.index(".b") + 5},
+    ])
+
+    assert updated["css"] == ".a { color: red; }\n.b { color: blue; }\n"
+
+
+def test_unsliced_code_is_fully_visible():
+    code = {"html": "<p>Hallo</p>", "css": "", "js": ""}
+
+    code_slice = slice_code(code, "Hallo", max_tokens=1000)
+
+    assert code_slice.omitted == 0
+    assert code_slice.visible == {"html": [(0, 12)], "css": [], "js": []}
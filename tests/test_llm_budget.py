@@ -0,0 +1,56 @@
+import pytest
+
+from app.services.cost_ledger import CostLedger, LedgerEntry
+from app.services.llm_budget import BudgetExceededError, RequestBudget
+from app.services.llm_stream import TokenUsage
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    ledger = CostLedger(ttl_seconds=60, max_entries=10, reconcile_interval=0)
+    ledger.entries[1] = LedgerEntry(0.04, 1, 100, None, [], ttl_seconds=60)
+    monkeypatch.setattr("app.services.llm_budget.cost_ledger", ledger)
+    return ledger
+
+
+def test_reservation_is_extended_before_each_further_billed_call(ledger):
+    reservation = ledger.reserve(1, ledger.entries[1], 0.02, limit=0.10)
+    budget = RequestBudget(reservation, call_cost=0.02)
+
+    budget.before_call()
+    budget.add("gpt-4.1", TokenUsage(1000, 200, 1200))
+    budget.before_call()
+
+    assert reservation.amount == pytest.approx(0.04)
+    assert ledger.reserved[1] == pytest.approx(0.04)
+
+
+def test_failed_call_without_output_reuses_the_reservation(ledger):
+    reservation = ledger.reserve(1, ledger.entries[1], 0.02, limit=0.10)
+    budget = RequestBudget(reservation, call_cost=0.02)
+
+    budget.before_call()
+    budget.before_call()  # Failover after an error before any output
+
+    assert reservation.amount == pytest.approx(0.02)
+
+
+def test_call_beyond_the_budget_is_refused(ledger):
+    reservation = ledger.reserve(1, ledger.entries[1], 0.05, limit=0.10)
+    budget = RequestBudget(reservation, call_cost=0.05)
+
+    budget.before_call()
+    budget.add("gpt-4.1", TokenUsage(1000, 200, 1200))
+    with pytest.raises(BudgetExceededError):
+        budget.before_call()
+    assert ledger.reserved[1] == pytest.approx(0.05)
+
+
+def test_unfinished_calls_are_counted_as_estimates(ledger):
+    budget = RequestBudget()
+
+    budget.add("gpt-4.1", TokenUsage(1000, 200, 1200))
+    budget.add("gpt-4.1", TokenUsage(1000, 50, 1050), finished=False)
+
+    assert budget.usage == TokenUsage(2000, 250, 2250, 0)
+    assert budget.unfinished == TokenUsage(1000, 50, 1050, 0)
@@ -0,0 +1,65 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import azure_ai
+from app.services.azure_ai import AzureAIService
+from app.services.llm_scheduler import llm_scheduler
+
+CODE = {"html": "<p>Hallo</p>", "css": "", "js": ""}
+
+
+class RateLimitedError(Exception):
+    """429 without Retry-After header"""
+
+    status_code = 429
+    response = SimpleNamespace(status_code=429, headers={})
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setattr(azure_ai.settings, "llm_endpoints", [{"name": "only", "provider": "fake"}])
+    monkeypatch.setattr(llm_scheduler, "backoff_base", 0.01)
+    monkeypatch.setattr(llm_scheduler, "backoff_max", 0.05)
+    return AzureAIService()
+
+
+def fail_first_calls(monkeypatch, endpoint, error: Exception, failures: int = 1):
+    original = endpoint.provider.complete
+    calls = []
+
+    async def complete(request, stream=None):
+        calls.append(time.monotonic())
+        if len(calls) <= failures:
+            raise error
+        return await original(request, stream)
+
+    monkeypatch.setattr(endpoint.provider, "complete", complete)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_bare_429_on_the_only_endpoint_is_retried(service, monkeypatch):
+    endpoint = service.endpoints[0]
+    calls = fail_first_calls(monkeypatch, endpoint, RateLimitedError())
+
+    llm_response, response_data = await service.generate_response("Hallo", CODE, use_cache=False)
+
+    assert response_data["response_type"] == "chat"
+    assert len(calls) == 2
+    assert llm_response.timing.retries == 1
+    assert endpoint.rate_limited == 1
+    assert endpoint.circuit_state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_request_waits_for_a_paused_endpoint_to_reopen(service):
+    endpoint = service.endpoints[0]
+    endpoint.open_until = time.monotonic() + 0.2
+
+    started = time.monotonic()
+    _, response_data = await service.generate_response("Hallo", CODE, use_cache=False)
+
+    assert response_data["response_type"] == "chat"
+    assert time.monotonic() - started >= 0.2
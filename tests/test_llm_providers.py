@@ -0,0 +1,105 @@
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import pytest
+
+from app.services import llm_providers
+from app.services.llm_endpoints import LLMEndpoint
+from app.services.llm_prompt import LLMRequest
+
+SLOW_COMPLETION_SECONDS = 0.5
+
+COMPLETION = {
+    "id": "chatcmpl-1",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "DeepSeek-R1",
+    "choices": [{
+        "index": 0,
+        "finish_reason": "tool_calls",
+        "message": {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{
+                "id": "call-1",
+                "type": "function",
+                "function": {
+                    "name": "process_website_request",
+                    "arguments": '{"response_type": "chat", "chat_message": "Hallo"}'
+                }
+            }]
+        }
+    }],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+}
+
+
+class SlowCompletionHandler(BaseHTTPRequestHandler):
+    """Chat completions endpoint that takes a while to answer, like DeepSeek"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(SLOW_COMPLETION_SECONDS)
+        body = json.dumps(COMPLETION).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def slow_server():
+    # Served from its own thread, so only a blocking client can stall the event loop
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowCompletionHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.asyncio
+async def test_event_loop_keeps_running_during_slow_inference_completion(slow_server):
+    endpoint = LLMEndpoint(
+        name="deepseek", url=slow_server, api_key="key",
+        api_version="2024-05-01-preview", model="DeepSeek-R1", endpoint_type="ai-inference", tpm=100000
+    )
+    request = LLMRequest(
+        messages=[{"role": "system", "content": "System"}, {"role": "user", "content": "Hallo"}],
+        tools=[],
+        tool_name="process_website_request"
+    )
+    ticks = []
+
+    async def ticker():
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    # The real SDK client and aiohttp transport, as AzureAIService builds them
+    async with aiohttp.ClientSession() as session:
+        provider = llm_providers.AzureInferenceProvider(endpoint, transport=session)
+        ticker_task = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        started = time.monotonic()
+        try:
+            result = await provider.complete(request)
+        finally:
+            ticks.append(time.monotonic())
+            ticker_task.cancel()
+            await provider.close()
+    elapsed = time.monotonic() - started
+
+    assert json.loads(result.arguments)["chat_message"] == "Hallo"
+    assert result.usage.completion_tokens == 5
+    assert elapsed >= SLOW_COMPLETION_SECONDS
+    # A blocking call anywhere in the client would have stalled the ticker for its duration
+    assert max(later - earlier for earlier, later in zip(ticks, ticks[1:])) < SLOW_COMPLETION_SECONDS / 2
@@ -0,0 +1,59 @@
+from app.services.azure_ai import AzureAIService
+from app.services import llm_stream
+from app.services.llm_stream import recover_tool_arguments
+
+REWRITE_START = '{"response_type": "rewrite", "chat_message": "Neu!", "new_code": {"html": "<p>Hallo</p>"'
+
+
+def test_rewrite_cut_between_new_code_members_is_lost():
+    recovered = recover_tool_arguments(REWRITE_START + ", ")
+
+    assert recovered.data["new_code"] == {"html": "<p>Hallo</p>"}
+    assert "new_code" in recovered.lost_fields
+
+
+def test_rewrite_cut_after_a_new_code_member_is_lost():
+    recovered = recover_tool_arguments(REWRITE_START)
+
+    assert "new_code" in recovered.lost_fields
+
+
+def test_rewrite_cut_inside_a_new_code_key_reports_key_and_container():
+    recovered = recover_tool_arguments(REWRITE_START + ', "cs')
+
+    assert recovered.lost_fields == ["new_code.cs", "new_code"]
+
+
+def test_truncated_rewrite_is_not_applied_and_needs_follow_up():
+    response_data = AzureAIService._parse_tool_arguments(REWRITE_START + ", ")
+
+    assert "new_code" not in response_data
+    assert response_data["recovery"]["needs_follow_up"]
+
+
+def test_updates_cut_between_items_keep_complete_items():
+    recovered = recover_tool_arguments(
+        '{"response_type": "update", "updates": [{"file": "css", "old_str": "a", "new_str": "b"}, '
+    )
+
+    assert recovered.data["updates"] == [{"file": "css", "old_str": "a", "new_str": "b"}]
+    assert recovered.lost_fields == ["updates[1]"]
+
+
+def test_complete_arguments_lose_nothing():
+    recovered = recover_tool_arguments('{"response_type": "chat", "chat_message": "Hallo"}')
+
+    assert recovered.lost_fields == []
+
+
+def test_tokens_are_estimated_from_characters_without_the_encoding(monkeypatch):
+    def offline(name):
+        raise ConnectionError("no network")
+
+    monkeypatch.setattr(llm_stream.tiktoken, "get_encoding", offline)
+    llm_stream._get_encoding.cache_clear()
+    try:
+        assert llm_stream.count_tokens("a" * 10) == 3
+        assert llm_stream.count_tokens("") == 0
+    finally:
+        llm_stream._get_encoding.cache_clear()